@@ -1,62 +1,414 @@
-from typing import Optional, Callable
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Callable
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
-from app.smol_rag import SmolRag
+from app.corpora import DEFAULT_CORPUS, CorpusRegistry
+from app.definitions import WARM_UP, SNAPSHOT_PATH, SNAPSHOT_POLL_INTERVAL, INPUT_DOCS_DIR, CORPORA_DIR, \
+    CORPUS_IDLE_SECONDS
+from app.ingestion_jobs import FINISHED_STATUSES, IngestionJobs
+from app.logger import logger
+from app.metrics import metrics
+from app.smol_rag import FILTERABLE_QUERY_TYPES, SmolRag
+from app.snapshot import watch_snapshots
+from app.timings import Timings
 
-app = FastAPI(title="Salable Docs RAG API")
+# Every corpus shares the LLM client, its caches and the rate limits; the default one is always loaded
+corpora = CorpusRegistry()
+llm_kwargs = {"llm": corpora.llm, "llm_scheduler": corpora.llm_scheduler}
+smol_rag = SmolRag.from_snapshot(SNAPSHOT_PATH, **llm_kwargs) if SNAPSHOT_PATH else SmolRag(**llm_kwargs)
+corpora.register(DEFAULT_CORPUS, smol_rag)
+if CORPORA_DIR:
+    corpora.register_dir(CORPORA_DIR)
+ingestion_jobs = IngestionJobs(smol_rag, corpora)
 
-smol_rag = SmolRag()
+
+async def evict_corpora(interval):
+    while True:
+        await asyncio.sleep(interval)
+        corpora.evict()
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # Stores load on first use; with WARM_UP set they are loaded in the background so the first queries are fast
+    tasks = []
+    if WARM_UP:
+        tasks.append(asyncio.create_task(smol_rag.warm_up()))
+    # A snapshot directory is watched for new generations published by the ingestion process
+    if SNAPSHOT_PATH and os.path.isdir(SNAPSHOT_PATH):
+        tasks.append(asyncio.create_task(watch_snapshots(smol_rag, SNAPSHOT_PATH, SNAPSHOT_POLL_INTERVAL)))
+    # Idle corpora are evicted on requests for other corpora, and otherwise here
+    if CORPORA_DIR:
+        tasks.append(asyncio.create_task(evict_corpora(max(CORPUS_IDLE_SECONDS / 10, 1))))
+    yield
+    for task in tasks:
+        task.cancel()
+    await ingestion_jobs.shutdown()
+
+
+app = FastAPI(title="Salable Docs RAG API", lifespan=lifespan)
+
+
+class QueryFilter(BaseModel):
+    doc_ids: Optional[List[str]] = None
+    source_prefix: Optional[str] = None
+    inserted_after: Optional[float] = None
+    inserted_before: Optional[float] = None
 
 
 class QueryRequest(BaseModel):
     text: str
     query_type: Optional[str] = "standard"
+    filter: Optional[QueryFilter] = None
+    corpus: Optional[str] = None
 
 
 class QueryResponse(BaseModel):
     result: str
 
 
+class BatchQueryRequest(BaseModel):
+    texts: List[str]
+    query_type: Optional[str] = "standard"
+    filter: Optional[QueryFilter] = None
+    corpus: Optional[str] = None
+    max_concurrency: int = 8
+
+
+class BatchQueryResult(BaseModel):
+    result: Optional[str] = None
+    error: Optional[str] = None
+
+
+class BatchQueryResponse(BaseModel):
+    results: List[BatchQueryResult]
+
+
+class ContextRequest(QueryRequest):
+    local_keywords: bool = False
+
+
+class IngestRequest(BaseModel):
+    paths: Optional[List[str]] = None
+    corpus: Optional[str] = None
+
+
+class IngestionJobResponse(BaseModel):
+    id: str
+    paths: Optional[List[str]] = None
+    corpus: Optional[str] = None
+    status: str
+    error: Optional[str] = None
+    documents_total: int
+    documents_skipped: int
+    documents_done: int
+    failed_paths: List[str]
+    excerpts_done: int
+    tokens: int
+    eta_seconds: Optional[float] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+
+class ContextResponse(BaseModel):
+    query_type: str
+    data: Dict[str, Any]
+    context: str
+    system_prompt: str
+    top_score: Optional[float] = None
+    timings: Dict[str, Any]
+
+
+class CorpusResponse(BaseModel):
+    loaded: bool
+    size: int
+    last_used: Optional[float] = None
+
+
+# SmolRag method names, looked up on the corpus each request selects
 query_map = {
-    "standard": smol_rag.query,
-    "hybrid_kg": smol_rag.hybrid_kg_query,
-    "local_kg": smol_rag.local_kg_query,
-    "global_kg": smol_rag.global_kg_query,
-    "mix": smol_rag.mix_query,
+    "standard": "query",
+    "hybrid": "hybrid_query",
+    "hybrid_kg": "hybrid_kg_query",
+    "local_kg": "local_kg_query",
+    "global_kg": "global_kg_query",
+    "mix": "mix_query",
+    "community": "community_query",
+}
+
+
+stream_map = {
+    "standard": "query_stream",
+    "hybrid": "hybrid_query_stream",
+    "hybrid_kg": "hybrid_kg_query_stream",
+    "local_kg": "local_kg_query_stream",
+    "global_kg": "global_kg_query_stream",
+    "mix": "mix_query_stream",
+    "community": "community_query_stream",
 }
 
 
-def get_query_function(request: QueryRequest) -> Callable:
-    """Validate the query request and return the appropriate query function."""
+def get_corpus(name: Optional[str]) -> SmolRag:
+    """Return the SmolRag of the named corpus, loading it if needed, or the default corpus without a name."""
+    if name is None:
+        return smol_rag
+    try:
+        return corpora.get(name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown corpus: {name}")
+
+
+def get_query_function(request: QueryRequest, functions: dict = query_map) -> Callable:
+    """Validate the query request and return the appropriate query function of the requested corpus."""
     if not request.text.strip():
         raise HTTPException(status_code=400, detail="Query text cannot be empty")
 
-    query_func = query_map.get(request.query_type.lower(), None)
+    method_name = functions.get(request.query_type.lower(), None)
 
-    if not query_func:
+    if not method_name:
         raise HTTPException(
             status_code=400,
-            detail=f"Invalid query_type: {request.query_type}. Valid types are: {', '.join(query_map.keys())}"
+            detail=f"Invalid query_type: {request.query_type}. Valid types are: {', '.join(functions.keys())}"
         )
 
-    return query_func
+    if request.filter is not None and request.query_type.lower() not in FILTERABLE_QUERY_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"filter is only supported for {' and '.join(FILTERABLE_QUERY_TYPES)} queries"
+        )
+
+    return getattr(get_corpus(request.corpus), method_name)
+
+
+def get_filter_kwargs(request) -> dict:
+    """Keyword arguments passing the request's filter on to SmolRag, empty without one."""
+    if request.filter is None:
+        return {}
+    return {"filter": request.filter.model_dump(exclude_none=True)}
+
+
+def format_sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def resolve_ingest_paths(paths: Optional[List[str]], input_docs_dir: str = INPUT_DOCS_DIR) -> Optional[List[str]]:
+    """Resolve paths relative to the input docs directory, rejecting any that are missing or outside of it."""
+    if paths is None:
+        return None
+    if not paths:
+        raise HTTPException(status_code=400, detail="paths must not be empty, omit it to ingest every document")
+    real_input_docs_dir = os.path.realpath(input_docs_dir)
+    resolved = []
+    for path in paths:
+        full_path = os.path.normpath(os.path.join(input_docs_dir, path))
+        if os.path.commonpath([os.path.realpath(full_path), real_input_docs_dir]) != real_input_docs_dir:
+            raise HTTPException(status_code=400, detail=f"Path is outside of the input docs directory: {path}")
+        if not os.path.exists(full_path):
+            raise HTTPException(status_code=400, detail=f"Path does not exist: {path}")
+        resolved.append(full_path)
+    return resolved
+
+
+def get_ingestion_job(job_id: str):
+    job = ingestion_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No ingestion job with id {job_id}")
+    return job
 
 
 @app.post("/query", response_model=QueryResponse)
 async def query_endpoint(request: QueryRequest):
     """
     Process a query using SmolRag.
-    Query types: standard, hybrid_kg, local_kg, global_kg, mix
+    Standard and hybrid queries accept a filter restricting the search to excerpts of matching documents: doc_ids,
+    source_prefix (a path prefix relative to the input docs directory) and inserted_after / inserted_before Unix
+    timestamps, combined with AND.
+    Set corpus to query another corpus than the default one.
+    Query types: standard, hybrid, hybrid_kg, local_kg, global_kg, mix, community
     """
     try:
         query_func = get_query_function(request)
 
-        result = await query_func(request.text)
+        result = await query_func(request.text, **get_filter_kwargs(request))
         return QueryResponse(result=result)
 
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/query/batch", response_model=BatchQueryResponse)
+async def query_batch_endpoint(request: BatchQueryRequest):
+    """
+    Process a batch of queries using SmolRag. Standard queries share one embedding call, one vector search and one
+    excerpt fetch, and completions run with at most max_concurrency in flight.
+    Results are returned in the order of texts, each with either a result or an error.
+    Query types: standard, hybrid, hybrid_kg, local_kg, global_kg, mix, community
+    """
+    if not request.texts:
+        raise HTTPException(status_code=400, detail="Batch must contain at least one query")
+    for text in request.texts:
+        get_query_function(QueryRequest(text=text, query_type=request.query_type, filter=request.filter,
+                                        corpus=request.corpus))
+    if request.max_concurrency < 1:
+        raise HTTPException(status_code=400, detail="max_concurrency must be at least 1")
+
+    try:
+        results = await get_corpus(request.corpus).query_many(
+            request.texts,
+            query_type=request.query_type.lower(),
+            max_concurrency=request.max_concurrency,
+            **get_filter_kwargs(request)
+        )
+        return BatchQueryResponse(results=[BatchQueryResult(**result) for result in results])
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/context", response_model=ContextResponse)
+async def context_endpoint(request: ContextRequest):
+    """
+    Retrieve the context SmolRag would answer a query from, without calling the completion model.
+    Returns the retrieved excerpts, entities, relationships or community reports as structured data alongside the
+    rendered context section and the full system prompt. Set local_keywords to extract the knowledge graph keywords
+    locally instead of with the LLM.
+    Query types: standard, hybrid, hybrid_kg, local_kg, global_kg, mix, community
+    """
+    try:
+        get_query_function(request)
+
+        result = await get_corpus(request.corpus).get_context(
+            request.text,
+            query_type=request.query_type.lower(),
+            local_keywords=request.local_keywords,
+            **get_filter_kwargs(request)
+        )
+        return ContextResponse(**result)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/query/stream")
+async def query_stream_endpoint(request: QueryRequest):
+    """
+    Process a query using SmolRag and stream the answer as server-sent events.
+    A "timings" event with the retrieval timings is sent first, followed by a "token" event per chunk of the answer
+    and a final "done" event with the full timings. Failures are reported as an "error" event.
+    Query types: standard, hybrid, hybrid_kg, local_kg, global_kg, mix, community
+    """
+    stream_func = get_query_function(request, stream_map)
+
+    async def events():
+        timings = Timings()
+        try:
+            tokens = await stream_func(request.text, timings=timings, **get_filter_kwargs(request))
+            yield format_sse("timings", timings.to_dict())
+            async for token in tokens:
+                yield format_sse("token", token)
+            yield format_sse("done", timings.to_dict())
+        except Exception as e:
+            logger.error(f"Streaming query failed: {e}")
+            yield format_sse("error", {"detail": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def submit_ingestion_job(paths: Optional[List[str]], corpus_name: Optional[str]):
+    """Queue an ingestion job into the named corpus, refusing unknown corpora, read-only snapshots and bad paths."""
+    corpus = get_corpus(corpus_name)
+    if corpus.snapshot is not None:
+        raise HTTPException(status_code=409, detail="The API is serving a read-only snapshot, ingestion is disabled")
+    return ingestion_jobs.submit(resolve_ingest_paths(paths, corpus.input_docs_dir), corpus_name)
+
+
+@app.post("/ingest", response_model=IngestionJobResponse, status_code=202)
+async def ingest_endpoint(request: IngestRequest):
+    """
+    Queue a background ingestion job for the given paths, relative to the input docs directory, or for every document
+    when paths is omitted. Jobs run one at a time into a staging index that replaces the live one once the job has
+    completed, so queries are served throughout. Finished documents are checkpointed, so a run that crashed or was
+    cancelled resumes where it stopped when queued again.
+    """
+    job = submit_ingestion_job(request.paths, request.corpus)
+    return IngestionJobResponse(**job.to_dict())
+
+
+@app.get("/ingest", response_model=List[IngestionJobResponse])
+async def ingest_list_endpoint():
+    """List the queued, running and recently finished ingestion jobs, oldest first."""
+    return [IngestionJobResponse(**job.to_dict()) for job in ingestion_jobs.jobs.values()]
+
+
+@app.get("/ingest/{job_id}", response_model=IngestionJobResponse)
+async def ingest_status_endpoint(job_id: str):
+    """
+    Return the progress of an ingestion job: documents and excerpts processed, estimated tokens spent and the
+    estimated seconds left.
+    """
+    return IngestionJobResponse(**get_ingestion_job(job_id).to_dict())
+
+
+@app.get("/ingest/{job_id}/events")
+async def ingest_events_endpoint(job_id: str):
+    """
+    Stream the progress of an ingestion job as server-sent events. A "progress" event is sent whenever it changes and
+    at least every second while the job runs, followed by a final "completed", "failed" or "cancelled" event.
+    """
+    job = get_ingestion_job(job_id)
+
+    async def events():
+        async for state in job.watch():
+            yield format_sse(state["status"] if state["status"] in FINISHED_STATUSES else "progress", state)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.delete("/ingest/{job_id}", response_model=IngestionJobResponse)
+async def ingest_cancel_endpoint(job_id: str):
+    """
+    Cancel a queued or running ingestion job. The live index is left as it was, and documents the job had finished
+    stay checkpointed for the next run.
+    """
+    get_ingestion_job(job_id)
+    return IngestionJobResponse(**(await ingestion_jobs.cancel(job_id)).to_dict())
+
+
+@app.get("/corpora", response_model=Dict[str, CorpusResponse])
+async def corpora_endpoint():
+    """
+    List the corpora requests can select, with whether each is loaded and the estimated bytes of its loaded stores.
+    Corpora other than the default one are loaded on first use and evicted when idle or over the memory budget.
+    """
+    return {name: CorpusResponse(**status) for name, status in corpora.get_status().items()}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """
+    Return the process-wide counters and gauges, such as single-flight dedup hits for queries, completions and
+    embeddings.
+    """
+    return metrics.snapshot()
+
+
+@app.get("/ready")
+async def ready_endpoint():
+    """
+    Report which stores have been loaded. With WARM_UP set the API is ready once every store is loaded and responds
+    with 503 until then; otherwise stores are loaded on first use and the API is always ready.
+    """
+    stores = smol_rag.get_store_status()
+    ready = not WARM_UP or all(stores.values())
+    return JSONResponse({"ready": ready, "stores": stores}, status_code=200 if ready else 503)
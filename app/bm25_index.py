@@ -0,0 +1,198 @@
+import asyncio
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+
+from app.keyword_extractor import STOP_WORDS
+from app.logger import logger
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9_][a-z0-9_\-./:]*[a-z0-9_]|[a-z0-9_]")
+PART_SEPARATOR_PATTERN = re.compile(r"[\-./:_]+")
+
+
+def tokenize(text):
+    """
+    Splits text into BM25 terms. Identifiers such as "/api/v2/plans", "plan_uuid" or "salable-checkout" are kept as a
+    single term, so exact matches score highly, and are also split into their parts.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        parts = [part for part in PART_SEPARATOR_PATTERN.split(token) if part]
+        if len(parts) > 1:
+            terms.append(token)
+        terms.extend(part for part in parts if part not in STOP_WORDS)
+    return terms
+
+
+class Bm25Index:
+    """
+    In-memory inverted index scoring documents with Okapi BM25. With a file_path, the term counts of every document are
+    saved there, so a restarted process loads the index instead of tokenizing the whole corpus again.
+    """
+
+    def __init__(self, file_path=None, k1=1.5, b=0.75):
+        self.file_path = file_path
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)
+        self.doc_lengths = {}
+        self.doc_terms = {}
+        self.total_length = 0
+        self.is_built = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_loaded(self):
+        return self.is_built
+
+    async def load(self):
+        """
+        Builds the index from the term counts saved to file_path.
+
+        :return: Whether a saved index was found.
+        """
+        if self.file_path is None or not os.path.exists(self.file_path):
+            return False
+        await self.build_from_term_counts(await asyncio.to_thread(self._read))
+        return True
+
+    def _read(self):
+        with open(self.file_path) as f:
+            return json.load(f)
+
+    def copy(self, file_path=None):
+        """Returns an independent copy saving to file_path, by default the same file, e.g. for staging."""
+        index = Bm25Index(file_path or self.file_path, self.k1, self.b)
+        index.postings = defaultdict(dict, {term: dict(postings) for term, postings in self.postings.items()})
+        index.doc_lengths = dict(self.doc_lengths)
+        index.doc_terms = dict(self.doc_terms)
+        index.total_length = self.total_length
+        index.is_built = self.is_built
+        return index
+
+    def reopen(self, file_path):
+        """Returns a new index over another file, loaded on first use, e.g. to resume a staging generation."""
+        return Bm25Index(file_path, self.k1, self.b)
+
+    def move(self, file_path):
+        """Replaces file_path with the saved file of this index, which saves there from now on."""
+        os.replace(self.file_path, file_path)
+        self.file_path = file_path
+
+    async def save(self):
+        # An index that hasn't been built only holds the documents added since, saving it would lose the others
+        if self.file_path is None or not self.is_built:
+            return
+        # Written to a temporary file first, so a crash mid-write never leaves a truncated index
+        async with self._lock:
+            tmp_path = f"{self.file_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._get_term_counts(), f)
+            os.replace(tmp_path, self.file_path)
+
+    async def build(self, items):
+        """
+        Indexes a full corpus and marks the index as built. Documents added with add_many before the build are kept.
+
+        :param items: Dict of document id to text.
+        """
+        async with self._lock:
+            for doc_id, text in items.items():
+                self._remove(doc_id)
+                self._add(doc_id, text)
+            self.is_built = True
+        logger.info(f"BM25 index built with {len(self.doc_lengths)} documents and {len(self.postings)} terms")
+
+    async def add_many(self, items):
+        """
+        :param items: Dict of document id to text, existing documents are replaced.
+        """
+        async with self._lock:
+            for doc_id, text in items.items():
+                self._remove(doc_id)
+                self._add(doc_id, text)
+
+    async def remove_many(self, doc_ids):
+        async with self._lock:
+            for doc_id in doc_ids:
+                self._remove(doc_id)
+
+    async def query(self, text, top_k=10, ids=None):
+        """
+        :param text: The query text.
+        :param top_k: Number of results to return.
+        :param ids: Optional set of document ids, only these documents are scored.
+        :return: List of {"__id__", "__metrics__"} dicts, best match first.
+        """
+        async with self._lock:
+            if not self.doc_lengths:
+                return []
+            doc_count = len(self.doc_lengths)
+            average_length = self.total_length / doc_count
+            scores = defaultdict(float)
+            for term in dict.fromkeys(tokenize(text)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                if ids is not None and len(ids) < len(postings):
+                    # A narrow filter looks up its own documents instead of walking the whole posting list
+                    postings = {doc_id: postings[doc_id] for doc_id in ids if doc_id in postings}
+                elif ids is not None:
+                    postings = {doc_id: count for doc_id, count in postings.items() if doc_id in ids}
+                for doc_id, term_frequency in postings.items():
+                    length_norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / average_length
+                    scores[doc_id] += idf * term_frequency * (self.k1 + 1) / (term_frequency + self.k1 * length_norm)
+
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [{"__id__": doc_id, "__metrics__": score} for doc_id, score in top]
+
+    async def build_from_term_counts(self, term_counts):
+        """
+        Indexes a corpus from precomputed term counts, such as those stored in a snapshot, without tokenizing it again.
+
+        :param term_counts: Dict of document id to a dict of term to count.
+        """
+        async with self._lock:
+            for doc_id, counts in term_counts.items():
+                self._remove(doc_id)
+                self._add_term_counts(doc_id, counts)
+            self.is_built = True
+        logger.info(f"BM25 index loaded with {len(self.doc_lengths)} documents and {len(self.postings)} terms")
+
+    async def get_term_counts(self):
+        """
+        :return: Dict of document id to a dict of term to count.
+        """
+        async with self._lock:
+            return self._get_term_counts()
+
+    def _get_term_counts(self):
+        return {
+            doc_id: {term: self.postings[term][doc_id] for term in terms} for doc_id, terms in self.doc_terms.items()
+        }
+
+    def _add(self, doc_id, text):
+        self._add_term_counts(doc_id, Counter(tokenize(text)))
+
+    def _add_term_counts(self, doc_id, term_counts):
+        for term, count in term_counts.items():
+            self.postings[term][doc_id] = count
+        length = sum(term_counts.values())
+        self.doc_terms[doc_id] = tuple(term_counts)
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+
+    def _remove(self, doc_id):
+        if doc_id not in self.doc_lengths:
+            return
+        for term in self.doc_terms.pop(doc_id):
+            del self.postings[term][doc_id]
+            if not self.postings[term]:
+                del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(doc_id)
+
+    def __len__(self):
+        return len(self.doc_lengths)
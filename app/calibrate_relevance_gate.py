@@ -0,0 +1,84 @@
+import asyncio
+import json
+import sys
+
+import numpy as np
+
+from app.definitions import EVALUATION_DATA_SET
+from app.smol_rag import SmolRag
+from app.utilities import get_json
+
+OFF_TOPIC_QUERIES = [
+    "what do jellyfish eat?",
+    "what do cats eat?",
+    "what do cows eat?",
+    "what do ducks eat?",
+    "what do frogs eat?",
+    "Who won the 1966 World Cup?",
+    "How do I bake sourdough bread?",
+    "What is the capital of Australia?",
+    "How far away is the moon?",
+    "Can you recommend a good science fiction novel?",
+]
+# Query types checked against the threshold before keyword extraction, so a query only passes if both that check and
+# its full context clear it: the knowledge graph queries score the query against their entities and/or relationships,
+# by the low and high level flags, and mix against the excerpts
+GRAPH_GATED_QUERY_TYPES = {"local_kg": (True, False), "global_kg": (False, True), "hybrid_kg": (True, True)}
+EXCERPT_GATED_QUERY_TYPES = ("mix",)
+
+
+def calibrate_relevance_threshold(in_domain_scores, off_topic_scores, target_recall=0.98):
+    """
+    Picks the highest threshold that still lets target_recall of the in-domain queries through.
+
+    :param in_domain_scores: Top similarity scores of queries that should be answered.
+    :param off_topic_scores: Top similarity scores of queries that should be rejected.
+    :param target_recall: Fraction of in-domain queries that must pass the gate.
+    :return: A dict with the threshold, the in-domain pass rate and the off-topic rejection rate.
+    """
+    in_domain_scores = np.array([score if score is not None else 0.0 for score in in_domain_scores])
+    off_topic_scores = np.array([score if score is not None else 0.0 for score in off_topic_scores])
+    must_pass = max(1, int(np.ceil(round(target_recall * len(in_domain_scores), 6))))
+    threshold = float(np.sort(in_domain_scores)[len(in_domain_scores) - must_pass])
+    return {
+        "threshold": round(threshold, 4),
+        "in_domain_pass_rate": float(np.mean(in_domain_scores >= threshold)),
+        "off_topic_rejection_rate": float(np.mean(off_topic_scores < threshold)) if len(off_topic_scores) else None,
+    }
+
+
+async def get_top_scores(smol_rag, queries, query_type, max_concurrency=8):
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def get_top_score(query):
+        async with semaphore:
+            top_score = (await smol_rag.get_context(query, query_type))["top_score"]
+            gate_score = top_score
+            if query_type in GRAPH_GATED_QUERY_TYPES and top_score is not None:
+                gate_score = await smol_rag._get_query_graph_score(query, *GRAPH_GATED_QUERY_TYPES[query_type])
+            elif query_type in EXCERPT_GATED_QUERY_TYPES and top_score is not None:
+                gate_score = (await smol_rag.get_context(query, "standard"))["top_score"]
+            top_score = min(top_score, gate_score) if gate_score is not None else None
+            return top_score
+
+    return await asyncio.gather(*(get_top_score(query) for query in queries))
+
+
+if __name__ == '__main__':
+    async def main():
+        query_types = sys.argv[1:] or ["standard", "mix"]
+        # Without a threshold, so the scores aren't cut short by the gate being calibrated
+        smol_rag = SmolRag(relevance_threshold=None)
+        in_domain_queries = [row["query"] for row in get_json(EVALUATION_DATA_SET)]
+
+        thresholds = {}
+        for query_type in query_types:
+            in_domain_scores = await get_top_scores(smol_rag, in_domain_queries, query_type)
+            off_topic_scores = await get_top_scores(smol_rag, OFF_TOPIC_QUERIES, query_type)
+            result = calibrate_relevance_threshold(in_domain_scores, off_topic_scores)
+            print(f"{query_type}: {result}")
+            thresholds[query_type] = result["threshold"]
+
+        print("relevance_threshold =", json.dumps(thresholds))
+
+    asyncio.run(main())
@@ -1,13 +1,9 @@
-from nltk import tokenize
-from nltk import sent_tokenize, download
 import re
+from typing import List, Optional
 
+# nltk is imported where it is used, it takes a quarter of a second to import and most processes never chunk anything
 # download('punkt')
 
-import re
-from typing import List, Optional
-from nltk.tokenize import sent_tokenize
-
 
 def preserve_markdown_code_excerpts(
     content: str,
@@ -40,6 +36,7 @@ def preserve_markdown_code_excerpts(
     list[str]
         Ordered list of excerpts.
     """
+    from nltk.tokenize import sent_tokenize
 
     # ---------------------------------------------------------------------
     # Internal helpers
@@ -160,6 +157,7 @@ def word_boundary_overlap_excerpts(content, n=2000, overlap=200):
     Returns:
         list of str: Excerpts that do not split words.
     """
+    from nltk import tokenize
     tokenizer = tokenize.TreebankWordTokenizer()
     token_spans = list(tokenizer.span_tokenize(content))
 
@@ -0,0 +1,60 @@
+from app.definitions import COMPLETION_MODEL
+from app.utilities import get_encoded_tokens
+
+
+class ContextAssembler:
+    """
+    Selects context items from several ranked sources under one shared token budget.
+
+    Every source is a list ordered best first. An item scores its similarity to the query divided by the best score in
+    its source, so sources whose similarities sit on different scales (e.g. excerpt and entity vectors) compete on equal
+    terms while a clearly weaker match still ranks below a strong one. Items found by several sources (e.g. an excerpt
+    returned by both the vector search and the knowledge graph) are only counted once, with their scores summed, and
+    move up. Items are then taken in score order until the budget is spent.
+
+    Sources without scores fall back to 1 / (k + rank), normalised the same way.
+    """
+
+    def __init__(self, max_tokens, k=60, model=COMPLETION_MODEL):
+        self.max_tokens = max_tokens
+        self.k = k
+        self.model = model
+        self.items = {}
+
+    def add_source(self, kind, rows, get_key, get_text, get_score=None):
+        """
+        :param kind: The section the rows belong to, e.g. "excerpts" or "entities".
+        :param rows: The rows, best first.
+        :param get_key: Returns the identity of a row, rows with the same kind and key are merged.
+        :param get_text: Returns the text of a row that will be rendered into the prompt.
+        :param get_score: Returns the similarity of a row to the query, higher is better.
+        """
+        if get_score is None:
+            scores = [1 / (self.k + rank) for rank in range(1, len(rows) + 1)]
+        else:
+            scores = [get_score(row) for row in rows]
+        best = max(scores, default=0)
+        for row, score in zip(rows, scores):
+            score = score / best if best > 0 else 0
+            key = (kind, get_key(row))
+            if key in self.items:
+                self.items[key]["score"] += score
+            else:
+                self.items[key] = {"kind": kind, "row": row, "score": score, "get_text": get_text}
+
+    def select(self):
+        """
+        :return: Dict of kind to the selected rows, best first, and the number of tokens used.
+        """
+        selected = {}
+        used_tokens = 0
+        for item in sorted(self.items.values(), key=lambda item: item["score"], reverse=True):
+            selected.setdefault(item["kind"], [])
+            if used_tokens >= self.max_tokens:
+                continue
+            tokens = len(get_encoded_tokens(item["get_text"](item["row"]), self.model))
+            if used_tokens + tokens > self.max_tokens:
+                continue
+            used_tokens += tokens
+            selected[item["kind"]].append(item["row"])
+        return selected, used_tokens
@@ -0,0 +1,126 @@
+import os
+import time
+from collections import OrderedDict
+
+from app.definitions import LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, CORPUS_MEMORY_BUDGET_MB, \
+    CORPUS_IDLE_SECONDS
+from app.llm_backend import create_llm_backend
+from app.llm_scheduler import LlmScheduler
+from app.logger import logger
+from app.metrics import metrics
+from app.smol_rag import SmolRag
+
+DEFAULT_CORPUS = "default"
+
+
+class CorpusRegistry:
+    """
+    Serves several corpora from one process. Each corpus is a SmolRag with its own stores, created on first use and
+    dropped again once it has been idle for idle_seconds, or least recently used first while the loaded corpora are
+    over the memory budget. Every corpus shares one LLM client, and with it the HTTP connection pool and the query and
+    embedding caches, and one LlmScheduler, so the rate limits hold for the process as a whole.
+    """
+
+    def __init__(self, llm=None, llm_scheduler=None, memory_budget=CORPUS_MEMORY_BUDGET_MB * 1024 * 1024,
+                 idle_seconds=CORPUS_IDLE_SECONDS):
+        """
+        :param llm: The LLM backend shared by every corpus, defaults to the one selected by LLM_BACKEND.
+        :param llm_scheduler: The scheduler shared by every corpus.
+        :param memory_budget: Bytes of loaded stores to keep, estimated from the size of their files.
+        :param idle_seconds: Seconds after its last use a corpus is evicted, even when under the memory budget.
+        """
+        self.llm = llm or create_llm_backend()
+        self.llm_scheduler = llm_scheduler or LlmScheduler(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+        self.memory_budget = memory_budget
+        self.idle_seconds = idle_seconds
+        self.corpora = {}
+        self.loaded = OrderedDict()
+        self.last_used = {}
+        self.resident = set()
+
+    def register(self, name, smol_rag=None, **kwargs):
+        """
+        :param name: The name requests select the corpus by.
+        :param smol_rag: An existing instance to serve, it stays loaded for the life of the registry.
+        :param kwargs: SmolRag arguments the corpus is created with on first use, e.g. data_dir and input_docs_dir.
+        """
+        self.corpora[name] = kwargs
+        if smol_rag is not None:
+            self.resident.add(name)
+            self.loaded[name] = smol_rag
+            self.last_used[name] = time.time()
+            self._publish_loaded()
+
+    def register_dir(self, corpora_dir, **kwargs):
+        """
+        Registers every subdirectory of corpora_dir as a corpus named after it, keeping its stores in <name>/data and
+        reading its documents from <name>/input_docs.
+
+        :param kwargs: Other SmolRag arguments every corpus is created with.
+        """
+        for name in sorted(os.listdir(corpora_dir)):
+            path = os.path.join(corpora_dir, name)
+            if os.path.isdir(path) and name not in self.corpora:
+                self.register(
+                    name,
+                    data_dir=os.path.join(path, "data"),
+                    input_docs_dir=os.path.join(path, "input_docs"),
+                    **kwargs
+                )
+
+    def get(self, name):
+        """
+        :return: The SmolRag of the corpus, created if it is not loaded.
+        :raises KeyError: If no corpus is registered with that name.
+        """
+        if name not in self.corpora:
+            raise KeyError(f"Unknown corpus: {name}")
+        smol_rag = self.loaded.get(name)
+        if smol_rag is None:
+            smol_rag = SmolRag(llm=self.llm, llm_scheduler=self.llm_scheduler, **self.corpora[name])
+            self.loaded[name] = smol_rag
+            metrics.increment("corpora.created")
+            logger.info(f"Created corpus {name}")
+        self.loaded.move_to_end(name)
+        self.last_used[name] = time.time()
+        self.evict(keep=name)
+        return smol_rag
+
+    def evict(self, keep=None):
+        """
+        Drops the idle corpora, then the least recently used ones until the rest fit in the memory budget. Resident
+        corpora and those with a query or ingestion run in progress are never dropped.
+
+        :param keep: A corpus to leave loaded regardless, e.g. the one just requested.
+        :return: The names of the evicted corpora.
+        """
+        now = time.time()
+        sizes = {name: smol_rag.get_loaded_size() for name, smol_rag in self.loaded.items()}
+        total = sum(sizes.values())
+        evicted = []
+        for name, smol_rag in list(self.loaded.items()):
+            if name == keep or name in self.resident or smol_rag.is_busy:
+                continue
+            if now - self.last_used[name] > self.idle_seconds or total > self.memory_budget:
+                # Sharded vector stores would otherwise keep their worker processes, and their memory, running
+                self.loaded.pop(name).close()
+                total -= sizes[name]
+                evicted.append(name)
+                metrics.increment("corpora.evicted")
+                logger.info(f"Evicted corpus {name}, {sizes[name] / 1024 / 1024:.1f}MB")
+        self._publish_loaded()
+        return evicted
+
+    def get_status(self):
+        """:return: Dict of corpus name to whether it is loaded and the estimated bytes of its loaded stores."""
+        return {
+            name: {
+                "loaded": name in self.loaded,
+                "size": self.loaded[name].get_loaded_size() if name in self.loaded else 0,
+                "last_used": self.last_used.get(name),
+            }
+            for name in self.corpora
+        }
+
+    def _publish_loaded(self):
+        metrics.set_gauge("corpora.loaded", len(self.loaded))
@@ -3,6 +3,24 @@ import os
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 COMPLETION_MODEL = os.getenv('COMPLETION_MODEL', 'gpt-4o-mini')
 EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small')
+# openai, or local for the in-process hashed n-gram embedder and stub completer that need no network
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'openai')
+# Minimum top similarity score for a query to be answered, unset disables the relevance gate
+RELEVANCE_THRESHOLD = float(os.getenv('RELEVANCE_THRESHOLD')) if os.getenv('RELEVANCE_THRESHOLD') else None
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', 6000))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', 2000000))
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH')
+SNAPSHOT_POLL_INTERVAL = float(os.getenv('SNAPSHOT_POLL_INTERVAL', 5))
+WARM_UP = os.getenv('WARM_UP', 'false').lower() in ('1', 'true', 'yes')
+# Directory of corpora served alongside the default one, each subdirectory has its own data and input_docs
+CORPORA_DIR = os.getenv('CORPORA_DIR')
+CORPUS_MEMORY_BUDGET_MB = float(os.getenv('CORPUS_MEMORY_BUDGET_MB', 1024))
+CORPUS_IDLE_SECONDS = float(os.getenv('CORPUS_IDLE_SECONDS', 600))
+# Worker processes the excerpt, entity and relationship vectors are sharded across, 0 keeps them in process
+VECTOR_SHARDS = int(os.getenv('VECTOR_SHARDS', 0))
+# Leading dimensions of the first pass of two-stage vector search, unset scans every vector at full dimension
+COARSE_DIMENSIONS = int(os.getenv('COARSE_DIMENSIONS')) if os.getenv('COARSE_DIMENSIONS') else None
+COARSE_CANDIDATES = int(os.getenv('COARSE_CANDIDATES', 100))
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(ROOT_DIR, "data")
@@ -19,6 +37,11 @@ EXCERPT_KV_PATH = os.path.join(DATA_DIR, "excerpt_db.json")
 EMBEDDINGS_DB = os.path.join(DATA_DIR, "embeddings_db.json")
 ENTITIES_DB = os.path.join(DATA_DIR, "entities_db.json")
 RELATIONSHIPS_DB = os.path.join(DATA_DIR, "relationships_db.json")
+COMMUNITIES_DB = os.path.join(DATA_DIR, "communities_db.json")
+COMMUNITY_KV_PATH = os.path.join(DATA_DIR, "community_db.json")
+ENTITY_ALIAS_KV_PATH = os.path.join(DATA_DIR, "entity_aliases.json")
+CONSOLIDATION_KV_PATH = os.path.join(DATA_DIR, "consolidated_descriptions.json")
+BM25_INDEX_PATH = os.path.join(DATA_DIR, "bm25_index.json")
 
 KG_DB = os.path.join(DATA_DIR, "kg_db.graphml")
 
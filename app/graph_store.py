@@ -1,23 +1,60 @@
+import asyncio
 import os
+import threading
 
-import networkx as nx
-
+from app.definitions import KG_SEP
 from app.logger import logger
+from app.utilities import split_string_by_multi_markers
 
 
 class NetworkXGraphStore:
     def __init__(self, file_path):
         self.file_path = file_path
-        if os.path.exists(file_path):
-            try:
-                self.graph = nx.read_graphml(file_path)
-                logger.info(f"Knowledge graph loaded from {file_path}")
-            except Exception as e:
-                logger.error(f"Error loading knowledge graph from {file_path}: {e}")
-                self.graph = nx.Graph()
-        else:
-            self.graph = nx.Graph()
-            logger.info("No existing knowledge graph found; creating a new one.")
+        self._graph = None
+        self._load_lock = threading.Lock()
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._graph is not None
+
+    @property
+    def graph(self):
+        if self._graph is None:
+            self.load()
+        return self._graph
+
+    def load(self):
+        """Reads the graph from disk. Called on first use, or from a worker thread to warm the store up."""
+        with self._load_lock:
+            if self._graph is not None:
+                return
+            import networkx as nx
+            if os.path.exists(self.file_path):
+                try:
+                    self._graph = nx.read_graphml(self.file_path)
+                    logger.info(f"Knowledge graph loaded from {self.file_path}")
+                except Exception as e:
+                    logger.error(f"Error loading knowledge graph from {self.file_path}: {e}")
+                    self._graph = nx.Graph()
+            else:
+                self._graph = nx.Graph()
+                logger.info("No existing knowledge graph found; creating a new one.")
+
+    def copy(self, file_path=None):
+        """Returns an independent in-memory copy saving to file_path, by default the same file, e.g. for staging."""
+        store = NetworkXGraphStore(file_path or self.file_path)
+        store._graph = self.graph.copy()
+        return store
+
+    def reopen(self, file_path):
+        """Returns a new store over another file, read on first use, e.g. to resume a staging generation."""
+        return NetworkXGraphStore(file_path)
+
+    def move(self, file_path):
+        """Replaces file_path with the saved file of this store, which saves there from now on."""
+        os.replace(self.file_path, file_path)
+        self.file_path = file_path
 
     def get_node(self, name):
         logger.info(f"Getting node {name}")
@@ -27,23 +64,99 @@ class NetworkXGraphStore:
         logger.info(f"Getting edge {edge}")
         return self.graph.edges.get(edge)
 
+    def get_nodes(self):
+        return list(self.graph.nodes(data=True))
+
+    def get_edges(self):
+        return list(self.graph.edges(data=True))
+
     def get_node_edges(self, name):
         return self.graph.edges(name)
 
-    def add_node(self, name, **kwargs):
-        logger.info(f"Adding node {name}")
-        self.graph.add_node(name, **kwargs)
+    async def merge_batch(self, entities=(), relationships=()):
+        """
+        Merges extracted entities and relationships into the graph as a single write.
+
+        Descriptions, categories, keywords and excerpt ids are appended to the existing values with KG_SEP,
+        relationship weights are summed.
+
+        :param entities: List of (name, {"category", "description", "excerpt_id"}) pairs.
+        :param relationships: List of ((source, target), {"description", "keywords", "weight", "excerpt_id"})
+            pairs.
+        """
+        async with self._lock:
+            for name, data in entities:
+                existing_node = self.graph.nodes.get(name)
+                if existing_node:
+                    data = {field: self._merge_values(existing_node.get(field), value) for field, value in data.items()}
+                self.graph.add_node(name, **data)
+            for (source, target), data in relationships:
+                existing_edge = self.graph.edges.get((source, target))
+                if existing_edge:
+                    data = {
+                        field: existing_edge.get(field, 0) + value if field == "weight"
+                        else self._merge_values(existing_edge.get(field), value)
+                        for field, value in data.items()
+                    }
+                self.graph.add_edge(source, target, **data)
+        logger.info(f"Merged {len(entities)} entities and {len(relationships)} relationships into the graph")
+
+    async def update_batch(self, entities=(), relationships=()):
+        """
+        Overwrites attributes on existing nodes and edges as a single write. Items that no longer exist are skipped.
+
+        :param entities: List of (name, attributes) pairs.
+        :param relationships: List of ((source, target), attributes) pairs.
+        """
+        async with self._lock:
+            for name, data in entities:
+                if name in self.graph:
+                    self.graph.add_node(name, **data)
+            for (source, target), data in relationships:
+                if self.graph.has_edge(source, target):
+                    self.graph.add_edge(source, target, **data)
 
-    def add_edge(self, source, destination, **kwargs):
-        logger.info(f"Adding edge {(source, destination)}")
-        self.graph.add_edge(source, destination, **kwargs)
+    async def remove_node(self, name):
+        async with self._lock:
+            logger.info(f"Removing node {name}")
+            self.graph.remove_node(name)
+
+    @staticmethod
+    def _merge_values(existing, value):
+        if not existing:
+            return value
+        values = split_string_by_multi_markers(existing, [KG_SEP]) + split_string_by_multi_markers(value, [KG_SEP])
+        return KG_SEP.join(dict.fromkeys(values))
 
     def degree(self, name):
         return self.graph.degree(name)
 
-    def set_field(self, key, value):
-        self.graph.graph[key] = value
+    def get_communities(self, resolution=1.0, seed=42):
+        import networkx as nx
+        communities = nx.community.louvain_communities(self.graph, weight="weight", resolution=resolution, seed=seed)
+        logger.info(f"Detected {len(communities)} communities")
+        return [sorted(community) for community in communities]
+
+    def get_community_edges(self, names):
+        return list(self.graph.subgraph(names).edges(data=True))
+
+    async def set_field(self, key, value):
+        async with self._lock:
+            self.graph.graph[key] = value
         logger.info(f"Graph metadata '{key}' updated to: {value}")
 
-    def save(self):
-        nx.write_graphml(self.graph, self.file_path)
\ No newline at end of file
+    async def get_all(self):
+        """
+        :return: The nodes and edges with their data, and the graph level attributes.
+        """
+        async with self._lock:
+            return self.get_nodes(), self.get_edges(), dict(self.graph.graph)
+
+    async def save(self):
+        import networkx as nx
+        # Written to a temporary file first, so a crash mid-write never leaves a truncated graph
+        async with self._lock:
+            tmp_path = f"{self.file_path}.tmp"
+            # Serialised in a thread so a large graph doesn't hold up queries, writes wait for the lock meanwhile
+            await asyncio.to_thread(nx.write_graphml, self.graph, tmp_path)
+            os.replace(tmp_path, self.file_path)
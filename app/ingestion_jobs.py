@@ -0,0 +1,212 @@
+import asyncio
+import contextvars
+import time
+import uuid
+from collections import OrderedDict
+
+from app.logger import logger
+from app.metrics import metrics
+
+# The progress of the ingestion job the current import belongs to, if any
+ingestion_progress = contextvars.ContextVar("ingestion_progress", default=None)
+
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+
+
+class IngestionJob:
+    """
+    An ingestion run queued on IngestionJobs. Progress is updated by SmolRag.import_documents through the
+    ingestion_progress context variable; tokens are the estimated prompt tokens of the LLM calls made.
+    """
+
+    def __init__(self, paths=None, corpus=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.paths = paths
+        self.corpus = corpus
+        self.status = "queued"
+        self.error = None
+        self.documents_total = 0
+        self.documents_skipped = 0
+        self.documents_done = 0
+        self.failed_paths = []
+        self.excerpts_done = 0
+        self.tokens = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.task = None
+        self._updated = asyncio.Event()
+
+    @property
+    def is_finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def get_eta(self):
+        """Seconds left, extrapolated from the documents finished so far."""
+        if self.status != "running" or not self.documents_done:
+            return None
+        elapsed = time.time() - self.started_at
+        return elapsed / self.documents_done * (self.documents_total - self.documents_done - len(self.failed_paths))
+
+    def start(self, documents_total, documents_skipped):
+        self.documents_total = documents_total
+        self.documents_skipped = documents_skipped
+        self.notify()
+
+    def add_excerpts(self, count):
+        self.excerpts_done += count
+        self.notify()
+
+    def add_tokens(self, tokens):
+        self.tokens += tokens
+
+    def finish_document(self):
+        self.documents_done += 1
+        self.notify()
+
+    def fail_document(self, path):
+        self.failed_paths.append(path)
+        self.notify()
+
+    def set_status(self, status, error=None):
+        self.status = status
+        self.error = error
+        if status == "running":
+            self.started_at = time.time()
+        elif self.is_finished:
+            self.finished_at = time.time()
+        metrics.increment(f"ingestion.jobs.{status}")
+        self.notify()
+
+    def notify(self):
+        # Wakes every watcher, each new wait gets a fresh event
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def watch(self, interval=1.0):
+        """
+        Yields the job state whenever it changes, at least every interval seconds while it runs so token counts and
+        the ETA stay current, and a final time once it has finished.
+        """
+        while True:
+            yield self.to_dict()
+            if self.is_finished:
+                return
+            try:
+                await asyncio.wait_for(self._updated.wait(), interval)
+            except TimeoutError:
+                pass
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "paths": self.paths,
+            "corpus": self.corpus,
+            "status": self.status,
+            "error": self.error,
+            "documents_total": self.documents_total,
+            "documents_skipped": self.documents_skipped,
+            "documents_done": self.documents_done,
+            "failed_paths": self.failed_paths,
+            "excerpts_done": self.excerpts_done,
+            "tokens": self.tokens,
+            "eta_seconds": self.get_eta(),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionJobs:
+    """
+    Runs ingestion jobs in the background one at a time, in submission order. Each job re-indexes into a staging
+    generation with SmolRag.reindex, so queries are served from the previous index until the job completes, and a
+    cancelled or failed job leaves it untouched. Documents finished before a crash, failure or cancellation are
+    checkpointed in the staging stores and skipped by the next run, in the same process or after a restart.
+    """
+
+    def __init__(self, smol_rag, corpora=None, max_finished_jobs=100):
+        """
+        :param smol_rag: The instance to ingest into when a job names no corpus.
+        :param corpora: CorpusRegistry the corpus a job names is looked up in when the job starts.
+        :param max_finished_jobs: Number of finished jobs kept for status requests, oldest are forgotten first.
+        """
+        self.smol_rag = smol_rag
+        self.corpora = corpora
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = OrderedDict()
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    def submit(self, paths=None, corpus=None):
+        """
+        :param paths: Files or directories to import, defaults to everything in the input docs directory.
+        :param corpus: Name of the corpus to ingest into, defaults to smol_rag.
+        :return: The queued IngestionJob.
+        """
+        job = IngestionJob(paths, corpus)
+        self.jobs[job.id] = job
+        self._forget_finished_jobs()
+        self._queue.put_nowait(job)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run_jobs())
+        logger.info(f"Queued ingestion job {job.id} for {paths or 'all documents'}")
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    async def cancel(self, job_id):
+        """
+        Cancels a queued job, or a running one and waits for it to stop.
+
+        :return: The job, or None if there is no job with that id. Finished jobs are returned unchanged.
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.is_finished:
+            return job
+        if job.task is None:
+            job.set_status("cancelled")
+        else:
+            job.task.cancel()
+            await asyncio.wait([job.task])
+        return job
+
+    async def shutdown(self):
+        """Cancels the queued and running jobs."""
+        for job in list(self.jobs.values()):
+            await self.cancel(job.id)
+        if self._worker is not None:
+            self._worker.cancel()
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+    async def _run_jobs(self):
+        while not self._queue.empty():
+            job = self._queue.get_nowait()
+            if job.is_finished:
+                continue
+            job.task = asyncio.create_task(self._run_job(job))
+            await asyncio.wait([job.task])
+
+    async def _run_job(self, job):
+        job.set_status("running")
+        token = ingestion_progress.set(job)
+        try:
+            # Looked up as the job starts, a corpus is not evicted while its reindex holds the lock
+            smol_rag = self.corpora.get(job.corpus) if job.corpus else self.smol_rag
+            await smol_rag.reindex(lambda: smol_rag.ingest(job.paths))
+            job.set_status("completed")
+            logger.info(f"Ingestion job {job.id} completed: {job.documents_done} documents, "
+                        f"{len(job.failed_paths)} failed, {job.excerpts_done} excerpts, ~{job.tokens} tokens")
+        except asyncio.CancelledError:
+            job.set_status("cancelled")
+            logger.info(f"Ingestion job {job.id} cancelled after {job.documents_done} documents")
+        except Exception as e:
+            job.set_status("failed", str(e))
+            logger.error(f"Ingestion job {job.id} failed: {e}")
+        finally:
+            ingestion_progress.reset(token)
@@ -0,0 +1,51 @@
+import re
+
+STOP_WORDS = frozenset("""
+    a about above after again against all also am an and any are as at be because been before being below between both
+    but by can could did do does doing done down during each either else even ever every few for from further get gets
+    getting give go goes going got had has have having he her here hers herself him himself his how i if in into is it
+    its itself just know let like make makes many may me might more most much must my myself need needs no nor not now
+    of off on once one only or other our ours ourselves out over own please same shall she should so some such tell
+    than that the their theirs them themselves then there these they this those through to too under until up us use
+    used uses using very want was way we were what whats when where whether which while who whom whose why will with
+    within without would yes yet you your yours yourself yourselves
+""".split())
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_\-./']*[A-Za-z0-9]|[A-Za-z0-9]")
+
+
+def _is_specific(word):
+    return any(c.isupper() for c in word) or any(c.isdigit() for c in word) or any(c in "_-./" for c in word)
+
+
+def extract_keywords(text, max_keywords=10):
+    """
+    Extracts keywords from a query without calling the LLM, returning them in the same shape as
+    get_high_low_level_keywords_prompt.
+
+    Runs of consecutive words between stop words are treated as phrases. Multi-word phrases become the high-level
+    keywords and the individual words the low-level keywords, with capitalised, numeric and identifier-like words
+    (e.g. "Salable", "v2", "plan_uuid") ranked first.
+
+    :param text: The query text.
+    :param max_keywords: Maximum number of keywords returned for each level.
+    :return: A dict with "high_level_keywords" and "low_level_keywords" lists.
+    """
+    phrases = []
+    current = []
+    for token in TOKEN_PATTERN.findall(text):
+        if token.lower() in STOP_WORDS or len(token) < 2:
+            if current:
+                phrases.append(current)
+            current = []
+        else:
+            current.append(token)
+    if current:
+        phrases.append(current)
+
+    words = list(dict.fromkeys(word for phrase in phrases for word in phrase))
+    low_level = sorted(words, key=lambda word: not _is_specific(word))[:max_keywords]
+    high_level = [" ".join(phrase) for phrase in phrases if len(phrase) > 1]
+    high_level = list(dict.fromkeys(high_level or [" ".join(phrase) for phrase in phrases]))[:max_keywords]
+
+    return {"high_level_keywords": high_level, "low_level_keywords": low_level}
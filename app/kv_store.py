@@ -1,4 +1,8 @@
 import asyncio
+import copy
+import os
+import threading
+
 import aiofiles
 import json
 
@@ -9,19 +13,66 @@ from app.utilities import create_file_if_not_exists, get_json
 class JsonKvStore:
     def __init__(self, file_path, initial_data="{}"):
         self.file_path = file_path
-        create_file_if_not_exists(file_path, initial_data)
-        self.store = get_json(self.file_path)
+        self.initial_data = initial_data
+        self._store = None
+        self._load_lock = threading.Lock()
         self._lock = asyncio.Lock()
 
+    @property
+    def is_loaded(self):
+        return self._store is not None
+
+    @property
+    def store(self):
+        if self._store is None:
+            self.load()
+        return self._store
+
+    def load(self):
+        """Reads the store from disk. Called on first use, or from a worker thread to warm the store up."""
+        with self._load_lock:
+            if self._store is None:
+                create_file_if_not_exists(self.file_path, self.initial_data)
+                self._store = get_json(self.file_path)
+
+    def copy(self, file_path=None):
+        """Returns an independent in-memory copy saving to file_path, by default the same file, e.g. for staging."""
+        store = JsonKvStore(file_path or self.file_path, self.initial_data)
+        store._store = copy.deepcopy(self.store)
+        return store
+
+    def reopen(self, file_path):
+        """Returns a new store over another file, read on first use, e.g. to resume a staging generation."""
+        return JsonKvStore(file_path, self.initial_data)
+
+    def move(self, file_path):
+        """Replaces file_path with the saved file of this store, which saves there from now on."""
+        os.replace(self.file_path, file_path)
+        self.file_path = file_path
+
     async def remove(self, key):
         async with self._lock:
             if key in self.store:
                 del self.store[key]
 
+    async def remove_many(self, keys):
+        async with self._lock:
+            for key in keys:
+                self.store.pop(key, None)
+
     async def add(self, key, value):
         async with self._lock:
             self.store[key] = value
 
+    async def setdefault(self, key, value):
+        """Adds value under key unless the key is already set, and returns the stored value."""
+        async with self._lock:
+            return self.store.setdefault(key, value)
+
+    async def add_many(self, items):
+        async with self._lock:
+            self.store.update(items)
+
     async def has(self, key):
         async with self._lock:
             return key in self.store
@@ -38,7 +89,14 @@ class JsonKvStore:
         async with self._lock:
             return self.store.get(key, None)
 
+    async def get_many(self, keys):
+        async with self._lock:
+            return [self.store.get(key, None) for key in keys]
+
     async def save(self):
+        # Written to a temporary file first, so a crash or cancellation mid-write never leaves a truncated store
         async with self._lock:
-            async with aiofiles.open(self.file_path, 'w') as f:
+            tmp_path = f"{self.file_path}.tmp"
+            async with aiofiles.open(tmp_path, 'w') as f:
                 await f.write(json.dumps(self.store, indent=2))
+            os.replace(tmp_path, self.file_path)
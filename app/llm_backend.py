@@ -0,0 +1,58 @@
+from typing import Any, AsyncIterator, List, Optional, Protocol, runtime_checkable
+
+from app.definitions import LLM_BACKEND, COMPLETION_MODEL, EMBEDDING_MODEL
+from app.local_llm import LocalLlm
+from app.openai_llm import OpenAiLlm
+
+
+@runtime_checkable
+class LlmBackend(Protocol):
+    """
+    What SmolRag needs from its llm: completions, streamed completions and embeddings. OpenAiLlm calls the OpenAI API,
+    LocalLlm runs in process without a network. A backend may also expose query_cache_kv and embedding_cache_kv, which
+    SmolRag then reports and warms up with its own stores.
+    """
+
+    async def get_completion(self, query: str, model: Optional[str] = None, context: str = "",
+                             use_cache: bool = True) -> str:
+        """
+        :param query: The prompt.
+        :param model: The model to use, backends ignore models they don't know.
+        :param context: Optional system instructions.
+        :param use_cache: Whether a cached result may be returned.
+        :return: The completion.
+        """
+        ...
+
+    def get_completion_stream(self, query: str, model: Optional[str] = None, context: str = "",
+                              use_cache: bool = True) -> AsyncIterator[str]:
+        """Same as get_completion, yielding the completion in chunks as it is generated."""
+        ...
+
+    async def get_embedding(self, content: Any, model: Optional[str] = None) -> List[float]:
+        ...
+
+    async def get_embeddings(self, contents: List[Any], model: Optional[str] = None) -> List[List[float]]:
+        """:return: The embedding vectors, in the same order as contents."""
+        ...
+
+
+def create_llm_backend(dimensions=None, query_cache_kv=None, embedding_cache_kv=None, backend=LLM_BACKEND):
+    """
+    :param dimensions: Embedding dimensions, used by the local backend.
+    :param query_cache_kv: Completion cache of the OpenAI backend.
+    :param embedding_cache_kv: Embedding cache of the OpenAI backend.
+    :param backend: "openai" or "local", defaults to LLM_BACKEND.
+    :return: A new backend. The OpenAI one doesn't retry, its calls are retried by the LlmScheduler.
+    """
+    if backend == "openai":
+        return OpenAiLlm(
+            COMPLETION_MODEL,
+            EMBEDDING_MODEL,
+            query_cache_kv=query_cache_kv,
+            embedding_cache_kv=embedding_cache_kv,
+            max_retries=0
+        )
+    if backend == "local":
+        return LocalLlm(dimensions or 1536)
+    raise ValueError(f"Unknown LLM backend: {backend}, expected openai or local")
@@ -0,0 +1,247 @@
+import asyncio
+import contextvars
+import functools
+import heapq
+import itertools
+import random
+import time
+from enum import IntEnum
+
+from app.logger import logger
+from app.metrics import metrics
+
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    INGESTION = 1
+
+
+llm_priority = contextvars.ContextVar("llm_priority", default=Priority.INTERACTIVE)
+
+
+def ingestion_priority(fn):
+    """Runs every LLM call made by the decorated coroutine function, and the tasks it starts, as ingestion work."""
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        token = llm_priority.set(Priority.INGESTION)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            llm_priority.reset(token)
+
+    return wrapper
+
+
+def estimate_tokens(*texts):
+    """Cheap token estimate used for budgeting, roughly four characters per token for English text."""
+    return sum(len(str(text)) for text in texts) // 4 + 1
+
+
+def get_retry_after(error):
+    """Returns the delay in seconds the API asked for in a Retry-After header, if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def is_retryable(error):
+    import openai
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code in RETRYABLE_STATUS_CODES or (status_code is not None and status_code >= 500)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        # One second of burst, so a cold start can't fire a whole minute's budget at once
+        self.capacity = max(self.rate, 1)
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def get_delay(self, amount):
+        self._refill()
+        # A call bigger than the burst can never find that much available, it goes ahead once the bucket is full
+        amount = min(amount, self.capacity)
+        return 0 if self.available >= amount else (amount - self.available) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        # The whole amount is charged, a bigger call leaves the bucket in debt and the calls after it wait it off
+        self.available -= amount
+
+
+class _ModelState:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.queue = []
+        self.paused_until = 0
+
+    def get_delay(self, tokens):
+        pause = self.paused_until - time.monotonic()
+        return max(pause, self.requests.get_delay(1), self.tokens.get_delay(tokens))
+
+
+class _Waiter:
+    def __init__(self, priority, sequence, tokens):
+        self.priority = priority
+        self.sequence = sequence
+        self.tokens = tokens
+        self.event = asyncio.Event()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class LlmScheduler:
+    """
+    Admits LLM calls per model through a request bucket and a token bucket, serving queued calls in priority order so
+    live queries are not starved by ingestion. Rate limited and transient failures are retried with jittered
+    exponential backoff, honouring Retry-After, and a 429 pauses the whole model rather than only the failing call.
+
+    Queue depth is published as the "llm.queue.<model>.<priority>" gauges, with "llm.retries" and "llm.rate_limited"
+    counters.
+    """
+
+    def __init__(self, requests_per_minute=6000, tokens_per_minute=2_000_000, limits=None, max_retries=5,
+                 base_delay=0.5, max_delay=30.0):
+        """
+        :param requests_per_minute: Default request budget per model.
+        :param tokens_per_minute: Default token budget per model.
+        :param limits: Optional dict of model to {"requests_per_minute", "tokens_per_minute"} overrides.
+        :param max_retries: Number of retries before the error is raised to the caller.
+        :param base_delay: Backoff delay of the first retry, doubled on each attempt.
+        :param max_delay: Upper bound on the backoff delay.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.limits = limits or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._models = {}
+        self._sequence = itertools.count()
+
+    def _get_state(self, model):
+        if model not in self._models:
+            limits = self.limits.get(model, {})
+            self._models[model] = _ModelState(
+                limits.get("requests_per_minute", self.requests_per_minute),
+                limits.get("tokens_per_minute", self.tokens_per_minute),
+            )
+        return self._models[model]
+
+    def _publish_queue_depth(self, model, state):
+        for priority in Priority:
+            depth = sum(1 for waiter in state.queue if waiter.priority == priority)
+            metrics.set_gauge(f"llm.queue.{model}.{priority.name.lower()}", depth)
+
+    async def acquire(self, model, tokens=1, priority=None):
+        """
+        Waits until the call is at the head of the model's queue and both budgets allow it.
+
+        :param model: The model the call is made against.
+        :param tokens: Estimated tokens used by the call.
+        :param priority: The priority class; defaults to the current llm_priority.
+        """
+        state = self._get_state(model)
+        waiter = _Waiter(llm_priority.get() if priority is None else priority, next(self._sequence), tokens)
+        heapq.heappush(state.queue, waiter)
+        self._publish_queue_depth(model, state)
+        try:
+            while True:
+                delay = None
+                if state.queue[0] is waiter:
+                    delay = state.get_delay(tokens)
+                    if delay <= 0:
+                        break
+                waiter.event.clear()
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), delay)
+                except TimeoutError:
+                    pass
+        except BaseException:
+            state.queue.remove(waiter)
+            heapq.heapify(state.queue)
+            self._wake_head(model, state)
+            raise
+
+        heapq.heappop(state.queue)
+        state.requests.take(1)
+        state.tokens.take(tokens)
+        self._wake_head(model, state)
+
+    def _wake_head(self, model, state):
+        self._publish_queue_depth(model, state)
+        if state.queue:
+            state.queue[0].event.set()
+
+    def _get_backoff(self, model, attempt, error):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if getattr(error, "status_code", None) == 429:
+            metrics.increment("llm.rate_limited")
+            state = self._get_state(model)
+            state.paused_until = max(state.paused_until, time.monotonic() + delay)
+        return delay
+
+    async def run(self, model, tokens, fn, priority=None):
+        """
+        :param model: The model the call is made against.
+        :param tokens: Estimated tokens used by the call.
+        :param fn: Zero-argument coroutine function that performs the call, called again on each retry.
+        :param priority: The priority class; defaults to the current llm_priority.
+        :return: The result of fn.
+        """
+        for attempt in itertools.count():
+            await self.acquire(model, tokens, priority)
+            try:
+                return await fn()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = self._get_backoff(model, attempt, e)
+                metrics.increment("llm.retries")
+                logger.warning(f"LLM call to {model} failed ({e}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def stream(self, model, tokens, fn, priority=None):
+        """
+        Streaming variant of run. A failure is only retried if no chunk has been yielded yet.
+
+        :param fn: Zero-argument function returning an async iterator over the chunks.
+        """
+        for attempt in itertools.count():
+            await self.acquire(model, tokens, priority)
+            started = False
+            try:
+                async for chunk in fn():
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started or attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = self._get_backoff(model, attempt, e)
+                metrics.increment("llm.retries")
+                logger.warning(f"LLM stream from {model} failed ({e}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
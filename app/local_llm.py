@@ -0,0 +1,87 @@
+import asyncio
+import math
+import re
+import zlib
+from collections import Counter
+from typing import Any, AsyncIterator, Callable, List, Optional
+
+import numpy as np
+
+from app.logger import logger
+
+TOKEN_REGEX = re.compile(r"\w+")
+
+
+def _hash(feature):
+    # crc32 is stable across processes, unlike hash(), so the same text always gets the same vector
+    return zlib.crc32(feature.encode())
+
+
+class LocalLlm:
+    """
+    In-process backend with no network calls, for tests, benchmarks and air-gapped use, and to measure SmolRag's own
+    overhead apart from the provider's latency.
+
+    Embeddings are deterministic hashed n-gram vectors: the words of a text and the character n-grams of each word are
+    hashed into a fixed number of buckets with a random sign, weighted by sublinear term frequency and L2 normalised.
+    Texts sharing words or word fragments get similar vectors, which is enough for lexical retrieval but captures no
+    meaning beyond that. Completions come from completion_fn, by default a stub echoing the start of the prompt.
+    """
+
+    def __init__(self, dimensions=1536, ngram_sizes=(3, 4), completion_fn: Optional[Callable[[str, str], str]] = None,
+                 stream_chunk_size=16):
+        """
+        :param dimensions: Embedding dimensions, must match the vector stores.
+        :param ngram_sizes: Sizes of the character n-grams taken from every word, on top of the word itself.
+        :param completion_fn: Function of the prompt and system context returning the completion.
+        :param stream_chunk_size: Characters per chunk yielded by get_completion_stream.
+        """
+        self.dimensions = dimensions
+        self.ngram_sizes = ngram_sizes
+        self.completion_fn = completion_fn or get_stub_completion
+        self.stream_chunk_size = stream_chunk_size
+
+    async def get_completion(self, query: str, model: Optional[str] = None, context: str = "",
+                             use_cache: bool = True) -> str:
+        return self.completion_fn(query, context)
+
+    async def get_completion_stream(self, query: str, model: Optional[str] = None, context: str = "",
+                                    use_cache: bool = True) -> AsyncIterator[str]:
+        result = self.completion_fn(query, context)
+        for start in range(0, len(result), self.stream_chunk_size):
+            yield result[start:start + self.stream_chunk_size]
+            # Lets other requests run between chunks, as a network stream would
+            await asyncio.sleep(0)
+
+    async def get_embedding(self, content: Any, model: Optional[str] = None) -> List[float]:
+        return self.embed(str(content)).tolist()
+
+    async def get_embeddings(self, contents: List[Any], model: Optional[str] = None) -> List[List[float]]:
+        logger.info(f"Embedding {len(contents)} contents locally")
+        return [self.embed(str(content)).tolist() for content in contents]
+
+    def embed(self, text):
+        """:return: The hashed n-gram vector of text, as a float32 array."""
+        features = Counter()
+        for word in TOKEN_REGEX.findall(text.lower()):
+            features[word] += 1
+            padded = f"<{word}>"
+            for size in self.ngram_sizes:
+                for start in range(len(padded) - size + 1):
+                    features[f"#{padded[start:start + size]}"] += 1
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for feature, count in features.items():
+            hashed = _hash(feature)
+            # The top bit picks the sign, so colliding features cancel out on average instead of piling up
+            vector[hashed % self.dimensions] += (1 + math.log(count)) * (1 if hashed >> 31 else -1)
+        norm = np.linalg.norm(vector)
+        # An empty text still gets a usable unit vector
+        if not norm:
+            vector[0], norm = 1, 1
+        return vector / norm
+
+
+def get_stub_completion(query, context=""):
+    """A deterministic stand-in for a completion: the first line of the prompt and the size of the context."""
+    first_line = query.strip().split("\n", 1)[0][:200]
+    return f"Stub completion for: {first_line} ({len(context)} characters of context)"
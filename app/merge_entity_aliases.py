@@ -0,0 +1,10 @@
+import asyncio
+
+from app.smol_rag import SmolRag
+
+if __name__ == '__main__':
+    async def main():
+        smol_rag = SmolRag()
+        await smol_rag.migrate_entity_aliases()
+
+    asyncio.run(main())
@@ -0,0 +1,28 @@
+from collections import defaultdict
+
+
+class Metrics:
+    """Process-wide counters and gauges, exposed by the API at /metrics."""
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+
+    def increment(self, name, value=1):
+        self.counters[name] += value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def get(self, name):
+        return self.counters.get(name, self.gauges.get(name, 0))
+
+    def snapshot(self):
+        return {"counters": dict(self.counters), "gauges": dict(self.gauges)}
+
+    def reset(self):
+        self.counters.clear()
+        self.gauges.clear()
+
+
+metrics = Metrics()
@@ -1,33 +1,52 @@
-from typing import Any, Dict, List, Optional
+import asyncio
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 from dotenv import load_dotenv
-from openai import OpenAI
 
 from app.definitions import QUERY_CACHE_KV_PATH, EMBEDDING_CACHE_KV_PATH, COMPLETION_MODEL, EMBEDDING_MODEL, \
     OPENAI_API_KEY
 from app.kv_store import JsonKvStore
 from app.logger import logger
+from app.single_flight import SingleFlight
 from app.utilities import make_hash
 
 load_dotenv()
 
 
+def get_query_hash(query, context=""):
+    # The system prompt carries the retrieved context, so the same question asked of another corpus is another entry
+    return make_hash(f"{context}\n\n{query}" if context else query, 'qry-')
+
+
 class OpenAiLlm:
     def __init__(self, completion_model=None, embedding_model=None, query_cache_kv=None, embedding_cache_kv=None,
-                 openai_api_key=None) -> None:
+                 openai_api_key=None, max_retries=2) -> None:
         """
-        Initializes the OpenAiLlm instance with specified models and caches.
+        Initializes the OpenAiLlm instance with specified models and caches. Set max_retries to 0 when calls are
+        retried by an LlmScheduler, so failures are not retried twice.
         """
-        self.client = openai_api_key or OpenAI(api_key=OPENAI_API_KEY)
+        self._client = openai_api_key
+        self.max_retries = max_retries
         self.query_cache_kv = query_cache_kv or JsonKvStore(QUERY_CACHE_KV_PATH)
         self.embedding_cache_kv = embedding_cache_kv or JsonKvStore(EMBEDDING_CACHE_KV_PATH)
         self.completion_model = completion_model or COMPLETION_MODEL
         self.embedding_model = embedding_model or EMBEDDING_MODEL
+        self.completion_flights = SingleFlight("llm.completion")
+        self.embedding_flights = SingleFlight("llm.embedding")
+
+    @property
+    def client(self):
+        # The openai package takes over half a second to import, so the client is only created on first use
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=OPENAI_API_KEY, max_retries=self.max_retries)
+        return self._client
 
     async def get_completion(self, query: str, model: Optional[str] = None, context: str = "",
                              use_cache: bool = True) -> str:
         """
-        Gets a completion from the API with optional caching.
+        Gets a completion from the API with optional caching. Concurrent calls with the same arguments share a single
+        request.
 
         :param query: User's query string.
         :param model: The model to use; if None, use self.completion_model.
@@ -36,7 +55,13 @@ class OpenAiLlm:
         :return: The completion result.
         """
         model = model or self.completion_model
-        query_hash = make_hash(query, 'qry-')
+        return await self.completion_flights.run(
+            (model, context, query, use_cache),
+            lambda: self._get_completion(query, model, context, use_cache)
+        )
+
+    async def _get_completion(self, query: str, model: str, context: str, use_cache: bool) -> str:
+        query_hash = get_query_hash(query, context)
         if use_cache and await self.query_cache_kv.has(query_hash):
             logger.info("Query cache hit")
             cache_data = await self.query_cache_kv.get_by_key(query_hash)
@@ -47,7 +72,8 @@ class OpenAiLlm:
         messages: List[Dict[str, str]] = [{"role": "user", "content": query}]
 
         try:
-            response = self.client.chat.completions.create(
+            response = await asyncio.to_thread(
+                self.client.chat.completions.create,
                 model=model,
                 store=True,
                 messages=system_message + messages
@@ -62,6 +88,60 @@ class OpenAiLlm:
 
         return result
 
+    async def get_completion_stream(self, query: str, model: Optional[str] = None, context: str = "",
+                                    use_cache: bool = True) -> AsyncIterator[str]:
+        """
+        Streams a completion from the API, yielding each chunk of content as it arrives. A cached result is yielded
+        as a single chunk, and the cache is only populated once the stream has finished.
+
+        :param query: User's query string.
+        :param model: The model to use; if None, use self.completion_model.
+        :param context: Optional context or instructions.
+        :param use_cache: Whether to use the cached results.
+        :return: An async iterator over the completion content.
+        """
+        model = model or self.completion_model
+        query_hash = get_query_hash(query, context)
+        if use_cache and await self.query_cache_kv.has(query_hash):
+            logger.info("Query cache hit")
+            cache_data = await self.query_cache_kv.get_by_key(query_hash)
+            yield cache_data["result"]
+            return
+
+        logger.info("New streaming query")
+        system_message = [{"role": "system", "content": context}] if context else []
+        messages: List[Dict[str, str]] = [{"role": "user", "content": query}]
+
+        try:
+            stream = await asyncio.to_thread(
+                self.client.chat.completions.create,
+                model=model,
+                store=True,
+                messages=system_message + messages,
+                stream=True
+            )
+        except Exception as e:
+            logger.error(f"Error getting completion stream: {e}")
+            raise
+
+        chunks = []
+        iterator = iter(stream)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk.choices and chunk.choices[0].delta.content:
+                    chunks.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            # A consumer that stops early, e.g. a client that disconnected, would otherwise leave the response open
+            # and the model generating
+            stream.close()
+
+        await self.query_cache_kv.add(query_hash, {"query": query, "result": "".join(chunks)})
+        await self.query_cache_kv.save()
+
     # Todo: add caching for chat completion
     def get_chat_completion(self, query: str, model: Optional[str] = None, context: str = "",
                             chat_history: List[Dict[str, str]] = []) -> List[Dict[str, str]]:
@@ -100,24 +180,60 @@ class OpenAiLlm:
         :param model: The model to use; if None, use self.embedding_model.
         :return: The embedding vector.
         """
+        return (await self.get_embeddings([content], model))[0]
+
+    async def get_embeddings(self, contents: List[Any], model: Optional[str] = None,
+                             batch_size: int = 2048) -> List[List[float]]:
+        """
+        Gets embeddings for several contents, requesting all cache misses from the API in a single batched call.
+        Identical contents are only embedded once, and contents already being embedded by a concurrent call are
+        shared with it.
+
+        :param contents: The texts to be embedded.
+        :param model: The model to use; if None, use self.embedding_model.
+        :param batch_size: Maximum number of inputs per API call, the embeddings endpoint accepts up to 2048.
+        :return: The embedding vectors, in the same order as contents.
+        """
         model = model or self.embedding_model
-        content_hash = make_hash(str(content), 'emb-')
+        content_hashes = [make_hash(str(content), 'emb-') for content in contents]
+
+        embeddings = {}
+        missing = {}
+        for content, content_hash in zip(contents, content_hashes):
+            if content_hash in embeddings or content_hash in missing:
+                continue
+            if await self.embedding_cache_kv.has(content_hash):
+                embeddings[content_hash] = await self.embedding_cache_kv.get_by_key(content_hash)
+            else:
+                missing[content_hash] = content
+        logger.info(f"Embedding cache hits: {len(embeddings)}, new embeddings: {len(missing)}")
+
+        if missing:
+            keys = [(model, content_hash) for content_hash in missing]
+            results = await self.embedding_flights.run_many(
+                keys,
+                lambda own_keys: self._create_embeddings(model, {key: missing[key[1]] for key in own_keys}, batch_size)
+            )
+            embeddings.update((key[1], embedding) for key, embedding in zip(keys, results))
 
-        if await self.embedding_cache_kv.has(content_hash):
-            logger.info("Embedding cache hit")
-            embedding = await self.embedding_cache_kv.get_by_key(content_hash)
-        else:
-            logger.info("New embedding")
+        return [embeddings[content_hash] for content_hash in content_hashes]
+
+    async def _create_embeddings(self, model: str, contents: Dict[Any, Any], batch_size: int) -> Dict[Any, List[float]]:
+        keys = list(contents.keys())
+        embeddings = {}
+        for start in range(0, len(keys), batch_size):
+            batch_keys = keys[start:start + batch_size]
             try:
-                response = self.client.embeddings.create(
+                response = await asyncio.to_thread(
+                    self.client.embeddings.create,
                     model=model,
-                    input=content,
+                    input=[contents[key] for key in batch_keys],
                 )
-                embedding = response.data[0].embedding
             except Exception as e:
-                logger.error(f"Error getting embedding: {e}")
+                logger.error(f"Error getting embeddings: {e}")
                 raise
-            await self.embedding_cache_kv.add(content_hash, embedding)
-            await self.embedding_cache_kv.save()
-
-        return embedding
+            for key, data in zip(batch_keys, sorted(response.data, key=lambda d: d.index)):
+                embeddings[key] = data.embedding
+                await self.embedding_cache_kv.add(key[1], data.embedding)
+        await self.embedding_cache_kv.save()
+        return embeddings
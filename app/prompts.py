@@ -162,6 +162,20 @@ def get_extract_entities_prompt(
     return prompt.format(**context_base, input_text=content)
 
 
+def get_consolidate_description_prompt(name, descriptions):
+    description_list = "\n".join(f"- {description}" for description in descriptions)
+    return inspect.cleandoc(f"""
+        You are given several descriptions of the same item from a knowledge graph, each written from a different excerpt of the documentation.
+
+        Combine them into a single comprehensive description of "{name}". Resolve any contradictions, remove repetition and keep every distinct fact. Write in the third person, in en_GB english, using no more than 150 words.
+
+        Descriptions:
+        {description_list}
+
+        Respond with the description only.
+    """)
+
+
 def get_high_low_level_keywords_prompt(query):
     return inspect.cleandoc(f"""
         ---Role---
@@ -276,3 +290,58 @@ def get_mix_system_prompt(query_context, kg_context):
     """)
 
     return system_prompt
+
+
+def get_community_summary_prompt(context):
+    return inspect.cleandoc(f"""
+        ---Role---
+
+        You are a technical writer summarising one community of a knowledge graph built from product documentation. A community is a group of closely connected entities and the relationships between them.
+
+        ---Goal---
+
+        Write a report describing what this community covers, the key entities in it, how they relate to each other and what a user could achieve with them. Only use the information in the data tables, do not make anything up.
+
+        ---Response parameters---
+
+         - Answers must be in en_GB english
+         - Start with a short title on its own line
+         - Follow with one or two paragraphs of summary, no more than 300 words in total
+
+        ---Data tables---
+
+        {context}
+    """)
+
+
+def get_community_query_system_prompt(context):
+    return inspect.cleandoc(f"""
+        ---Role---
+
+        You are a helpful assistant responding to broad questions about a set of documentation. The provided community reports summarise groups of related topics in the documentation and are your source of truth.
+
+        ---Goal---
+
+        Generate a response that answers the user's question by combining the relevant information in the community reports.
+        If you don't know the answer, just say so. Do not make anything up or include information where the supporting evidence is not provided.
+
+        ---Response parameters---
+
+         - Answers must be in en_GB english
+         - Use markdown formatting with appropriate section headings
+         - Each section should focus on one main point or aspect of the answer
+         - Use clear and descriptive section titles that reflect the content
+         - You must not attempt to answer queries if the context does provide any supporting evidence
+
+        ---Community reports---
+
+        {context}
+    """)
+
+
+def get_no_relevant_context_response():
+    return inspect.cleandoc("""
+        I'm sorry, I couldn't find anything in the documentation related to your question, so I'm unable to answer it.
+        
+        Try rephrasing the question or asking about a topic covered by the documentation.
+    """)
@@ -0,0 +1,336 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+
+import numpy as np
+
+from app.logger import logger
+from app.vector_store import NanoVectorStore
+
+SHARD_MANIFEST = "shards.json"
+
+# The shard served by the current worker process, see _init_shard
+_shard = None
+_loop = None
+
+
+def get_shard(key, shard_names):
+    """Rendezvous hashing: adding or removing a shard only moves the rows that shard gains or loses."""
+    return max(shard_names, key=lambda name: hashlib.md5(f"{name}:{key}".encode()).digest())
+
+
+def get_shard_key(row):
+    # Excerpts are partitioned by document, so a doc_ids filter only has to ask the shards owning those documents
+    return row.get("__doc_id__") or row["__id__"]
+
+
+def _init_shard(storage_file, dimensions, coarse_dimensions, coarse_candidates):
+    global _shard, _loop
+    _loop = asyncio.new_event_loop()
+    _shard = NanoVectorStore(storage_file, dimensions, coarse_dimensions, coarse_candidates)
+
+
+def _load_shard():
+    _shard.load()
+
+
+def _restore_shard(data, matrix):
+    # A staging copy starts from the rows of the live shard rather than from its file, which may be behind
+    _shard.restore(data, matrix)
+
+
+def _save_shard(storage_file):
+    # Saved where the parent says, a staging store saves to its staging directory until it is moved into place
+    _shard.storage_file = storage_file
+    _loop.run_until_complete(_shard.save())
+
+
+def _call_shard(method, *args):
+    return _loop.run_until_complete(getattr(_shard, method)(*args))
+
+
+def _get_moved_rows(shard_names, name):
+    data, matrix = _loop.run_until_complete(_shard.get_all())
+    return [
+        {**row, "__vector__": matrix[i]}
+        for i, row in enumerate(data)
+        if get_shard(get_shard_key(row), shard_names) != name
+    ]
+
+
+class ShardedVectorStore:
+    """
+    Vector store partitioned across local worker processes, for stores that don't fit in one worker's memory or search
+    too slowly on one core. Rows are assigned to shards by rendezvous hashing of their document id, or their id when
+    they have none, and every shard is a NanoVectorStore in its own process saving to <storage_dir>/<shard>.json.
+    Queries are sent to every shard, or only the shards owning the documents of a doc_ids filter, and the per-shard
+    top k results are merged. A worker process that dies fails the calls it was serving and is restarted from the last
+    saved file of its shard.
+
+    Has the same interface as NanoVectorStore, plus add_shard and remove_shard to rebalance a live store.
+    """
+
+    def __init__(self, storage_dir, dimensions, shards=4, coarse_dimensions=None, coarse_candidates=100):
+        """
+        :param storage_dir: Directory of the shard files and the manifest listing the shards.
+        :param dimensions: Vector dimensions.
+        :param shards: Number of shards of a new store, an existing store keeps the shards in its manifest.
+        :param coarse_dimensions: Two-stage search on every shard, see NanoVectorStore.
+        :param coarse_candidates: Rows re-scored at full dimension per query and shard.
+        """
+        self.storage_dir = storage_dir
+        self.dimensions = dimensions
+        self.coarse_dimensions = coarse_dimensions
+        self.coarse_candidates = coarse_candidates
+        self.shard_names = self._read_manifest() or [f"shard-{i}" for i in range(shards)]
+        self._workers = {}
+        self._removed_shards = []
+        self._load_lock = threading.Lock()
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_loaded(self):
+        return bool(self._workers)
+
+    def load(self):
+        """Starts a worker process per shard and has them read their shard in parallel."""
+        with self._load_lock:
+            if not self._workers:
+                workers = {name: self._start_worker(name) for name in self.shard_names}
+                for future in [worker.submit(_load_shard) for worker in workers.values()]:
+                    future.result()
+                self._workers = workers
+                logger.info(f"Loaded {len(workers)} vector shards from {self.storage_dir}")
+
+    def copy(self, storage_dir=None):
+        """
+        Returns an independent copy with its own worker processes saving to storage_dir, by default the same
+        directory, e.g. for a staging generation. The rows of every shard are passed through the parent process.
+        """
+        store = ShardedVectorStore(
+            storage_dir or self.storage_dir,
+            self.dimensions,
+            len(self.shard_names),
+            self.coarse_dimensions,
+            self.coarse_candidates
+        )
+        store.shard_names = list(self.shard_names)
+        self.load()
+        workers = self._workers
+        states = {name: workers[name].submit(_call_shard, "get_all") for name in store.shard_names}
+        store._workers = {name: store._start_worker(name) for name in store.shard_names}
+        for future in [store._workers[name].submit(_restore_shard, *states[name].result()) for name in states]:
+            future.result()
+        return store
+
+    def reopen(self, storage_dir):
+        """Returns a new store over another directory, loaded on first use, e.g. to resume a staging generation."""
+        return ShardedVectorStore(
+            storage_dir, self.dimensions, len(self.shard_names), self.coarse_dimensions, self.coarse_candidates
+        )
+
+    def move(self, storage_dir):
+        """Replaces storage_dir with the saved directory of this store, which saves there from now on."""
+        old_dir = f"{storage_dir}.old"
+        # A directory can only be renamed over an empty one, so the old shards are moved aside first
+        if os.path.exists(storage_dir):
+            os.replace(storage_dir, old_dir)
+        os.replace(self.storage_dir, storage_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        self.storage_dir = storage_dir
+
+    def close(self):
+        """Stops the worker processes, unsaved changes are lost."""
+        workers, self._workers = self._workers, {}
+        for worker in workers.values():
+            worker.shutdown(wait=False, cancel_futures=True)
+
+    def _start_worker(self, name):
+        os.makedirs(self.storage_dir, exist_ok=True)
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_shard,
+            initargs=(
+                os.path.join(self.storage_dir, f"{name}.json"),
+                self.dimensions,
+                self.coarse_dimensions,
+                self.coarse_candidates
+            )
+        )
+
+    async def _get_workers(self):
+        if not self._workers:
+            # Starting the workers and reading the shards takes a while, other requests are served meanwhile
+            await asyncio.to_thread(self.load)
+        return self._workers
+
+    async def _call(self, name, fn, *args):
+        worker = (await self._get_workers())[name]
+        try:
+            return await asyncio.get_running_loop().run_in_executor(worker, fn, *args)
+        except BrokenProcessPool:
+            await self._restart_worker(name, worker)
+            raise
+
+    async def _restart_worker(self, name, worker):
+        """Replaces the worker of a shard whose process died with one reading the shard from its last saved file."""
+        # Calls failing on the same dead worker restart it once
+        if self._workers.get(name) is not worker:
+            return
+        logger.error(f"Worker of vector shard {name} died, restarting it, changes since the last save are lost")
+        worker.shutdown(wait=False)
+        self._workers[name] = self._start_worker(name)
+        await asyncio.get_running_loop().run_in_executor(self._workers[name], _load_shard)
+
+    async def _call_all(self, names, method, *args):
+        return await asyncio.gather(*(self._call(name, _call_shard, method, *args) for name in names))
+
+    def _get_query_shards(self, filter):
+        if filter is None or filter.get("doc_ids") is None:
+            return list(self.shard_names)
+        return sorted({get_shard(doc_id, self.shard_names) for doc_id in filter["doc_ids"]})
+
+    async def _upsert_by_shard(self, rows, shard_names):
+        shard_rows = defaultdict(list)
+        for row in rows:
+            shard_rows[get_shard(get_shard_key(row), shard_names)].append(row)
+        await asyncio.gather(*(self._call(name, _call_shard, "upsert", rows) for name, rows in shard_rows.items()))
+
+    async def upsert(self, rows):
+        async with self._lock:
+            await self._upsert_by_shard(rows, self.shard_names)
+
+    async def delete(self, ids):
+        # Ids don't say which document they belong to, so every shard is asked
+        async with self._lock:
+            await self._call_all(self.shard_names, "delete", ids)
+
+    async def query(self, query, top_k=10, better_than_threshold=0.02, filter=None):
+        """
+        :param query: Query vector.
+        :param top_k: Number of results.
+        :param better_than_threshold: Minimum score for a result to be returned.
+        :param filter: Optional dict restricting the rows scored, see NanoVectorStore.get_ids.
+        """
+        return (await self.query_many([query], top_k, better_than_threshold, filter))[0]
+
+    async def query_many(self, queries, top_k=10, better_than_threshold=0.02, filter=None):
+        """
+        Scatters the queries to the shards as one matrix each and merges their top k results.
+
+        :param queries: Array of shape (n_queries, dimensions).
+        :param top_k: Number of results per query.
+        :param better_than_threshold: Minimum score for a result to be returned.
+        :param filter: Optional dict restricting the rows scored, see NanoVectorStore.get_ids.
+        :return: One list of results per query, in the same format as NanoVectorStore.query().
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimensions)
+        shard_results = await self._call_all(
+            self._get_query_shards(filter), "query_many", queries, top_k, better_than_threshold, filter
+        )
+        results = []
+        for query_results in zip(*shard_results) if shard_results else [[] for _ in queries]:
+            # A row being moved by add_shard or remove_shard can briefly be on two shards
+            rows = {}
+            for row in sorted(chain(*query_results), key=lambda row: -row["__metrics__"]):
+                rows.setdefault(row["__id__"], row)
+            results.append(list(rows.values())[:top_k])
+        return results
+
+    async def get_ids(self, filter):
+        """:return: The ids of the rows matching the filter, see NanoVectorStore.get_ids."""
+        return list(chain(*await self._call_all(self._get_query_shards(filter), "get_ids", filter)))
+
+    async def get_first_id(self):
+        """:return: The id of the first row of the first non-empty shard, or None when every shard is empty."""
+        for name in list(self.shard_names):
+            id = await self._call(name, _call_shard, "get_first_id")
+            if id is not None:
+                return id
+        return None
+
+    async def get_all(self):
+        """
+        :return: The row metadata, shard by shard, and the normalised vector matrix in the same order.
+        """
+        shards = await self._call_all(self.shard_names, "get_all")
+        data = list(chain(*(data for data, _ in shards)))
+        matrix = np.vstack([matrix for _, matrix in shards]) if shards else np.zeros((0, self.dimensions))
+        return data, matrix
+
+    async def add_shard(self, name=None):
+        """
+        Adds a shard and moves the rows it now owns to it. Queries are served throughout.
+
+        :param name: Name of the new shard, defaults to the next free shard-<n>.
+        :return: The name of the new shard.
+        """
+        async with self._lock:
+            workers = await self._get_workers()
+            name = name or next(f"shard-{i}" for i in range(len(workers) + 1) if f"shard-{i}" not in workers)
+            if name in workers:
+                raise ValueError(f"Shard {name} already exists")
+            workers[name] = self._start_worker(name)
+            old_names, shard_names = self.shard_names, self.shard_names + [name]
+            # Every moved row is copied to the new shard and the shard is published to queries before any row is
+            # deleted from its old shard, so none go missing meanwhile
+            moved_ids = {}
+            for old_name in old_names:
+                rows = await self._call(old_name, _get_moved_rows, shard_names, old_name)
+                await self._call(name, _call_shard, "upsert", rows)
+                moved_ids[old_name] = [row["__id__"] for row in rows]
+            self.shard_names = shard_names
+            for old_name, ids in moved_ids.items():
+                await self._call(old_name, _call_shard, "delete", ids)
+            logger.info(f"Added vector shard {name} to {self.storage_dir}")
+            return name
+
+    async def remove_shard(self, name):
+        """Moves the rows of a shard to the shards that now own them and stops it. Queries are served throughout."""
+        async with self._lock:
+            if name not in self.shard_names:
+                raise ValueError(f"No shard named {name}")
+            if len(self.shard_names) == 1:
+                raise ValueError("Cannot remove the last shard")
+            shard_names = [shard_name for shard_name in self.shard_names if shard_name != name]
+            await self._upsert_by_shard(await self._call(name, _get_moved_rows, shard_names, name), shard_names)
+            self.shard_names = shard_names
+            self._workers.pop(name).shutdown(wait=False)
+            self._removed_shards.append(name)
+            logger.info(f"Removed vector shard {name} from {self.storage_dir}")
+
+    async def save(self):
+        # The manifest is written once every shard has been saved, and files of removed shards deleted after that
+        async with self._lock:
+            if not self._workers:
+                return
+            await asyncio.gather(*(
+                self._call(name, _save_shard, os.path.join(self.storage_dir, f"{name}.json"))
+                for name in self.shard_names
+            ))
+            os.makedirs(self.storage_dir, exist_ok=True)
+            manifest_file = os.path.join(self.storage_dir, SHARD_MANIFEST)
+            with open(f"{manifest_file}.tmp", "w") as f:
+                json.dump({"shards": self.shard_names}, f)
+            os.replace(f"{manifest_file}.tmp", manifest_file)
+            for name in self._removed_shards:
+                removed_file = os.path.join(self.storage_dir, f"{name}.json")
+                if os.path.exists(removed_file):
+                    os.remove(removed_file)
+            self._removed_shards = []
+
+    def _read_manifest(self):
+        manifest_file = os.path.join(self.storage_dir, SHARD_MANIFEST)
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file) as f:
+            return json.load(f)["shards"]
@@ -0,0 +1,81 @@
+import asyncio
+
+from app.metrics import metrics
+
+
+class SingleFlight:
+    """
+    Shares one in-flight call between concurrent callers asking for the same key. Keys are only held while the call is
+    running, so finished results are never served from here; caching stays the job of the KV stores.
+
+    Every key that starts a call counts towards the "<name>.calls" metric and every caller that joins one counts
+    towards "<name>.dedup_hits".
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._futures = {}
+
+    def __len__(self):
+        return len(self._futures)
+
+    async def run(self, key, fn):
+        """
+        :param key: Hashable key identifying the call.
+        :param fn: Zero-argument coroutine function that performs the call.
+        :return: The result of the call, shared with any concurrent caller using the same key.
+        """
+        future = self._futures.get(key)
+        if future is not None:
+            metrics.increment(f"{self.name}.dedup_hits")
+            return await asyncio.shield(future)
+
+        metrics.increment(f"{self.name}.calls")
+        task = asyncio.ensure_future(fn())
+        self._futures[key] = task
+        task.add_done_callback(lambda _: self._release(key, task))
+        return await asyncio.shield(task)
+
+    async def run_many(self, keys, fn):
+        """
+        Batched variant of run. Keys already in flight are joined, the remaining keys are fetched with a single call.
+
+        :param keys: Hashable keys identifying each item.
+        :param fn: Coroutine function taking the list of keys that are not in flight and returning a dict of results
+            by key.
+        :return: The results, in the same order as keys.
+        """
+        shared = {key: self._futures[key] for key in keys if key in self._futures}
+        own_keys = [key for key in dict.fromkeys(keys) if key not in shared]
+        if shared:
+            metrics.increment(f"{self.name}.dedup_hits", len(shared))
+
+        if own_keys:
+            metrics.increment(f"{self.name}.calls", len(own_keys))
+            loop = asyncio.get_running_loop()
+            futures = {key: loop.create_future() for key in own_keys}
+            self._futures.update(futures)
+            task = asyncio.ensure_future(fn(own_keys))
+            task.add_done_callback(lambda _: self._resolve_many(task, futures))
+            shared.update(futures)
+
+        return await asyncio.gather(*(asyncio.shield(shared[key]) for key in keys))
+
+    def _release(self, key, future):
+        if self._futures.get(key) is future:
+            del self._futures[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved, joined callers may all have been cancelled
+            future.exception()
+
+    def _resolve_many(self, task, futures):
+        for key, future in futures.items():
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            elif key not in task.result():
+                future.set_exception(KeyError(key))
+            else:
+                future.set_result(task.result()[key])
+            self._release(key, future)
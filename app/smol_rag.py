@@ -1,78 +1,456 @@
 import asyncio
+import contextlib
+import functools
 import inspect
+import json
+import os
+import shutil
 import time
 
 import numpy as np
-from aiolimiter import AsyncLimiter
 
+from app.bm25_index import Bm25Index
 from app.chunking import preserve_markdown_code_excerpts
+from app.context_assembler import ContextAssembler
 from app.definitions import INPUT_DOCS_DIR, SOURCE_TO_DOC_ID_KV_PATH, DOC_ID_TO_SOURCE_KV_PATH, EMBEDDINGS_DB, \
     EXCERPT_KV_PATH, DOC_ID_TO_EXCERPT_KV_PATH, KG_DB, ENTITIES_DB, RELATIONSHIPS_DB, KG_SEP, TUPLE_SEP, REC_SEP, \
-    COMPLETE_TAG, LOG_DIR, COMPLETION_MODEL, EMBEDDING_MODEL
+    COMPLETE_TAG, LOG_DIR, COMPLETION_MODEL, EMBEDDING_MODEL, COMMUNITIES_DB, COMMUNITY_KV_PATH, \
+    CONSOLIDATION_KV_PATH, ENTITY_ALIAS_KV_PATH, RELEVANCE_THRESHOLD, LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, \
+    VECTOR_SHARDS, COARSE_DIMENSIONS, COARSE_CANDIDATES, BM25_INDEX_PATH
 from app.graph_store import NetworkXGraphStore
+from app.ingestion_jobs import ingestion_progress
+from app.keyword_extractor import extract_keywords
 from app.kv_store import JsonKvStore
+from app.llm_backend import create_llm_backend
+from app.llm_scheduler import LlmScheduler, estimate_tokens, ingestion_priority
 from app.logger import logger, set_logger
-from app.openai_llm import OpenAiLlm
+from app.metrics import metrics
 from app.prompts import get_query_system_prompt, excerpt_summary_prompt, get_extract_entities_prompt, \
-    get_high_low_level_keywords_prompt, get_kg_query_system_prompt, get_mix_system_prompt
+    get_high_low_level_keywords_prompt, get_kg_query_system_prompt, get_mix_system_prompt, \
+    get_community_summary_prompt, get_community_query_system_prompt, get_consolidate_description_prompt, \
+    get_no_relevant_context_response
+from app.sharded_vector_store import ShardedVectorStore
+from app.single_flight import SingleFlight
+from app.store_generation import GenerationStore, StoreGeneration, pinned_generations, get_store_path, \
+    get_staging_path, STAGING_CHECKPOINT
+from app.timings import Timings
 from app.utilities import read_file, get_docs, make_hash, split_string_by_multi_markers, clean_str, \
     extract_json_from_text, is_float_regex, truncate_list_by_token_size, \
-    list_of_list_to_csv, delete_all_files
+    list_of_list_to_csv, delete_all_files, get_encoded_tokens, normalize_entity_name, reciprocal_rank_fusion, \
+    get_relative_path
 from app.vector_store import NanoVectorStore
 
 
+FILTER_FIELDS = ("doc_ids", "source_prefix", "inserted_after", "inserted_before")
+FILTERABLE_QUERY_TYPES = ("standard", "hybrid")
+KG_QUERY_TYPES = {(True, True): "hybrid_kg", (True, False): "local_kg", (False, True): "global_kg"}
+# Minimum similarity between a stored excerpt vector and the same excerpt embedded again by the llm backend
+EMBEDDING_CHECK_THRESHOLD = 0.9
+
+
+def writes_stores(fn):
+    """
+    Runs a SmolRag method that writes the live stores under the reindex lock, so a reindex never copies them halfway
+    through a write. Run as the ingestion of a reindex, it writes the staging generation under the lock already held.
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(self, *args, **kwargs):
+        if self.generation is not self._generation:
+            return await fn(self, *args, **kwargs)
+        async with self._reindex_lock:
+            # The checkpoint of an interrupted reindex was copied from the stores this is about to change
+            self._remove_staging_dirs()
+            return await fn(self, *args, **kwargs)
+
+    return wrapper
+
+
 class SmolRag:
+    embeddings_db = GenerationStore()
+    entities_db = GenerationStore()
+    relationships_db = GenerationStore()
+    communities_db = GenerationStore()
+    source_to_doc_kv = GenerationStore()
+    doc_to_source_kv = GenerationStore()
+    doc_to_excerpt_kv = GenerationStore()
+    excerpt_kv = GenerationStore()
+    community_kv = GenerationStore()
+    consolidation_kv = GenerationStore()
+    entity_alias_kv = GenerationStore()
+    graph = GenerationStore()
+    bm25_index = GenerationStore()
+
     def __init__(
             self,
             excerpt_fn=None,
             llm=None,
+            llm_scheduler=None,
             embeddings_db=None,
             entities_db=None,
             relationships_db=None,
+            communities_db=None,
             source_to_doc_kv=None,
             doc_to_source_kv=None,
             doc_to_excerpt_kv=None,
             excerpt_kv=None,
+            community_kv=None,
+            consolidation_kv=None,
+            entity_alias_kv=None,
             query_cache_kv=None,
             embedding_cache_kv=None,
             graph_db=None,
+            bm25_index=None,
+            snapshot=None,
+            data_dir=None,
+            input_docs_dir=None,
             dimensions=None,
+            vector_shards=VECTOR_SHARDS,
+            coarse_dimensions=COARSE_DIMENSIONS,
+            coarse_candidates=COARSE_CANDIDATES,
             excerpt_size=2000,
-            overlap=200
+            overlap=200,
+            entity_merge_threshold=None,
+            relevance_threshold=RELEVANCE_THRESHOLD,
+            embedding_timeout=2.0,
+            mix_token_budget=8000
     ):
         set_logger("main.log")
-        self.llm_limiter = AsyncLimiter(max_rate=100, time_period=1)
+        self.llm_scheduler = llm_scheduler or LlmScheduler(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+        self.query_flights = SingleFlight("query")
 
         self.excerpt_fn = excerpt_fn or preserve_markdown_code_excerpts
         self.excerpt_size = excerpt_size
         self.overlap = overlap
-
-        self.llm = llm or OpenAiLlm(
-            COMPLETION_MODEL,
-            EMBEDDING_MODEL,
-            query_cache_kv=query_cache_kv,
-            embedding_cache_kv=embedding_cache_kv
-        )
+        self.entity_merge_threshold = entity_merge_threshold
+        self.relevance_threshold = relevance_threshold
+        self.embedding_timeout = embedding_timeout
+        self.mix_token_budget = mix_token_budget
+        self.coarse_dimensions = coarse_dimensions
+        self.coarse_candidates = coarse_candidates
 
         self.dimensions = dimensions or 1536
-        self.embeddings_db = embeddings_db or NanoVectorStore(EMBEDDINGS_DB, self.dimensions)
-        self.entities_db = entities_db or NanoVectorStore(ENTITIES_DB, self.dimensions)
-        self.relationships_db = relationships_db or NanoVectorStore(RELATIONSHIPS_DB, self.dimensions)
-
-        self.source_to_doc_kv = source_to_doc_kv or JsonKvStore(SOURCE_TO_DOC_ID_KV_PATH)
-        self.doc_to_source_kv = doc_to_source_kv or JsonKvStore(DOC_ID_TO_SOURCE_KV_PATH)
-        self.doc_to_excerpt_kv = doc_to_excerpt_kv or JsonKvStore(DOC_ID_TO_EXCERPT_KV_PATH)
-        self.excerpt_kv = excerpt_kv or JsonKvStore(EXCERPT_KV_PATH)
+        self.llm = llm or create_llm_backend(self.dimensions, query_cache_kv, embedding_cache_kv)
+
+        # Another corpus keeps the same store file names in its own data directory
+        if data_dir:
+            os.makedirs(data_dir, exist_ok=True)
+
+        def data_path(path):
+            return os.path.join(data_dir, os.path.basename(path)) if data_dir else path
+
+        def vector_store(path):
+            return NanoVectorStore(data_path(path), self.dimensions, coarse_dimensions, coarse_candidates)
+
+        def sharded_vector_store(path):
+            # The largest vector stores can be spread over worker processes, a directory of shards replaces the file
+            if vector_shards:
+                return ShardedVectorStore(
+                    os.path.splitext(data_path(path))[0],
+                    self.dimensions,
+                    vector_shards,
+                    coarse_dimensions,
+                    coarse_candidates
+                )
+            return vector_store(path)
+
+        self.input_docs_dir = input_docs_dir or INPUT_DOCS_DIR
+        self._generation = StoreGeneration({
+            "embeddings_db": embeddings_db or sharded_vector_store(EMBEDDINGS_DB),
+            "entities_db": entities_db or sharded_vector_store(ENTITIES_DB),
+            "relationships_db": relationships_db or sharded_vector_store(RELATIONSHIPS_DB),
+            "communities_db": communities_db or vector_store(COMMUNITIES_DB),
+            "source_to_doc_kv": source_to_doc_kv or JsonKvStore(data_path(SOURCE_TO_DOC_ID_KV_PATH)),
+            "doc_to_source_kv": doc_to_source_kv or JsonKvStore(data_path(DOC_ID_TO_SOURCE_KV_PATH)),
+            "doc_to_excerpt_kv": doc_to_excerpt_kv or JsonKvStore(data_path(DOC_ID_TO_EXCERPT_KV_PATH)),
+            "excerpt_kv": excerpt_kv or JsonKvStore(data_path(EXCERPT_KV_PATH)),
+            "community_kv": community_kv or JsonKvStore(data_path(COMMUNITY_KV_PATH)),
+            "consolidation_kv": consolidation_kv or JsonKvStore(data_path(CONSOLIDATION_KV_PATH)),
+            "entity_alias_kv": entity_alias_kv or JsonKvStore(data_path(ENTITY_ALIAS_KV_PATH)),
+            "graph": graph_db or NetworkXGraphStore(data_path(KG_DB)),
+            # An empty index is falsy, it has a length
+            "bm25_index": bm25_index if bm25_index is not None else Bm25Index(data_path(BM25_INDEX_PATH)),
+        }, snapshot=snapshot)
+        self._bm25_build_lock = asyncio.Lock()
+        self._embedding_check_lock = asyncio.Lock()
+        self._embedding_backend_checked = False
+        self._reindex_lock = asyncio.Lock()
+        self._checkpoint_lock = asyncio.Lock()
+
+    @classmethod
+    def from_snapshot(cls, path, **kwargs):
+        """
+        Opens a snapshot written by app.snapshot.export_snapshot. Its stores are memory-mapped and read-only, so the
+        instance can answer queries but not ingest documents.
+
+        :param path: Path of the snapshot file, or a directory written by publish_snapshot to open its current
+            generation.
+        :param kwargs: Any other SmolRag arguments, e.g. llm.
+        """
+        from app.snapshot import Snapshot, SnapshotError, get_current_snapshot
+        if os.path.isdir(path):
+            current = get_current_snapshot(path)
+            if current is None:
+                raise SnapshotError(f"No snapshot has been published to {path}")
+            path = current["path"]
+        snapshot = Snapshot(path)
+        stores = snapshot.get_stores(
+            kwargs.get("coarse_dimensions", COARSE_DIMENSIONS), kwargs.get("coarse_candidates", COARSE_CANDIDATES)
+        )
+        # The index is built from the snapshot, it never saves to the data directory
+        stores["bm25_index"] = kwargs.pop("bm25_index", Bm25Index())
+        return cls(snapshot=snapshot, dimensions=snapshot.manifest["dimensions"], **stores, **kwargs)
+
+    def use_snapshot(self, snapshot):
+        """
+        Switches every store to another snapshot, e.g. a newer generation. Queries already running finish on the old
+        snapshot, which is released once the last of them is done.
+        """
+        stores = snapshot.get_stores(self.coarse_dimensions, self.coarse_candidates)
+        stores["graph"] = stores.pop("graph_db")
+        stores["bm25_index"] = Bm25Index()
+        self._swap_generation(StoreGeneration(stores, self._generation.number + 1, snapshot))
+        logger.info(f"Switched to snapshot {snapshot.id}, generation {snapshot.generation}")
+
+    @property
+    def generation(self):
+        """The store generation read by the current query, or the live one outside of a query."""
+        return pinned_generations.get().get(id(self), self._generation)
+
+    @property
+    def snapshot(self):
+        return self.generation.snapshot
+
+    @contextlib.contextmanager
+    def _pin_generation(self, generation=None):
+        pinned = pinned_generations.get()
+        if generation is None and id(self) in pinned:
+            yield pinned[id(self)]
+            return
+        generation = generation or self._generation
+        generation.acquire()
+        token = pinned_generations.set({**pinned, id(self): generation})
+        try:
+            yield generation
+        finally:
+            pinned_generations.reset(token)
+            generation.release()
+
+    async def _build_context(self, get_context):
+        # Every store read while building one context comes from the same generation, even if a swap happens meanwhile
+        with self._pin_generation():
+            await self._check_embedding_backend()
+            return await get_context()
+
+    async def _check_embedding_backend(self):
+        """
+        Embeds one stored excerpt again and looks it up in the excerpt vectors, once, so a backend whose vectors don't
+        match the stored ones (e.g. the local backend over stores embedded with OpenAI) is refused rather than
+        answering from meaningless similarities.
+
+        :raises ValueError: If the vectors differ in dimensions or the excerpt isn't found.
+        """
+        if self._embedding_backend_checked:
+            return
+        async with self._embedding_check_lock:
+            if self._embedding_backend_checked:
+                return
+            excerpt_id = await self.embeddings_db.get_first_id()
+            excerpt = await self.excerpt_kv.get_by_key(excerpt_id) if excerpt_id is not None else None
+            # Empty stores are only ever filled by this backend
+            if excerpt:
+                embedding = await self.rate_limited_get_embedding(f"{excerpt['excerpt']}\n\n{excerpt['summary']}")
+                if len(embedding) != self.dimensions:
+                    raise ValueError(f"The llm backend embeds in {len(embedding)} dimensions, the vector stores hold "
+                                     f"{self.dimensions}")
+                results = await self.embeddings_db.query(np.array(embedding), top_k=1, better_than_threshold=None)
+                if results and results[0]["__metrics__"] < EMBEDDING_CHECK_THRESHOLD:
+                    raise ValueError("The vector stores were embedded with another model than the llm backend's, use "
+                                     "the backend they were built with or import the documents into a new data_dir")
+            self._embedding_backend_checked = True
+
+    def _swap_generation(self, generation):
+        old_generation, self._generation = self._generation, generation
+        old_generation.retire()
+        metrics.set_gauge("store_generation", generation.number)
+
+    async def reindex(self, ingest=None):
+        """
+        Blue/green ingestion. Copies the live stores into a staging generation, runs the ingestion against the copies
+        and swaps them in once it has finished, so queries keep reading a complete, unchanging set of stores
+        throughout. Queries still running on the old generation finish on it.
+
+        The staging stores save to a staging directory beside the live files and are renamed over them when the
+        generation is swapped in, so a failed or cancelled run leaves the files untouched as well. The next run
+        carries on from the staging stores it left behind instead, so the documents it had checkpointed are skipped.
+
+        :param ingest: Coroutine function run against the staging generation, defaults to ingest.
+        """
+        if self.snapshot is not None:
+            raise PermissionError("Snapshot stores are read-only, publish a new snapshot instead")
+        ingest = ingest or self.ingest
+        async with self._reindex_lock:
+            start_time = time.time()
+            live = self._generation
+            paths = self._get_store_paths()
+            staging = StoreGeneration(await self._get_staging_stores(live), live.number + 1)
+            staging.stores.setdefault("bm25_index", Bm25Index())
+
+            try:
+                with self._pin_generation(staging):
+                    await ingest()
+                    await self._get_bm25_index()
+                await asyncio.gather(*(staging.stores[name].save() for name in paths))
+            except BaseException:
+                # A failed or cancelled run never goes live, its stores are dropped straight away
+                staging.retire()
+                raise
+
+            # Only renames from here on, with nothing awaited, so the files are replaced together with the generation
+            for name, path in paths.items():
+                staging.stores[name].move(path)
+            self._remove_staging_dirs()
+            self._swap_generation(staging)
+            logger.info(f"Reindexed into store generation {staging.number} in {time.time() - start_time:.2f} seconds")
+
+    async def _get_staging_stores(self, live):
+        staging_paths = {name: get_staging_path(path) for name, path in self._get_store_paths().items()}
+        staging_dirs = {os.path.dirname(path) for path in staging_paths.values()}
+        if all(os.path.exists(os.path.join(staging_dir, STAGING_CHECKPOINT)) for staging_dir in staging_dirs):
+            logger.info("Resuming the staging stores of an interrupted reindex")
+            return {name: live.stores[name].reopen(path) for name, path in staging_paths.items()}
+
+        self._remove_staging_dirs()
+        for staging_dir in staging_dirs:
+            os.makedirs(staging_dir)
+        copies = await asyncio.gather(*(
+            asyncio.to_thread(live.stores[name].copy, path) for name, path in staging_paths.items()
+        ))
+        stores = dict(zip(staging_paths, copies))
+        # Every store is saved once up front, so a checkpoint is complete even for stores the ingestion never saves
+        await asyncio.gather(*(store.save() for store in stores.values()))
+        for staging_dir in staging_dirs:
+            with open(os.path.join(staging_dir, STAGING_CHECKPOINT), "w"):
+                pass
+        return stores
+
+    def _get_store_paths(self):
+        # A BM25 index without a file is rebuilt from the excerpts rather than saved
+        return {
+            name: get_store_path(store)
+            for name, store in self._generation.stores.items()
+            if name != "bm25_index" or store.file_path
+        }
 
-        self.graph = graph_db or NetworkXGraphStore(KG_DB)
+    def _remove_staging_dirs(self):
+        for staging_dir in {os.path.dirname(get_staging_path(path)) for path in self._get_store_paths().values()}:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _get_stores(self):
+        stores = {
+            "embeddings_db": self.embeddings_db,
+            "entities_db": self.entities_db,
+            "relationships_db": self.relationships_db,
+            "communities_db": self.communities_db,
+            "source_to_doc_kv": self.source_to_doc_kv,
+            "doc_to_source_kv": self.doc_to_source_kv,
+            "doc_to_excerpt_kv": self.doc_to_excerpt_kv,
+            "excerpt_kv": self.excerpt_kv,
+            "community_kv": self.community_kv,
+            "consolidation_kv": self.consolidation_kv,
+            "entity_alias_kv": self.entity_alias_kv,
+            "query_cache_kv": getattr(self.llm, "query_cache_kv", None),
+            "embedding_cache_kv": getattr(self.llm, "embedding_cache_kv", None),
+            "graph": self.graph,
+        }
+        return {name: store for name, store in stores.items() if store is not None}
+
+    def get_store_status(self):
+        """
+        Stores are read from disk on first use, so a fresh instance is cheap to create.
+
+        :return: Dict of store name to whether it has been loaded, including the BM25 index.
+        """
+        status = {name: getattr(store, "is_loaded", True) for name, store in self._get_stores().items()}
+        status["bm25_index"] = self.bm25_index.is_built
+        return status
+
+    def get_loaded_size(self):
+        """
+        Rough estimate of the memory held by the loaded stores in bytes, taken from the size of their files, or of
+        the shard files of a sharded vector store, held by its worker processes.
+        """
+        size = 0
+        for store in self.generation.stores.values():
+            path = getattr(store, "file_path", None) or getattr(store, "storage_file", None)
+            path = path or getattr(store, "storage_dir", None)
+            if not getattr(store, "is_loaded", False) or not path or not os.path.exists(path):
+                continue
+            if os.path.isdir(path):
+                size += sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            else:
+                size += os.path.getsize(path)
+        return size
+
+    def close(self):
+        """
+        Releases the stores once the queries reading them have finished, stopping the worker processes of sharded
+        vector stores. The instance must not be used afterwards.
+        """
+        self._generation.retire()
+
+    @property
+    def is_busy(self):
+        """Whether a query is reading the stores or an ingestion run is writing them."""
+        return self._generation.active_queries > 0 or self._reindex_lock.locked()
+
+    async def warm_up(self):
+        """
+        Loads every store in worker threads, builds the BM25 index and checks the llm backend embeds like the stored
+        vectors, so the first queries don't pay for it.
+        """
+        start_time = time.time()
+        stores = [store for store in self._get_stores().values() if not getattr(store, "is_loaded", True)]
+        await asyncio.gather(*(asyncio.to_thread(store.load) for store in stores))
+        await self._get_bm25_index()
+        await self._check_embedding_backend()
+        logger.info(f"Warm-up loaded {len(stores)} stores in {time.time() - start_time:.2f} seconds")
+
+    def _estimate_tokens(self, *texts):
+        tokens = estimate_tokens(*texts)
+        progress = ingestion_progress.get()
+        if progress:
+            progress.add_tokens(tokens)
+        return tokens
+
+    async def rate_limited_get_completion(self, query, **kwargs):
+        return await self.llm_scheduler.run(
+            kwargs.get("model") or COMPLETION_MODEL,
+            self._estimate_tokens(query, kwargs.get("context", "")),
+            lambda: self.llm.get_completion(query, **kwargs)
+        )
 
-    async def rate_limited_get_completion(self, *args, **kwargs):
-        async with self.llm_limiter:
-            return await self.llm.get_completion(*args, **kwargs)
+    async def rate_limited_get_completion_stream(self, query, **kwargs):
+        async for token in self.llm_scheduler.stream(
+                kwargs.get("model") or COMPLETION_MODEL,
+                self._estimate_tokens(query, kwargs.get("context", "")),
+                lambda: self.llm.get_completion_stream(query, **kwargs)
+        ):
+            yield token
+
+    async def rate_limited_get_embedding(self, content, **kwargs):
+        return await self.llm_scheduler.run(
+            kwargs.get("model") or EMBEDDING_MODEL,
+            self._estimate_tokens(content),
+            lambda: self.llm.get_embedding(content, **kwargs)
+        )
 
-    async def rate_limited_get_embedding(self, *args, **kwargs):
-        async with self.llm_limiter:
-            return await self.llm.get_embedding(*args, **kwargs)
+    async def rate_limited_get_embeddings(self, contents, **kwargs):
+        return await self.llm_scheduler.run(
+            kwargs.get("model") or EMBEDDING_MODEL,
+            self._estimate_tokens(*contents),
+            lambda: self.llm.get_embeddings(contents, **kwargs)
+        )
 
     async def remove_document_by_id(self, doc_id):
         if await self.doc_to_source_kv.has(doc_id):
@@ -81,42 +459,102 @@ class SmolRag:
             await asyncio.gather(self.doc_to_source_kv.save(), self.source_to_doc_kv.save())
         if await self.doc_to_excerpt_kv.has(doc_id):
             excerpt_ids = await self.doc_to_excerpt_kv.get_by_key(doc_id)
-            print(excerpt_ids)
-            excerpts_to_remove = [self.excerpt_kv.remove(excerpt_id) for excerpt_id in excerpt_ids]
-            await asyncio.gather(self.embeddings_db.delete(excerpt_ids), *excerpts_to_remove)
+            bm25_index = await self._get_bm25_index()
+            await asyncio.gather(
+                self.embeddings_db.delete(excerpt_ids),
+                self.excerpt_kv.remove_many(excerpt_ids),
+                bm25_index.remove_many(excerpt_ids),
+            )
             await self.doc_to_excerpt_kv.remove(doc_id)
-            await asyncio.gather(self.excerpt_kv.save(), self.doc_to_excerpt_kv.save())
+            await asyncio.gather(self.excerpt_kv.save(), self.doc_to_excerpt_kv.save(), bm25_index.save())
             await self.embeddings_db.save()
 
-    async def import_documents(self):
-        sources = get_docs(INPUT_DOCS_DIR)
-        tasks = []
+    async def ingest(self, paths=None):
+        """
+        Imports new and changed documents with import_documents, consolidates the descriptions they grew past the
+        token threshold and brings the community reports up to date with the knowledge graph. Descriptions and
+        communities that are unchanged since the last run are not summarised again.
+
+        :param paths: Files or directories to import, defaults to everything in input_docs_dir.
+        :return: Dict of the path of each document that failed to import to its error.
+        """
+        failures = await self.import_documents(paths)
+        await self.consolidate_descriptions()
+        await self.build_communities()
+        return failures
+
+    @writes_stores
+    @ingestion_priority
+    async def import_documents(self, paths=None):
+        """
+        Imports new and changed documents. A document is checkpointed once it has been fully imported: the stores are
+        saved first and only then is it recorded in the document maps, so an interrupted run is resumed by running it
+        again, which only redoes the documents that were not finished, with their LLM calls answered by the cache.
+        A document that fails to import is logged and left for the next run without stopping the others.
+
+        :param paths: Files or directories to import, defaults to everything in input_docs_dir.
+        :return: Dict of the path of each document that failed to import to its error.
+        """
+        sources = [
+            source
+            for path in paths or [self.input_docs_dir]
+            for source in (get_docs(path) if os.path.isdir(path) else [path])
+        ]
+        documents = []
         for source in sources:
             content = read_file(source)
             doc_id = make_hash(content, "doc_")
             if not await self.source_to_doc_kv.has(source):
                 logger.info(f"Importing new document: {source} (ID: {doc_id})")
-                tasks.append(self._add_document_maps(source, content))
-                tasks.append(self._embed_document(content, doc_id))
-                tasks.append(self._extract_entities(content, doc_id))
+                documents.append((source, content, doc_id, None))
             elif not await self.source_to_doc_kv.equal(source, doc_id):
                 logger.info(f"Updating document: {source} (New ID: {doc_id})")
-                old_doc_id = await self.source_to_doc_kv.get_by_key(source)
-                tasks.append(self.remove_document_by_id(old_doc_id))
-                tasks.append(self._add_document_maps(source, content))
-                tasks.append(self._embed_document(content, doc_id))
-                tasks.append(self._extract_entities(content, doc_id))
+                documents.append((source, content, doc_id, await self.source_to_doc_kv.get_by_key(source)))
             else:
                 logger.debug(f"No changes detected for document: {source} (ID: {doc_id})")
 
-        await asyncio.gather(*tasks)
-
-    async def _add_document_maps(self, source, content):
-        doc_id = make_hash(content, "doc_")
-        await self.source_to_doc_kv.add(source, doc_id)
-        await self.doc_to_source_kv.add(doc_id, source)
-        await self.source_to_doc_kv.save()
-        await self.doc_to_source_kv.save()
+        if documents:
+            await self._check_embedding_backend()
+        progress = ingestion_progress.get()
+        if progress:
+            progress.start(len(documents), len(sources) - len(documents))
+        finished = []
+        failures = await asyncio.gather(*(self._import_document(*document, finished) for document in documents))
+        return {source: error for (source, *_), error in zip(documents, failures) if error is not None}
+
+    async def _import_document(self, source, content, doc_id, old_doc_id, finished):
+        progress = ingestion_progress.get()
+        try:
+            if old_doc_id is not None:
+                await self.remove_document_by_id(old_doc_id)
+            await asyncio.gather(self._embed_document(content, doc_id), self._extract_entities(content, doc_id))
+            finished.append((source, doc_id))
+            await self._checkpoint_documents(finished)
+        except Exception as e:
+            logger.error(f"Failed to import document {source}: {e}")
+            if progress:
+                progress.fail_document(source)
+            return str(e)
+        if progress:
+            progress.finish_document()
+
+    async def _checkpoint_documents(self, finished):
+        # Documents finishing while a checkpoint is being written are recorded together by the next one
+        async with self._checkpoint_lock:
+            if not finished:
+                return
+            documents = finished[:]
+            finished.clear()
+            await asyncio.gather(
+                self.entities_db.save(),
+                self.relationships_db.save(),
+                self.entity_alias_kv.save(),
+                self.graph.save()
+            )
+            await self.source_to_doc_kv.add_many(dict(documents))
+            await self.doc_to_source_kv.add_many({doc_id: source for source, doc_id in documents})
+            await asyncio.gather(self.source_to_doc_kv.save(), self.doc_to_source_kv.save())
+            logger.info(f"Checkpointed {len(documents)} imported documents")
 
     async def _embed_document(self, content, doc_id):
         start_time = time.time()
@@ -131,33 +569,41 @@ class SmolRag:
             embedding_content = f"{excerpt}\n\n{summary}"
             embedding_tasks.append(self.rate_limited_get_embedding(embedding_content))
         embedding_results = await asyncio.gather(*embedding_tasks)
-        storage_tasks = []
+        rows = []
+        excerpt_data = {}
         for i, (excerpt, summary, embedding_result) in enumerate(zip(excerpts, summaries, embedding_results)):
             excerpt_id = make_hash(excerpt, "excerpt_id_")
             excerpt_ids.append(excerpt_id)
             vector = np.array(embedding_result, dtype=np.float32)
-            storage_tasks.append(self.embeddings_db.upsert([
-                {
-                    "__id__": excerpt_id,
-                    "__vector__": vector,
-                    "__doc_id__": doc_id,
-                    "__inserted_at__": time.time()
-                }
-            ]))
-            storage_tasks.append(self.excerpt_kv.add(excerpt_id, {
+            rows.append({
+                "__id__": excerpt_id,
+                "__vector__": vector,
+                "__doc_id__": doc_id,
+                "__inserted_at__": time.time()
+            })
+            excerpt_data[excerpt_id] = {
                 "doc_id": doc_id,
                 "doc_order_index": i,
                 "excerpt": excerpt,
                 "summary": summary,
                 "indexed_at": time.time()
-            }))
+            }
             logger.info(f"Created embedding for excerpt {excerpt_id} associated with document {doc_id}")
-        await asyncio.gather(*storage_tasks)
+        # Built first, so the index saved with the excerpts is never missing the documents imported before
+        bm25_index = await self._get_bm25_index()
+        await asyncio.gather(
+            self.embeddings_db.upsert(rows),
+            self.excerpt_kv.add_many(excerpt_data),
+            bm25_index.add_many({excerpt_id: data["excerpt"] for excerpt_id, data in excerpt_data.items()}),
+        )
 
-        await self.excerpt_kv.save()
+        await asyncio.gather(self.excerpt_kv.save(), bm25_index.save())
         await self.embeddings_db.save()
         await self.doc_to_excerpt_kv.add(doc_id, excerpt_ids)
         await self.doc_to_excerpt_kv.save()
+        progress = ingestion_progress.get()
+        if progress:
+            progress.add_excerpts(len(excerpts))
         elapsed = time.time() - start_time
         logger.info(f"Document {doc_id} processed with {len(excerpts)} excerpts in {elapsed:.2f} seconds.")
 
@@ -172,10 +618,13 @@ class SmolRag:
 
     async def _extract_entities(self, content, doc_id):
         start_time = time.time()
-        total_entities = 0
-        total_relationships = 0
         excerpts = self.excerpt_fn(content, self.excerpt_size, self.overlap)
 
+        entities = []
+        relationships = []
+        # Vectors requested for entity merging, a new entity's text is the one it is embedded with after the merge
+        embeddings = {}
+
         extract_entity_tasks = [self.rate_limited_get_completion(get_extract_entities_prompt(excerpt)) for excerpt in
                                 excerpts]
         entity_results = await asyncio.gather(*extract_entity_tasks)
@@ -192,10 +641,6 @@ class SmolRag:
                 clean_records.append(clean_str(record))
             records = clean_records
 
-            tasks = []
-            entities_to_upsert = []
-            relationships_to_upsert = []
-
             for record in records:
                 fields = split_string_by_multi_markers(record, [TUPLE_SEP])
                 if not fields:
@@ -206,190 +651,986 @@ class SmolRag:
                 if record_type == 'entity':
                     if len(fields) >= 4:
                         _, name, category, description = fields[:4]
-                        existing_node = self.graph.get_node(name)
-                        if existing_node:
-                            existing_descriptions = split_string_by_multi_markers(existing_node["description"],
-                                                                                  [KG_SEP])
-                            descriptions = KG_SEP.join(set(list(existing_descriptions) + [description]))
-                            existing_categories = split_string_by_multi_markers(existing_node["category"], [KG_SEP])
-                            # Todo: figure out how to reduce to a single category for a given entity name, probably something for an LLM
-                            categories = KG_SEP.join(set(list(existing_categories) + [category]))
-                            existing_excerpt_ids = split_string_by_multi_markers(existing_node["excerpt_id"], [KG_SEP])
-                            excerpt_ids = KG_SEP.join(set(list(existing_excerpt_ids) + [excerpt_id]))
-                            # Todo: summarise descriptions with LLM query if they get too long
-                            self.graph.add_node(
-                                name,
-                                category=categories,
-                                description=descriptions,
-                                excerpt_id=excerpt_ids
-                            )
-                        else:
-                            self.graph.add_node(name, category=category, description=description, excerpt_id=excerpt_id)
-                        total_entities += 1
-                        entity_id = make_hash(name, prefix="ent-")
-                        embedding_content = f"{name} {description}"
-                        tasks.append(self.rate_limited_get_embedding(embedding_content))
-                        entities_to_upsert.append({
-                            "__id__": entity_id,
-                            "__entity_name__": name,
-                            "__inserted_at__": time.time(),
-                        })
+                        name = await self._resolve_entity_name(
+                            name, self._get_entity_embedding_content(name, {"description": description}), embeddings
+                        )
+                        # Todo: figure out how to reduce to a single category for a given entity name, probably something for an LLM
+                        entities.append((name, {
+                            "category": category,
+                            "description": description,
+                            "excerpt_id": excerpt_id
+                        }))
                 elif record_type == 'relationship':
                     if len(fields) >= 6:
                         _, source, target, description, keywords, weight = fields[:6]
+                        source = await self._resolve_entity_name(source)
+                        target = await self._resolve_entity_name(target)
+                        if source == target:
+                            continue
                         source, target = sorted([source, target])
-                        # Todo: summarise descriptions with LLM query if they get too long
-                        existing_edge = self.graph.get_edge((source, target))
                         weight = float(weight) if is_float_regex(weight) else 1.0
-                        if existing_edge:
-                            existing_descriptions = split_string_by_multi_markers(existing_edge["description"],
-                                                                                  [KG_SEP])
-                            descriptions = KG_SEP.join(set(list(existing_descriptions) + [description]))
-                            existing_keywords = split_string_by_multi_markers(existing_edge["keywords"], [KG_SEP])
-                            keywords = KG_SEP.join(set(list(existing_keywords) + [keywords]))
-                            existing_excerpt_ids = split_string_by_multi_markers(existing_edge["excerpt_id"], [KG_SEP])
-                            excerpt_ids = KG_SEP.join(set(list(existing_excerpt_ids) + [excerpt_id]))
-                            weight = sum([weight, existing_edge["weight"]])
-                            self.graph.add_edge(source, target, description=descriptions, keywords=keywords,
-                                                weight=weight,
-                                                excerpt_id=excerpt_ids)
-                        else:
-                            self.graph.add_edge(source, target, description=description, keywords=keywords,
-                                                weight=weight,
-                                                excerpt_id=excerpt_id)
-                        total_relationships += 1
-
-                        relationship_id = make_hash(f"{source}_{target}", prefix="ent-")
-                        embedding_content = f"{keywords} {source} {target} {description}"
-                        tasks.append(self.rate_limited_get_embedding(embedding_content))
-                        relationships_to_upsert.append({
-                            "__id__": relationship_id,
-                            "__source__": source,
-                            "__target__": target,
-                            "__inserted_at__": time.time(),
-                        })
+                        relationships.append(((source, target), {
+                            "description": description,
+                            "keywords": keywords,
+                            "weight": weight,
+                            "excerpt_id": excerpt_id
+                        }))
                 elif record_type == 'content_keywords':
                     if len(fields) >= 2:
                         # Todo: figure out what these are for, we're overwriting them each time
-                        self.graph.set_field('content_keywords', fields[1])
+                        await self.graph.set_field('content_keywords', fields[1])
 
-            results = await asyncio.gather(*tasks)
+        await self.graph.merge_batch(entities, relationships)
+        embedded_entities, embedded_relationships = await self._embed_graph_items(
+            list(dict.fromkeys(name for name, _ in entities)),
+            list(dict.fromkeys(edge for edge, _ in relationships)),
+            embeddings
+        )
 
-            idx = 0
-            for entity in entities_to_upsert:
-                vector = np.array(results[idx], dtype=np.float32)
-                entity["__vector__"] = vector
-                idx += 1
+        elapsed = time.time() - start_time
+        logger.info(f"Extracted {len(entities)} entities and {len(relationships)} relationships "
+                    f"from document {doc_id} in {elapsed:.2f} seconds, re-embedded {embedded_entities} entities "
+                    f"and {embedded_relationships} relationships.")
+
+    def _get_entity_embedding_content(self, name, data):
+        return f"{name} {data.get('description', '')}"
+
+    def _get_relationship_embedding_content(self, source, target, data):
+        return f"{data.get('keywords', '')} {source} {target} {data.get('description', '')}"
+
+    async def _embed_graph_items(self, entity_names, relationships, embeddings=None):
+        items = []
+        for name in entity_names:
+            data = self.graph.get_node(name)
+            if data is not None:
+                items.append((name, data, self._get_entity_embedding_content(name, data)))
+        for source, target in relationships:
+            data = self.graph.get_edge((source, target))
+            if data is not None:
+                items.append(((source, target), data, self._get_relationship_embedding_content(source, target, data)))
+
+        items = [
+            (key, content, make_hash(content, "cnt-"))
+            for key, data, content in items
+            if data.get("content_hash") != make_hash(content, "cnt-")
+        ]
+        unique_contents = list(dict.fromkeys(content for _, content, _ in items))
+        embeddings = dict(embeddings or {})
+        contents_to_embed = [content for content in unique_contents if content not in embeddings]
+        embedding_results = await asyncio.gather(*[
+            self.rate_limited_get_embedding(content) for content in contents_to_embed
+        ])
+        embeddings.update(zip(contents_to_embed, embedding_results))
+
+        entities_to_upsert = []
+        relationships_to_upsert = []
+        entity_hashes = []
+        relationship_hashes = []
+        for key, content, content_hash in items:
+            # Another document may have merged into this item while we were embedding, its task embeds the newer text
+            if isinstance(key, str):
+                data = self.graph.get_node(key)
+                current_content = data is not None and self._get_entity_embedding_content(key, data)
+            else:
+                data = self.graph.get_edge(key)
+                current_content = data is not None and self._get_relationship_embedding_content(*key, data)
+            if current_content != content:
+                continue
 
-            for relation in relationships_to_upsert:
-                vector = np.array(results[idx], dtype=np.float32)
-                relation["__vector__"] = vector
-                idx += 1
+            vector = np.array(embeddings[content], dtype=np.float32)
+            if isinstance(key, str):
+                entity_hashes.append((key, {"content_hash": content_hash}))
+                entities_to_upsert.append({
+                    "__id__": make_hash(key, prefix="ent-"),
+                    "__entity_name__": key,
+                    "__inserted_at__": time.time(),
+                    "__vector__": vector,
+                })
+            else:
+                source, target = key
+                relationship_hashes.append((key, {"content_hash": content_hash}))
+                relationships_to_upsert.append({
+                    "__id__": make_hash(f"{source}_{target}", prefix="ent-"),
+                    "__source__": source,
+                    "__target__": target,
+                    "__inserted_at__": time.time(),
+                    "__vector__": vector,
+                })
 
-            await asyncio.gather(self.entities_db.upsert(entities_to_upsert), self.relationships_db.upsert(relationships_to_upsert))
+        await self.graph.update_batch(entity_hashes, relationship_hashes)
+        await asyncio.gather(
+            self.entities_db.upsert(entities_to_upsert),
+            self.relationships_db.upsert(relationships_to_upsert)
+        )
+        logger.info(f"Embedded {len(contents_to_embed)} unique texts for {len(items)} changed graph items.")
+        return len(entities_to_upsert), len(relationships_to_upsert)
+
+    async def _resolve_entity_name(self, name, embedding_content=None, embeddings=None):
+        key = normalize_entity_name(name)
+        if not key:
+            return name
+        canonical_name = await self.entity_alias_kv.get_by_key(key)
+        if canonical_name is not None:
+            return canonical_name
+
+        canonical_name = name
+        if self.entity_merge_threshold is not None and embedding_content is not None:
+            embedding = await self.rate_limited_get_embedding(embedding_content)
+            if embeddings is not None:
+                embeddings[embedding_content] = embedding
+            results = await self.entities_db.query(
+                query=np.array(embedding),
+                top_k=1,
+                better_than_threshold=self.entity_merge_threshold
+            )
+            if results:
+                canonical_name = results[0]["__entity_name__"]
+                logger.info(f"Merging entity {name} into similar entity {canonical_name}")
+        # Another document may have recorded the key while we were embedding, the first name recorded wins
+        return await self.entity_alias_kv.setdefault(key, canonical_name)
+
+    @writes_stores
+    @ingestion_priority
+    async def migrate_entity_aliases(self):
+        start_time = time.time()
+        groups = {}
+        for name, _ in self.graph.get_nodes():
+            groups.setdefault(normalize_entity_name(name), []).append(name)
+
+        aliases = {}
+        merged_names = []
+        entities_to_embed = set()
+        relationships_to_embed = set()
+        stale_relationship_ids = []
+        for key, names in groups.items():
+            canonical_name = max(names, key=lambda n: (self.graph.degree(n), n))
+            aliases[key] = canonical_name
+            if len(names) == 1:
+                continue
+            for name in names:
+                if name == canonical_name:
+                    continue
+                await self._merge_node_into(name, canonical_name, relationships_to_embed, stale_relationship_ids)
+                merged_names.append(name)
+            entities_to_embed.add(canonical_name)
+
+        await self.entity_alias_kv.add_many(aliases)
+        await self.entities_db.delete([make_hash(name, prefix="ent-") for name in merged_names])
+        await self.relationships_db.delete(stale_relationship_ids)
+
+        relationships = [edge for edge in relationships_to_embed if self.graph.get_edge(edge)]
+        await self._embed_graph_items(list(entities_to_embed), relationships)
+
+        await asyncio.gather(
+            self.entities_db.save(),
+            self.relationships_db.save(),
+            self.entity_alias_kv.save(),
+            self.graph.save()
+        )
+        elapsed = time.time() - start_time
+        logger.info(f"Merged {len(merged_names)} entity name variants into {len(entities_to_embed)} entities "
+                    f"in {elapsed:.2f} seconds.")
+
+    async def _merge_node_into(self, name, canonical_name, relationships_to_embed, stale_relationship_ids):
+        node_fields = ("category", "description", "excerpt_id")
+        edge_fields = ("description", "keywords", "weight", "excerpt_id")
+        node = self.graph.get_node(name)
+        entities = [(canonical_name, {field: node[field] for field in node_fields if field in node})]
+
+        relationships = []
+        for _, neighbour in list(self.graph.get_node_edges(name)):
+            edge = self.graph.get_edge((name, neighbour))
+            stale_relationship_ids.append(make_hash("_".join(sorted([name, neighbour])), prefix="ent-"))
+            if neighbour == canonical_name:
+                continue
+            source, target = sorted([canonical_name, neighbour])
+            relationships.append(((source, target), {field: edge[field] for field in edge_fields if field in edge}))
+            relationships_to_embed.add((source, target))
+
+        await self.graph.merge_batch(entities, relationships)
+        await self.graph.remove_node(name)
 
-        await asyncio.gather(self.entities_db.save(), self.relationships_db.save())
+    @writes_stores
+    @ingestion_priority
+    async def consolidate_descriptions(self, max_token_size=500, batch_size=20):
+        start_time = time.time()
+        consolidated = await self.consolidation_kv.get_all()
+
+        candidates = []
+        for name, data in self.graph.get_nodes():
+            candidates.append((make_hash(name, prefix="ent-"), name, data))
+        for source, target, data in self.graph.get_edges():
+            source, target = sorted([source, target])
+            # A prefix of their own, so an entity named "A_B" and the relationship of A and B are recorded apart
+            candidates.append((make_hash(f"{source}_{target}", prefix="rel-"), (source, target), data))
+
+        dirty = []
+        for item_id, key, data in candidates:
+            description = data.get("description", "")
+            if consolidated.get(item_id) == make_hash(description, "cnt-"):
+                continue
+            if len(get_encoded_tokens(description)) <= max_token_size:
+                continue
+            dirty.append((item_id, key, data))
+        logger.info(f"Found {len(dirty)} descriptions above {max_token_size} tokens to consolidate.")
+
+        total = 0
+        for i in range(0, len(dirty), batch_size):
+            batch = dirty[i:i + batch_size]
+            results = await asyncio.gather(*[self._consolidate_description(*item) for item in batch])
+            embedded_entities, embedded_relationships = await self._embed_graph_items(
+                [key for key in results if isinstance(key, str)],
+                [key for key in results if isinstance(key, tuple)]
+            )
+            await asyncio.gather(
+                self.entities_db.save(),
+                self.relationships_db.save(),
+                self.consolidation_kv.save(),
+                self.graph.save()
+            )
+            total += embedded_entities + embedded_relationships
 
-        self.graph.save()
         elapsed = time.time() - start_time
-        logger.info(f"Extracted {total_entities} entities and {total_relationships} relationships "
-                    f"from document {doc_id} in {elapsed:.2f} seconds.")
+        logger.info(f"Consolidated {total} of {len(dirty)} descriptions in {elapsed:.2f} seconds.")
+
+    async def _consolidate_description(self, item_id, key, data):
+        name = key if isinstance(key, str) else f"{key[0]} -> {key[1]}"
+        descriptions = split_string_by_multi_markers(data["description"], [KG_SEP])
+        prompt = get_consolidate_description_prompt(name, descriptions)
+        try:
+            description = (await self.rate_limited_get_completion(prompt)).strip()
+        except Exception as e:
+            logger.error(f"LLM call in _consolidate_description failed: {e}")
+            return None
+
+        if isinstance(key, str):
+            await self.graph.update_batch(entities=[(key, {"description": description})])
+        else:
+            await self.graph.update_batch(relationships=[(key, {"description": description})])
+        await self.consolidation_kv.add(item_id, make_hash(description, "cnt-"))
+        return key
+
+    @writes_stores
+    @ingestion_priority
+    async def build_communities(self, resolution=1.0, min_community_size=2):
+        start_time = time.time()
+        communities = [
+            names for names in self.graph.get_communities(resolution=resolution)
+            if len(names) >= min_community_size
+        ]
+        community_ids = [make_hash(KG_SEP.join(names), "community-") for names in communities]
+        community_contexts = [self._get_community_summary_context(names) for names in communities]
+
+        existing = await self.community_kv.get_all()
+        stale_ids = [community_id for community_id in existing if community_id not in community_ids]
+        if stale_ids:
+            await asyncio.gather(self.communities_db.delete(stale_ids), self.community_kv.remove_many(stale_ids))
+
+        to_summarise = []
+        for community_id, names, context in zip(community_ids, communities, community_contexts):
+            content_hash = make_hash(context, "cnt-")
+            if community_id in existing and existing[community_id]["content_hash"] == content_hash:
+                continue
+            to_summarise.append((community_id, names, context, content_hash))
+
+        summary_tasks = [self._get_community_summary(context) for _, _, context, _ in to_summarise]
+        summaries = await asyncio.gather(*summary_tasks)
+        to_embed = [(item, summary) for item, summary in zip(to_summarise, summaries) if summary is not None]
+        embedding_results = await asyncio.gather(*[self.rate_limited_get_embedding(summary) for _, summary in to_embed])
+
+        rows = []
+        community_data = {}
+        for ((community_id, names, _, content_hash), summary), embedding_result in zip(to_embed, embedding_results):
+            rows.append({
+                "__id__": community_id,
+                "__vector__": np.array(embedding_result, dtype=np.float32),
+                "__inserted_at__": time.time(),
+            })
+            community_data[community_id] = {
+                "entities": names,
+                "summary": summary,
+                "content_hash": content_hash,
+                "indexed_at": time.time(),
+            }
+        await asyncio.gather(self.communities_db.upsert(rows), self.community_kv.add_many(community_data))
+        await asyncio.gather(self.communities_db.save(), self.community_kv.save())
+
+        elapsed = time.time() - start_time
+        logger.info(f"Built {len(communities)} communities, summarised {len(rows)} and removed {len(stale_ids)} "
+                    f"in {elapsed:.2f} seconds.")
+
+    def _get_community_summary_context(self, names):
+        entities = sorted(
+            [(name, self.graph.get_node(name) or {}, self.graph.degree(name)) for name in names],
+            key=lambda x: x[2],
+            reverse=True,
+        )
+        entities = truncate_list_by_token_size(
+            entities,
+            get_text_for_row=lambda x: x[1].get("description", ""),
+            max_token_size=4000,
+        )
+        entity_csv = [["entity", "type", "description", "rank"]]
+        for name, data, degree in entities:
+            entity_csv.append([name, data.get("category", "UNKNOWN"), data.get("description", "UNKNOWN"), degree])
+
+        # Edge ends come back in either order, so they are sorted for an unchanged community to keep its content hash
+        edges = sorted(
+            ((*sorted([source, target]), data) for source, target, data in self.graph.get_community_edges(names)),
+            key=lambda x: (-x[2].get("weight", 0), x[0], x[1]),
+        )
+        edges = truncate_list_by_token_size(
+            edges,
+            get_text_for_row=lambda x: x[2].get("description", ""),
+            max_token_size=4000,
+        )
+        relation_csv = [["source", "target", "description", "keywords", "weight"]]
+        for source, target, data in edges:
+            relation_csv.append([
+                source,
+                target,
+                data.get("description", "UNKNOWN"),
+                data.get("keywords", ""),
+                data.get("weight", 1.0),
+            ])
+
+        return inspect.cleandoc(f"""
+            -----Entities-----
+            ```csv
+            {list_of_list_to_csv(entity_csv)}
+            ```
+            -----Relationships-----
+            ```csv
+            {list_of_list_to_csv(relation_csv)}
+            ```
+        """)
+
+    async def _get_community_summary(self, context):
+        prompt = get_community_summary_prompt(context)
+        try:
+            return await self.rate_limited_get_completion(prompt)
+        except Exception as e:
+            logger.error(f"LLM call in _get_community_summary failed: {e}")
+            return None
 
-    async def query(self, text, use_cache=True):
+    async def query(self, text, use_cache=True, timings=None, filter=None):
+        """
+        :param filter: Optional dict restricting the excerpts searched, see _get_vector_filter.
+        """
         logger.info(f"Received query: {text}")
-        excerpts = await self._get_query_excerpts(text)
+        timings = timings or Timings()
+        return await self._single_flight_query(
+            "standard", text, use_cache, timings,
+            lambda: self._get_standard_context(text, timings, filter),
+            filter
+        )
+
+    async def query_stream(self, text, use_cache=True, timings=None, filter=None):
+        logger.info(f"Received streaming query: {text}")
+        timings = timings or Timings()
+        context = await self._build_context(lambda: self._get_standard_context(text, timings, filter))
+        return self._stream_query_completion("standard", text, context, use_cache, timings)
+
+    async def hybrid_query(self, text, use_cache=True, timings=None, filter=None):
+        """
+        :param filter: Optional dict restricting the excerpts searched, see _get_vector_filter.
+        """
+        logger.info(f"Received hybrid query: {text}")
+        timings = timings or Timings()
+        return await self._single_flight_query(
+            "hybrid", text, use_cache, timings,
+            lambda: self._get_hybrid_context(text, timings, filter),
+            filter
+        )
+
+    async def hybrid_query_stream(self, text, use_cache=True, timings=None, filter=None):
+        logger.info(f"Received streaming hybrid query: {text}")
+        timings = timings or Timings()
+        context = await self._build_context(lambda: self._get_hybrid_context(text, timings, filter))
+        return self._stream_query_completion("hybrid", text, context, use_cache, timings)
+
+    async def get_context(self, text, query_type="standard", use_cache=True, local_keywords=False, timings=None,
+                          filter=None):
+        logger.info(f"Received {query_type} context request: {text}")
+        timings = timings or Timings()
+        if filter and query_type not in FILTERABLE_QUERY_TYPES:
+            raise ValueError(f"filter is only supported for {' and '.join(FILTERABLE_QUERY_TYPES)} queries")
+        context_builders = {
+            "standard": lambda: self._get_standard_context(text, timings, filter),
+            "hybrid": lambda: self._get_hybrid_context(text, timings, filter),
+            "hybrid_kg": lambda: self._get_kg_context(text, use_cache, timings, True, True, local_keywords),
+            "local_kg": lambda: self._get_kg_context(text, use_cache, timings, True, False, local_keywords),
+            "global_kg": lambda: self._get_kg_context(text, use_cache, timings, False, True, local_keywords),
+            "mix": lambda: self._get_mix_context(text, use_cache, timings, local_keywords),
+            "community": lambda: self._get_community_context(text, timings),
+        }
+        if query_type not in context_builders:
+            raise ValueError(f"Invalid query_type: {query_type}. Valid types are: {', '.join(context_builders)}")
+
+        context = await self._build_context(context_builders[query_type])
+        logger.info(f"Context timings: {timings}")
+        return {
+            "query_type": query_type,
+            "data": self._serialise_context_data(context["data"]),
+            "context": context["context"],
+            "system_prompt": context["system_prompt"],
+            "top_score": self._get_context_top_score(context),
+            "timings": timings.to_dict(),
+        }
+
+    def _serialise_context_data(self, data):
+        fields = {
+            "excerpts": ("id", "doc_id", "excerpt", "summary", "score"),
+            "entities": ("entity_name", "category", "description", "rank", "score"),
+            "relationships": ("src_tgt", "description", "keywords", "weight", "rank", "score"),
+            "communities": ("id", "entities", "summary", "score"),
+        }
+        serialised = {}
+        for key, value in data.items():
+            if isinstance(value, dict):
+                serialised[key] = self._serialise_context_data(value)
+            else:
+                serialised[key] = [{field: row.get(field) for field in fields[key] if field in row} for row in value]
+        return serialised
+
+    async def query_many(self, texts, query_type="standard", use_cache=True, max_concurrency=8, filter=None):
+        logger.info(f"Received batch of {len(texts)} {query_type} queries")
+        if filter and query_type not in FILTERABLE_QUERY_TYPES:
+            raise ValueError(f"filter is only supported for {' and '.join(FILTERABLE_QUERY_TYPES)} queries")
+        query_funcs = {
+            "hybrid": self.hybrid_query,
+            "hybrid_kg": self.hybrid_kg_query,
+            "local_kg": self.local_kg_query,
+            "global_kg": self.global_kg_query,
+            "mix": self.mix_query,
+            "community": self.community_query,
+        }
+        if query_type != "standard" and query_type not in query_funcs:
+            raise ValueError(f"Invalid query_type: {query_type}. Valid types are: standard, {', '.join(query_funcs)}")
+
+        timings = Timings()
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        if query_type == "standard":
+            try:
+                all_excerpts = await timings.run(
+                    "excerpt_search", self._build_context(lambda: self._get_query_excerpts_many(texts, filter))
+                )
+            except Exception as e:
+                logger.error(f"Batch excerpt search failed: {e}")
+                all_excerpts = [e] * len(texts)
+
+            async def run_query(index):
+                if isinstance(all_excerpts[index], Exception):
+                    raise all_excerpts[index]
+                context = self._get_standard_context_from_excerpts(all_excerpts[index])
+                async with semaphore:
+                    return await self._get_query_completion("standard", texts[index], context, use_cache, Timings())
+        else:
+            async def run_query(index):
+                async with semaphore:
+                    kwargs = {"filter": filter} if filter else {}
+                    return await query_funcs[query_type](texts[index], use_cache=use_cache, **kwargs)
+
+        with timings.measure("completions"):
+            results = await asyncio.gather(*(run_query(i) for i in range(len(texts))), return_exceptions=True)
+        logger.info(f"Batch query timings: {timings}")
+
+        return [
+            {"error": str(result)} if isinstance(result, Exception) else {"result": result}
+            for result in results
+        ]
+
+    async def _get_standard_context(self, text, timings, filter=None):
+        excerpts = await timings.run("excerpt_search", self._get_query_excerpts(text, filter))
+        return self._get_standard_context_from_excerpts(excerpts)
+
+    def _get_standard_context_from_excerpts(self, excerpts):
         logger.info(f"Retrieved {len(excerpts)} excerpts for the query.")
         excerpt_context = self._get_excerpt_context(excerpts)
-        system_prompt = get_query_system_prompt(excerpt_context)
+        return {
+            "data": {"excerpts": excerpts},
+            "context": excerpt_context,
+            "system_prompt": get_query_system_prompt(excerpt_context),
+        }
 
-        return await self.rate_limited_get_completion(text, context=system_prompt.strip(), use_cache=use_cache)
+    async def _get_hybrid_context(self, text, timings, filter=None):
+        excerpts, lexical_fallback = await timings.run("excerpt_search", self._get_hybrid_excerpts(text, filter))
+        return {**self._get_standard_context_from_excerpts(excerpts), "lexical_fallback": lexical_fallback}
+
+    async def _get_hybrid_excerpts(self, text, filter=None, top_k=5, candidates=20):
+        # The lexical leg needs no network call, so it still answers when the embedding service is slow or down
+        bm25_index = await self._get_bm25_index()
+        vector_filter = await self._get_vector_filter(filter)
+        excerpt_ids = None if vector_filter is None else set(await self.embeddings_db.get_ids(vector_filter))
+        lexical_results, vector_results = await asyncio.gather(
+            bm25_index.query(text, top_k=candidates, ids=excerpt_ids),
+            self._get_vector_results_within_timeout(text, candidates, vector_filter),
+        )
+        vector_scores = {result["__id__"]: result["__metrics__"] for result in vector_results or []}
+        fused = reciprocal_rank_fusion([
+            [result["__id__"] for result in vector_results or []],
+            [result["__id__"] for result in lexical_results],
+        ])[:top_k]
+        results = [{"__id__": excerpt_id} for excerpt_id, _ in fused]
+        for result in results:
+            if result["__id__"] in vector_scores:
+                result["__metrics__"] = vector_scores[result["__id__"]]
+        excerpt_ids = [result["__id__"] for result in results]
+        excerpt_lookup = dict(zip(excerpt_ids, await self.excerpt_kv.get_many(excerpt_ids)))
+        logger.info(f"Hybrid search fused {len(vector_scores)} vector and {len(lexical_results)} lexical results.")
+        return self._get_excerpts_from_results(results, excerpt_lookup), vector_results is None
+
+    async def _get_vector_results_within_timeout(self, text, top_k, vector_filter=None):
+        try:
+            embedding = await asyncio.wait_for(self.rate_limited_get_embedding(text), self.embedding_timeout)
+        except Exception as e:
+            logger.warning(f"Query embedding failed or took longer than {self.embedding_timeout} seconds, "
+                           f"falling back to lexical search: {e!r}")
+            metrics.increment("hybrid_search.lexical_fallback")
+            return None
+        return await self.embeddings_db.query(
+            query=np.array(embedding), top_k=top_k, better_than_threshold=0.02, filter=vector_filter
+        )
 
-    def _get_excerpt_context(self, excerpts):
-        context = ""
-        for excerpt in excerpts:
-            context += inspect.cleandoc(f"""
-                ## Excerpt
-    
-                {excerpt["excerpt"]}
-    
-                ## Summary
-    
-                {excerpt["summary"]} 
-            """)
-            context += "\n\n"
+    async def _get_bm25_index(self):
+        if self.bm25_index.is_built:
+            return self.bm25_index
+        async with self._bm25_build_lock:
+            if not self.bm25_index.is_built and self.snapshot is not None:
+                await self.bm25_index.build_from_term_counts(self.snapshot.get_json("bm25_index"))
+            elif not self.bm25_index.is_built and not await self.bm25_index.load():
+                # Data directories from before the index was saved are indexed from their excerpts, once
+                excerpts = await self.excerpt_kv.get_all()
+                await self.bm25_index.build({excerpt_id: data["excerpt"] for excerpt_id, data in excerpts.items()})
+        return self.bm25_index
+
+    async def _single_flight_query(self, query_type, text, use_cache, timings, get_context, filter=None):
+        # Concurrent identical queries share the leader's retrieval and completion, only the leader's timings are filled
+        async def run_query():
+            context = await self._build_context(get_context)
+            return await self._get_query_completion(query_type, text, context, use_cache, timings)
+
+        filter_key = json.dumps(filter, sort_keys=True, default=sorted) if filter else None
+        return await self.query_flights.run((query_type, text, use_cache, filter_key), run_query)
+
+    def _get_relevance_threshold(self, query_type):
+        threshold = self.relevance_threshold
+        if isinstance(threshold, dict):
+            threshold = threshold.get(query_type)
+        return threshold
+
+    def _is_relevant(self, query_type, context):
+        threshold = self._get_relevance_threshold(query_type)
+        if threshold is None:
+            return True
+
+        top_score = self._get_context_top_score(context)
+        if top_score is None and context.get("lexical_fallback"):
+            # Without the vector leg there is no similarity score to judge the query by
+            return True
+        relevant = top_score is not None and top_score >= threshold
+        metrics.increment(f"relevance_gate.{query_type}.checked")
+        if not relevant:
+            metrics.increment(f"relevance_gate.{query_type}.rejected")
+            logger.info(f"Relevance gate rejected {query_type} query, top score {top_score} is below {threshold}.")
+        return relevant
+
+    async def _get_gated_query_excerpts(self, query_type, text, timings):
+        """
+        Searches the excerpts ahead of LLM keyword extraction when query_type has a relevance threshold, so queries the
+        gate refuses never pay for the keywords.
+
+        :return: Dict of the excerpts, their top score and whether it clears the threshold, or None without one.
+        """
+        threshold = self._get_relevance_threshold(query_type)
+        if threshold is None:
+            return None
+        excerpts = await timings.run("excerpt_search", self._get_query_excerpts(text))
+        top_score = self._get_top_score({"excerpts": excerpts})
+        relevant = top_score is not None and top_score >= threshold
+        return {"excerpts": excerpts, "top_score": top_score, "relevant": relevant}
+
+    async def _get_gated_kg_score(self, query_type, text, low_level, high_level, timings):
+        """
+        Scores the query against the entity and/or relationship vectors ahead of LLM keyword extraction when query_type
+        has a relevance threshold, so queries the gate refuses never pay for the keywords.
+
+        :return: Dict of the top score and whether it clears the threshold, or None without one.
+        """
+        threshold = self._get_relevance_threshold(query_type)
+        if threshold is None:
+            return None
+        top_score = await timings.run("relevance_gate", self._get_query_graph_score(text, low_level, high_level))
+        return {"top_score": top_score, "relevant": top_score is not None and top_score >= threshold}
+
+    async def _get_query_graph_score(self, text, low_level, high_level):
+        """
+        :return: The best similarity of the query to the entities when low_level and to the relationships when
+            high_level, the stores the knowledge graph queries score against, or None without a match.
+        """
+        embedding = np.array(await self.rate_limited_get_embedding(text))
+        stores = [store for store, used in ((self.entities_db, low_level), (self.relationships_db, high_level)) if used]
+        results = await asyncio.gather(
+            *(store.query(query=embedding, top_k=1, better_than_threshold=0.02) for store in stores)
+        )
+        return max((float(rows[0]["__metrics__"]) for rows in results if rows), default=None)
+
+    def _get_context_top_score(self, context):
+        # A context refused before retrieval carries the score it was refused on
+        return context["top_score"] if "top_score" in context else self._get_top_score(context["data"])
+
+    def _get_top_score(self, data):
+        scores = [
+            self._get_top_score(value) if isinstance(value, dict) else max(
+                (row["score"] for row in value if "score" in row), default=None
+            )
+            for value in data.values()
+        ]
+        return max((score for score in scores if score is not None), default=None)
+
+    async def _get_query_completion(self, query_type, text, context, use_cache, timings):
+        if not self._is_relevant(query_type, context):
+            return get_no_relevant_context_response()
+        result = await timings.run(
+            "completion",
+            self.rate_limited_get_completion(text, context=context["system_prompt"].strip(), use_cache=use_cache)
+        )
+        logger.info(f"Query timings: {timings}")
+        return result
+
+    async def _stream_query_completion(self, query_type, text, context, use_cache, timings):
+        if not self._is_relevant(query_type, context):
+            yield get_no_relevant_context_response()
+            return
+
+        start = time.perf_counter()
+        system_prompt = context["system_prompt"].strip()
+        tokens = self.rate_limited_get_completion_stream(text, context=system_prompt, use_cache=use_cache)
+        async for token in tokens:
+            if "first_token" not in timings.stages:
+                timings.record("first_token", time.perf_counter() - start)
+            yield token
+        timings.record("completion", time.perf_counter() - start)
+        logger.info(f"Streaming query timings: {timings}")
 
-        return context
+    def _get_excerpt_context(self, excerpts):
+        return "".join(
+            f"## Excerpt\n\n{excerpt['excerpt']}\n\n## Summary\n\n{excerpt['summary']}\n\n" for excerpt in excerpts
+        )
 
-    async def _get_query_excerpts(self, text):
-        embedding = await self.rate_limited_get_embedding(text)
+    async def _get_vector_filter(self, filter):
+        """
+        Translates a query filter into the row filter of the excerpt vector store.
+
+        :param filter: Dict with any of "doc_ids", a list of document ids, "source_prefix", a path prefix relative to
+            the input docs directory such as "Components/", and "inserted_after" / "inserted_before" Unix timestamps.
+            Fields are combined with AND.
+        :return: A filter for NanoVectorStore.query, or None without a filter.
+        """
+        if not filter:
+            return None
+        unknown_fields = set(filter) - set(FILTER_FIELDS)
+        if unknown_fields:
+            raise ValueError(f"Unknown filter fields: {', '.join(sorted(unknown_fields))}. "
+                             f"Valid fields are: {', '.join(FILTER_FIELDS)}")
+
+        vector_filter = {
+            field: filter[field] for field in ("inserted_after", "inserted_before") if filter.get(field) is not None
+        }
+        doc_ids = set(filter["doc_ids"]) if filter.get("doc_ids") is not None else None
+        if filter.get("source_prefix"):
+            # Document paths aren't on the vector rows, so the prefix is resolved to doc ids through the document map
+            sources = await self.doc_to_source_kv.get_all()
+            prefix_doc_ids = {
+                doc_id for doc_id, source in sources.items()
+                if get_relative_path(source, self.input_docs_dir).startswith(filter["source_prefix"])
+            }
+            doc_ids = prefix_doc_ids if doc_ids is None else doc_ids & prefix_doc_ids
+        if doc_ids is not None:
+            vector_filter["doc_ids"] = doc_ids
+        return vector_filter
+
+    async def _get_query_excerpts(self, text, filter=None, embedding=None):
+        if embedding is None:
+            embedding = await self.rate_limited_get_embedding(text)
         embedding_array = np.array(embedding)
-        results = await self.embeddings_db.query(query=embedding_array, top_k=5, better_than_threshold=0.02)
-        excerpts = [self.excerpt_kv.get_by_key(result["__id__"]) for result in results]
-        excerpts = await asyncio.gather(*excerpts)
+        results = await self.embeddings_db.query(
+            query=embedding_array, top_k=5, better_than_threshold=0.02, filter=await self._get_vector_filter(filter)
+        )
+        excerpt_ids = [result["__id__"] for result in results]
+        excerpt_lookup = dict(zip(excerpt_ids, await self.excerpt_kv.get_many(excerpt_ids)))
+        return self._get_excerpts_from_results(results, excerpt_lookup)
+
+    async def _get_query_excerpts_many(self, texts, filter=None):
+        # One embedding call and one matrix search for every query, excerpts shared between queries are fetched once
+        embeddings = await self.rate_limited_get_embeddings(texts)
+        all_results = await self.embeddings_db.query_many(
+            np.array(embeddings), top_k=5, better_than_threshold=0.02, filter=await self._get_vector_filter(filter)
+        )
+        excerpt_ids = list(dict.fromkeys(result["__id__"] for results in all_results for result in results))
+        excerpt_lookup = dict(zip(excerpt_ids, await self.excerpt_kv.get_many(excerpt_ids)))
+        logger.info(f"Batch excerpt search matched {len(excerpt_ids)} unique excerpts for {len(texts)} queries.")
+        return [self._get_excerpts_from_results(results, excerpt_lookup) for results in all_results]
+
+    def _get_excerpts_from_results(self, results, excerpt_lookup):
+        excerpts = [
+            {
+                "id": result["__id__"],
+                **({"score": float(result["__metrics__"])} if "__metrics__" in result else {}),
+                **excerpt_lookup[result["__id__"]],
+            }
+            for result in results
+            if excerpt_lookup.get(result["__id__"]) is not None
+        ]
         excerpts = truncate_list_by_token_size(excerpts, get_text_for_row=lambda x: x["excerpt"], max_token_size=4000)
         return excerpts
 
-    async def hybrid_kg_query(self, text, use_cache=True):
-        prompt = get_high_low_level_keywords_prompt(text)
-        result = await self.rate_limited_get_completion(prompt, use_cache=use_cache)
-        keyword_data = extract_json_from_text(result)
-        logger.info("Processed high/low level keywords for hybrid KG query.")
+    async def hybrid_kg_query(self, text, use_cache=True, timings=None):
+        logger.info(f"Received hybrid KG query: {text}")
+        timings = timings or Timings()
+        return await self._single_flight_query(
+            "hybrid_kg", text, use_cache, timings,
+            lambda: self._get_kg_context(text, use_cache, timings, low_level=True, high_level=True)
+        )
 
-        ll_dataset, ll_entity_excerpts, ll_relations = await self._get_low_level_dataset(keyword_data)
-        hl_dataset, hl_entities, hl_entity_excerpts = await self._get_high_level_dataset(keyword_data)
+    async def local_kg_query(self, text, use_cache=True, timings=None):
+        logger.info(f"Received local KG query: {text}")
+        timings = timings or Timings()
+        return await self._single_flight_query(
+            "local_kg", text, use_cache, timings,
+            lambda: self._get_kg_context(text, use_cache, timings, low_level=True, high_level=False)
+        )
 
-        entities = ll_dataset + hl_entities
-        relations = ll_relations + hl_dataset
-        excerpts = ll_entity_excerpts + hl_entity_excerpts
-        context = self._get_kg_query_context(entities, excerpts, relations)
-        system_prompt = get_kg_query_system_prompt(context)
-        return await self.rate_limited_get_completion(text, context=system_prompt.strip(), use_cache=use_cache)
+    async def global_kg_query(self, text, use_cache=True, timings=None):
+        logger.info(f"Received global KG query: {text}")
+        timings = timings or Timings()
+        return await self._single_flight_query(
+            "global_kg", text, use_cache, timings,
+            lambda: self._get_kg_context(text, use_cache, timings, low_level=False, high_level=True)
+        )
 
-    async def local_kg_query(self, text, use_cache=True):
-        prompt = get_high_low_level_keywords_prompt(text)
-        result = await self.rate_limited_get_completion(prompt, use_cache=use_cache)
-        keyword_data = extract_json_from_text(result)
-        logger.info("Processed high/low level keywords for local KG query.")
-
-        ll_dataset, ll_entity_excerpts, ll_relations = await self._get_low_level_dataset(keyword_data)
-        entities = ll_dataset
-        relations = ll_relations
-        excerpts = ll_entity_excerpts
-        context = self._get_kg_query_context(entities, excerpts, relations)
-        system_prompt = get_kg_query_system_prompt(context)
-        return await self.rate_limited_get_completion(text, context=system_prompt.strip(), use_cache=use_cache)
-
-    async def global_kg_query(self, text, use_cache=True):
-        prompt = get_high_low_level_keywords_prompt(text)
-        result = await self.rate_limited_get_completion(prompt, use_cache=use_cache)
-        keyword_data = extract_json_from_text(result)
-        logger.info("Processed high/low level keywords for global KG query.")
-
-        hl_dataset, hl_entities, hl_entity_excerpts = await self._get_high_level_dataset(keyword_data)
-        entities = hl_entities
-        relations = hl_dataset
-        excerpts = hl_entity_excerpts
-        context = self._get_kg_query_context(entities, excerpts, relations)
-        system_prompt = get_kg_query_system_prompt(context)
-        return await self.rate_limited_get_completion(text, context=system_prompt.strip(), use_cache=use_cache)
-
-    async def mix_query(self, text, use_cache=True):
+    async def mix_query(self, text, use_cache=True, timings=None):
+        logger.info(f"Received mix query: {text}")
+        timings = timings or Timings()
+        return await self._single_flight_query(
+            "mix", text, use_cache, timings,
+            lambda: self._get_mix_context(text, use_cache, timings)
+        )
+
+    async def hybrid_kg_query_stream(self, text, use_cache=True, timings=None):
+        logger.info(f"Received streaming hybrid KG query: {text}")
+        timings = timings or Timings()
+        context = await self._build_context(
+            lambda: self._get_kg_context(text, use_cache, timings, low_level=True, high_level=True)
+        )
+        return self._stream_query_completion("hybrid_kg", text, context, use_cache, timings)
+
+    async def local_kg_query_stream(self, text, use_cache=True, timings=None):
+        logger.info(f"Received streaming local KG query: {text}")
+        timings = timings or Timings()
+        context = await self._build_context(
+            lambda: self._get_kg_context(text, use_cache, timings, low_level=True, high_level=False)
+        )
+        return self._stream_query_completion("local_kg", text, context, use_cache, timings)
+
+    async def global_kg_query_stream(self, text, use_cache=True, timings=None):
+        logger.info(f"Received streaming global KG query: {text}")
+        timings = timings or Timings()
+        context = await self._build_context(
+            lambda: self._get_kg_context(text, use_cache, timings, low_level=False, high_level=True)
+        )
+        return self._stream_query_completion("global_kg", text, context, use_cache, timings)
+
+    async def mix_query_stream(self, text, use_cache=True, timings=None):
+        logger.info(f"Received streaming mix query: {text}")
+        timings = timings or Timings()
+        context = await self._build_context(lambda: self._get_mix_context(text, use_cache, timings))
+        return self._stream_query_completion("mix", text, context, use_cache, timings)
+
+    async def _get_kg_context(self, text, use_cache, timings, low_level, high_level, local_keywords=False):
+        if not local_keywords:
+            query_type = KG_QUERY_TYPES[(low_level, high_level)]
+            gate = await self._get_gated_kg_score(query_type, text, low_level, high_level, timings)
+            if gate is not None and not gate["relevant"]:
+                return {
+                    "data": {"entities": [], "relationships": [], "excerpts": []},
+                    "context": "",
+                    "system_prompt": get_kg_query_system_prompt(""),
+                    "top_score": gate["top_score"],
+                }
+        entities, excerpts, relations = await self._get_kg_data(
+            text, use_cache, timings, low_level, high_level, local_keywords
+        )
+        kg_context = self._get_kg_query_context(entities, excerpts, relations)
+        return {
+            "data": {"entities": entities, "relationships": relations, "excerpts": excerpts},
+            "context": kg_context,
+            "system_prompt": get_kg_query_system_prompt(kg_context),
+        }
+
+    async def _get_mix_context(self, text, use_cache, timings, local_keywords=False):
+        if local_keywords:
+            # Local keywords are ready straight away, so the query is embedded in the same call as them
+            keyword_data = self._get_local_keywords(text, timings)
+            ll_embedding, hl_embedding, query_embedding = await timings.run(
+                "keyword_embeddings", self._get_keyword_embeddings(keyword_data, query=text)
+            )
+            kg_datasets, query_excerpts = await asyncio.gather(
+                self._get_kg_datasets_for_embeddings(ll_embedding, hl_embedding, timings),
+                timings.run("excerpt_search", self._get_query_excerpts(text, embedding=query_embedding)),
+            )
+        elif (gated_excerpts := await self._get_gated_query_excerpts("mix", text, timings)) is not None:
+            query_excerpts = gated_excerpts["excerpts"]
+            # The gate rejects the query on its excerpts alone, as the knowledge graph can only raise the top score
+            kg_datasets = await (
+                self._get_kg_datasets(text, use_cache, timings, True, True)
+                if gated_excerpts["relevant"] else self._get_kg_datasets_for_embeddings(None, None, timings)
+            )
+        else:
+            # The excerpt search only needs the query embedding, so it runs alongside keyword extraction
+            kg_datasets, query_excerpts = await asyncio.gather(
+                self._get_kg_datasets(text, use_cache, timings, True, True),
+                timings.run("excerpt_search", self._get_query_excerpts(text)),
+            )
+
+        with timings.measure("context_assembly"):
+            assembler = ContextAssembler(self.mix_token_budget)
+            for excerpts in (query_excerpts, kg_datasets["ll_excerpts"], kg_datasets["hl_excerpts"]):
+                assembler.add_source(
+                    "excerpts", excerpts,
+                    get_key=lambda excerpt: excerpt["id"],
+                    get_text=lambda excerpt: f"{excerpt['excerpt']} {excerpt.get('summary', '')}",
+                    get_score=lambda excerpt: excerpt["score"],
+                )
+            for entities in (kg_datasets["ll_entities"], kg_datasets["hl_entities"]):
+                assembler.add_source(
+                    "entities", entities,
+                    get_key=lambda entity: entity["entity_name"],
+                    get_text=lambda entity: f"{entity['entity_name']} {entity.get('description', '')}",
+                    get_score=lambda entity: entity["score"],
+                )
+            for relations in (kg_datasets["ll_relations"], kg_datasets["hl_relations"]):
+                assembler.add_source(
+                    "relationships", relations,
+                    get_key=lambda relation: tuple(sorted(relation["src_tgt"])),
+                    get_text=lambda relation: f"{relation['description']} {relation['keywords']}",
+                    get_score=lambda relation: relation["score"],
+                )
+            selected, used_tokens = assembler.select()
+            excerpts = selected.get("excerpts", [])
+            entities = selected.get("entities", [])
+            relations = selected.get("relationships", [])
+
+            # Excerpts found by the knowledge graph are rendered with their summaries alongside the vector search ones
+            kg_context = self._get_kg_query_context(entities, None, relations)
+            excerpt_context = self._get_excerpt_context(excerpts)
+        logger.info(f"Mix context assembled from {len(excerpts)} excerpts, {len(entities)} entities and "
+                    f"{len(relations)} relationships in {used_tokens} tokens.")
+        return {
+            "data": {
+                "excerpts": excerpts,
+                "kg": {"entities": entities, "relationships": relations},
+            },
+            "context": f"{excerpt_context}\n\n{kg_context}",
+            "system_prompt": get_mix_system_prompt(excerpt_context, kg_context),
+        }
+
+    async def _get_kg_data(self, text, use_cache, timings, low_level, high_level, local_keywords=False):
+        kg_datasets = await self._get_kg_datasets(text, use_cache, timings, low_level, high_level, local_keywords)
+        entities = kg_datasets["ll_entities"] + kg_datasets["hl_entities"]
+        relations = kg_datasets["ll_relations"] + kg_datasets["hl_relations"]
+        excerpts = kg_datasets["ll_excerpts"] + kg_datasets["hl_excerpts"]
+        return entities, excerpts, relations
+
+    async def _get_kg_datasets(self, text, use_cache, timings, low_level, high_level, local_keywords=False):
+        if local_keywords:
+            keyword_data = self._get_local_keywords(text, timings)
+        else:
+            keyword_data = await timings.run("keywords", self._get_keywords(text, use_cache))
+        ll_embedding, hl_embedding, _ = await timings.run(
+            "keyword_embeddings",
+            self._get_keyword_embeddings(keyword_data, low_level, high_level)
+        )
+        return await self._get_kg_datasets_for_embeddings(ll_embedding, hl_embedding, timings)
+
+    async def _get_kg_datasets_for_embeddings(self, ll_embedding, hl_embedding, timings):
+        (ll_dataset, ll_entity_excerpts, ll_relations), (hl_dataset, hl_entities, hl_entity_excerpts) = \
+            await asyncio.gather(
+                timings.run("low_level", self._get_low_level_dataset(ll_embedding)),
+                timings.run("high_level", self._get_high_level_dataset(hl_embedding)),
+            )
+
+        return {
+            "ll_entities": ll_dataset,
+            "hl_entities": hl_entities,
+            "ll_relations": ll_relations,
+            "hl_relations": hl_dataset,
+            "ll_excerpts": ll_entity_excerpts,
+            "hl_excerpts": hl_entity_excerpts,
+        }
+
+    async def _get_keywords(self, text, use_cache):
         prompt = get_high_low_level_keywords_prompt(text)
         result = await self.rate_limited_get_completion(prompt, use_cache=use_cache)
-        keyword_data = extract_json_from_text(result)
-        logger.info("Processed high/low level keywords for mixed KG query.")
-
-        ll_dataset, ll_entity_excerpts, ll_relations = await self._get_low_level_dataset(keyword_data)
-        hl_dataset, hl_entities, hl_entity_excerpts = await self._get_high_level_dataset(keyword_data)
+        keyword_data = extract_json_from_text(result) or {}
+        logger.info(f"Found {len(keyword_data.get('low_level_keywords', []))} low-level and "
+                    f"{len(keyword_data.get('high_level_keywords', []))} high-level keywords.")
+        return keyword_data
+
+    def _get_local_keywords(self, text, timings):
+        with timings.measure("keywords"):
+            return extract_keywords(text)
+
+    async def _get_keyword_embeddings(self, keyword_data, low_level=True, high_level=True, query=None):
+        """
+        :param query: Query text to embed in the same call, e.g. for the excerpt search of a mix query.
+        :return: The low-level keyword, high-level keyword and query embeddings, None for those not embedded.
+        """
+        ll_keywords = keyword_data.get("low_level_keywords", []) if low_level else []
+        hl_keywords = keyword_data.get("high_level_keywords", []) if high_level else []
+        contents = [", ".join(keywords) for keywords in (ll_keywords, hl_keywords) if keywords]
+        contents += [query] if query else []
+        embeddings = await self.rate_limited_get_embeddings(contents) if contents else []
+        embeddings = iter(embeddings)
+        ll_embedding = next(embeddings) if ll_keywords else None
+        hl_embedding = next(embeddings) if hl_keywords else None
+        query_embedding = next(embeddings) if query else None
+        return ll_embedding, hl_embedding, query_embedding
+
+    async def community_query(self, text, use_cache=True, timings=None):
+        logger.info(f"Received community query: {text}")
+        timings = timings or Timings()
+        return await self._single_flight_query(
+            "community", text, use_cache, timings,
+            lambda: self._get_community_context(text, timings)
+        )
 
-        kg_entities = ll_dataset + hl_entities
-        kg_relations = ll_relations + hl_dataset
-        kg_excerpts = ll_entity_excerpts + hl_entity_excerpts
-        query_excerpts = await self._get_query_excerpts(text)
-        kg_context = self._get_kg_query_context(kg_entities, kg_excerpts, kg_relations)
-        excerpt_context = self._get_excerpt_context(query_excerpts)
-        system_prompt = get_mix_system_prompt(excerpt_context, kg_context)
-        return await self.rate_limited_get_completion(text, context=system_prompt.strip(), use_cache=use_cache)
+    async def community_query_stream(self, text, use_cache=True, timings=None):
+        logger.info(f"Received streaming community query: {text}")
+        timings = timings or Timings()
+        context = await self._build_context(lambda: self._get_community_context(text, timings))
+        return self._stream_query_completion("community", text, context, use_cache, timings)
+
+    async def _get_community_context(self, text, timings):
+        with timings.measure("community_search"):
+            embedding = await self.rate_limited_get_embedding(text)
+            results = await self.communities_db.query(query=np.array(embedding), top_k=3, better_than_threshold=0.02)
+            communities = await self.community_kv.get_many([result["__id__"] for result in results])
+        communities = [
+            {"id": result["__id__"], "score": float(result["__metrics__"]), **community}
+            for result, community in zip(results, communities)
+            if community is not None
+        ]
+        logger.info(f"Retrieved {len(communities)} community reports for the query.")
+        community_context = "\n\n".join(
+            f"## Community report\n\n{community['summary']}" for community in communities
+        )
+        return {
+            "data": {"communities": communities},
+            "context": community_context,
+            "system_prompt": get_community_query_system_prompt(community_context),
+        }
 
     def _get_kg_query_context(self, entities, excerpts, relations):
         entity_csv = [["entity", "type", "description", "rank"]]
@@ -412,41 +1653,34 @@ class SmolRag:
                 relation["rank"],
             ])
         relations_context = list_of_list_to_csv(relation_csv)
-        excerpt_csv = [["excerpt"]]
-        for excerpt in excerpts:
-            excerpt_csv.append([excerpt["excerpt"]])
-        excerpt_context = list_of_list_to_csv(excerpt_csv)
-        context = inspect.cleandoc(f"""
-            -----Entities-----
-            ```csv
-            {entity_context}
-            ```
-            -----Relationships-----
-            ```csv
-            {relations_context}
-            ```
-            -----Excerpts-----
-            ```csv
-            {excerpt_context}
-            ```
-        """)
+        sections = [("Entities", entity_context), ("Relationships", relations_context)]
+        if excerpts is not None:
+            excerpt_csv = [["excerpt"]]
+            for excerpt in excerpts:
+                excerpt_csv.append([excerpt["excerpt"]])
+            sections.append(("Excerpts", list_of_list_to_csv(excerpt_csv)))
+        context = "\n".join(f"-----{title}-----\n```csv\n{csv}\n```" for title, csv in sections)
         logger.info(f"KG query context built with {len(entities)} entities, {len(relations)} relationships, "
-                    f"and {len(excerpts)} excerpts.")
+                    f"and {len(excerpts or [])} excerpts.")
         return context
 
-    async def _get_high_level_dataset(self, keyword_data):
-        hl_keywords = keyword_data.get("high_level_keywords", [])
-        logger.info(f"Found {len(hl_keywords)} high-level keywords.")
-        hl_results = []
-        if len(hl_keywords):
-            hl_embedding = await self.rate_limited_get_embedding(hl_keywords)
-            hl_embedding_array = np.array(hl_embedding)
-            hl_results = await self.relationships_db.query(query=hl_embedding_array, top_k=25, better_than_threshold=0.02)
+    async def _get_high_level_dataset(self, hl_embedding):
+        if hl_embedding is None:
+            return [], [], []
+        hl_embedding_array = np.array(hl_embedding)
+        hl_results = await self.relationships_db.query(query=hl_embedding_array, top_k=25, better_than_threshold=0.02)
+        # A vector can outlive its edge, e.g. one left behind by an interrupted merge
+        hl_results = [r for r in hl_results if self.graph.get_edge((r["__source__"], r["__target__"])) is not None]
         hl_data = [self.graph.get_edge((r["__source__"], r["__target__"])) for r in hl_results]
         hl_degrees = [self.graph.degree(r["__source__"]) + self.graph.degree(r["__target__"]) for r in hl_results]
         hl_dataset = []
         for k, n, d in zip(hl_results, hl_data, hl_degrees):
-            hl_dataset.append({"src_tgt": (k["__source__"], k["__target__"]), "rank": d, **n, })
+            hl_dataset.append({
+                "src_tgt": (k["__source__"], k["__target__"]),
+                "rank": d,
+                "score": float(k["__metrics__"]),
+                **n,
+            })
         hl_dataset = sorted(hl_dataset, key=lambda x: (x["rank"], x["weight"]), reverse=True)
         hl_dataset = truncate_list_by_token_size(
             hl_dataset,
@@ -458,18 +1692,16 @@ class SmolRag:
         logger.info(f"High-level dataset: {len(hl_dataset)} relationships, {len(hl_entities)} entities extracted.")
         return hl_dataset, hl_entities, hl_entity_excerpts
 
-    async def _get_low_level_dataset(self, keyword_data):
-        ll_keywords = keyword_data.get("low_level_keywords", [])
-        logger.info(f"Found {len(ll_keywords)} low-level keywords.")
-        ll_results = []
-        if len(ll_keywords):
-            ll_embedding = await self.rate_limited_get_embedding(ll_keywords)
-            ll_embedding_array = np.array(ll_embedding)
-            ll_results = await self.entities_db.query(query=ll_embedding_array, top_k=25, better_than_threshold=0.02)
+    async def _get_low_level_dataset(self, ll_embedding):
+        if ll_embedding is None:
+            return [], [], []
+        ll_embedding_array = np.array(ll_embedding)
+        ll_results = await self.entities_db.query(query=ll_embedding_array, top_k=25, better_than_threshold=0.02)
+        ll_results = [r for r in ll_results if self.graph.get_node(r["__entity_name__"]) is not None]
         ll_data = [self.graph.get_node(r["__entity_name__"]) for r in ll_results]
         ll_degrees = [self.graph.degree(r["__entity_name__"]) for r in ll_results]
         ll_dataset = [
-            {**n, "entity_name": k["__entity_name__"], "rank": d}
+            {**n, "entity_name": k["__entity_name__"], "rank": d, "score": float(k["__metrics__"])}
             for k, n, d in zip(ll_results, ll_data, ll_degrees)
         ]
         ll_entity_excerpts = await self._get_excerpts_for_entities(ll_dataset)
@@ -491,6 +1723,8 @@ class SmolRag:
             for k, v in zip(sibling_names, sibling_nodes)
             if v is not None and "excerpt_id" in v
         }
+        unique_excerpt_ids = list(dict.fromkeys(excerpt_id for ids in excerpt_ids for excerpt_id in ids))
+        excerpt_data_lookup = dict(zip(unique_excerpt_ids, await self.excerpt_kv.get_many(unique_excerpt_ids)))
         all_excerpt_data_lookup = {}
         for index, (excerpt_ids, edges) in enumerate(zip(excerpt_ids, all_edges)):
             for excerpt_id in excerpt_ids:
@@ -503,7 +1737,7 @@ class SmolRag:
                         if sibling_name in sibling_excerpt_lookup and excerpt_id in sibling_excerpt_lookup[
                             sibling_name]:
                             relation_counts += 1
-                excerpt_data = await self.excerpt_kv.get_by_key(excerpt_id)
+                excerpt_data = excerpt_data_lookup[excerpt_id]
                 if excerpt_data is not None and "excerpt" in excerpt_data:
                     all_excerpt_data_lookup[excerpt_id] = {
                         "data": excerpt_data,
@@ -522,7 +1756,8 @@ class SmolRag:
             return []
 
         all_excerpts = sorted(all_excerpts, key=lambda x: (x["order"], -x["relation_counts"]))
-        all_excerpts = [t["data"] for t in all_excerpts]
+        # Each excerpt scores as its best matching entity did
+        all_excerpts = [{"id": t["id"], "score": kg_dataset[t["order"]]["score"], **t["data"]} for t in all_excerpts]
 
         all_excerpts = truncate_list_by_token_size(
             all_excerpts,
@@ -535,21 +1770,20 @@ class SmolRag:
     def _get_relationships_from_entities(self, kg_dataset):
         node_edges_list = [self.graph.get_node_edges(row["entity_name"]) for row in kg_dataset]
 
-        edges = []
-        seen = set()
+        # Each relationship scores as the best matching of its entities did
+        edge_scores = {}
 
-        for node_edges in node_edges_list:
+        for row, node_edges in zip(kg_dataset, node_edges_list):
             for edge in node_edges:
-                sorted_edge = tuple(sorted(edge))
-                if sorted_edge not in seen:
-                    seen.add(sorted_edge)
-                    edges.append(sorted_edge)
+                edge = tuple(sorted(edge))
+                edge_scores[edge] = max(edge_scores.get(edge, row["score"]), row["score"])
 
+        edges = list(edge_scores)
         edges_pack = [self.graph.get_edge((e[0], e[1])) for e in edges]
         edges_degree = [self.graph.degree(e[0]) + self.graph.degree(e[1]) for e in edges]
 
         edges_data = [
-            {"src_tgt": k, "rank": d, **v}
+            {"src_tgt": k, "rank": d, "score": edge_scores[k], **v}
             for k, v, d in zip(edges, edges_pack, edges_degree)
             if v is not None
         ]
@@ -568,15 +1802,22 @@ class SmolRag:
             for dp in kg_dataset
         ]
 
+        unique_excerpt_ids = list(dict.fromkeys(excerpt_id for ids in excerpt_ids for excerpt_id in ids))
+        excerpt_data_lookup = dict(zip(unique_excerpt_ids, await self.excerpt_kv.get_many(unique_excerpt_ids)))
         all_excerpts_lookup = {}
 
         for index, excerpt_ids in enumerate(excerpt_ids):
             for excerpt_id in excerpt_ids:
                 if excerpt_id not in all_excerpts_lookup:
                     all_excerpts_lookup[excerpt_id] = {
-                        "data": await self.excerpt_kv.get_by_key(excerpt_id),
+                        "data": excerpt_data_lookup[excerpt_id],
                         "order": index,
+                        "score": kg_dataset[index]["score"],
                     }
+                else:
+                    # The relationships are ordered by degree, not by score
+                    lookup = all_excerpts_lookup[excerpt_id]
+                    lookup["score"] = max(lookup["score"], kg_dataset[index]["score"])
 
         if any([v is None for v in all_excerpts_lookup.values()]):
             logger.warning("Text chunks are missing, maybe the storage is damaged")
@@ -585,7 +1826,10 @@ class SmolRag:
         ]
         all_excerpts = sorted(all_excerpts, key=lambda x: x["order"])
         # Todo: figure out how t["data"] is None
-        all_excerpts = [t["data"] for t in all_excerpts if t["data"] is not None]
+        # Each excerpt scores as its best matching relationship did
+        all_excerpts = [
+            {"id": t["id"], "score": t["score"], **t["data"]} for t in all_excerpts if t["data"] is not None
+        ]
 
         all_excerpts = truncate_list_by_token_size(
             all_excerpts,
@@ -596,23 +1840,20 @@ class SmolRag:
         return all_excerpts
 
     def _get_entities_from_relationships(self, kg_dataset):
-        entity_names = []
-        seen = set()
+        # Each entity scores as the best matching of its relationships did
+        entity_scores = {}
 
         for e in kg_dataset:
-            if e["src_tgt"][0] not in seen:
-                entity_names.append(e["src_tgt"][0])
-                seen.add(e["src_tgt"][0])
-            if e["src_tgt"][1] not in seen:
-                entity_names.append(e["src_tgt"][1])
-                seen.add(e["src_tgt"][1])
+            for entity_name in e["src_tgt"]:
+                entity_scores[entity_name] = max(entity_scores.get(entity_name, e["score"]), e["score"])
 
+        entity_names = list(entity_scores)
         data = [self.graph.get_node(entity_name) for entity_name in entity_names]
         degrees = [self.graph.degree(entity_name) for entity_name in entity_names]
 
         # Todo: we need to filter out missing node data (ie no description) in case the node was added as an edge only
         data = [
-            {**n, "entity_name": k, "rank": d}
+            {**n, "entity_name": k, "rank": d, "score": entity_scores[k]}
             for k, n, d in zip(entity_names, data, degrees) if 'description' in n
         ]
 
@@ -632,7 +1873,7 @@ if __name__ == '__main__':
         # delete_all_files(LOG_DIR)
 
         smol_rag = SmolRag()
-        await smol_rag.import_documents()
+        await smol_rag.ingest()
 
         # print(await smol_rag.query("what is SmolRag?"))  # Should answer
         # print("=+=+=+=+=+=+=+=+=+=+=+=+=+=")
@@ -0,0 +1,506 @@
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from app.definitions import EMBEDDINGS_DB, ENTITIES_DB, RELATIONSHIPS_DB, COMMUNITIES_DB, SOURCE_TO_DOC_ID_KV_PATH, \
+    DOC_ID_TO_SOURCE_KV_PATH, DOC_ID_TO_EXCERPT_KV_PATH, EXCERPT_KV_PATH, COMMUNITY_KV_PATH, CONSOLIDATION_KV_PATH, \
+    ENTITY_ALIAS_KV_PATH, KG_DB, EMBEDDING_MODEL
+from app.graph_store import NetworkXGraphStore
+from app.kv_store import JsonKvStore
+from app.logger import logger
+from app.metrics import metrics
+from app.vector_store import NanoVectorStore
+
+SNAPSHOT_MAGIC = b"SMOLSNAP"
+SNAPSHOT_FORMAT_VERSION = 2
+# Blobs start on 64 byte boundaries so the arrays can be mapped in place
+BLOB_ALIGNMENT = 64
+HEADER = struct.Struct("<8sIQ")
+CURRENT_FILE = "CURRENT"
+
+VECTOR_STORES = {
+    "embeddings_db": EMBEDDINGS_DB,
+    "entities_db": ENTITIES_DB,
+    "relationships_db": RELATIONSHIPS_DB,
+    "communities_db": COMMUNITIES_DB,
+}
+KV_STORES = {
+    "source_to_doc_kv": SOURCE_TO_DOC_ID_KV_PATH,
+    "doc_to_source_kv": DOC_ID_TO_SOURCE_KV_PATH,
+    "doc_to_excerpt_kv": DOC_ID_TO_EXCERPT_KV_PATH,
+    "excerpt_kv": EXCERPT_KV_PATH,
+    "community_kv": COMMUNITY_KV_PATH,
+    "consolidation_kv": CONSOLIDATION_KV_PATH,
+    "entity_alias_kv": ENTITY_ALIAS_KV_PATH,
+}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _align(size):
+    return -(-size // BLOB_ALIGNMENT) * BLOB_ALIGNMENT
+
+
+def _encode_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _add_json(blobs, name, value):
+    blobs[name] = ("json", _encode_json(value), {})
+
+
+def _add_array(blobs, name, array):
+    array = np.ascontiguousarray(array)
+    blobs[name] = ("array", array.tobytes(), {"dtype": array.dtype.name, "shape": list(array.shape)})
+
+
+def _add_records(blobs, name, values):
+    # Values are stored back to back with an offsets array, so a single value can be decoded without the others
+    payloads = [_encode_json(value) for value in values]
+    offsets = np.zeros(len(payloads) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(payload) for payload in payloads])
+    _add_array(blobs, f"{name}.offsets", offsets)
+    blobs[f"{name}.values"] = ("records", b"".join(payloads), {})
+
+
+def _add_graph(blobs, nodes, edges, attributes):
+    index = {name: i for i, (name, _) in enumerate(nodes)}
+    endpoints = np.array([[index[source], index[target]] for source, target, _ in edges], dtype=np.int32)
+    endpoints = endpoints.reshape(-1, 2)
+    # Adjacency in CSR form, each edge is listed under both of its nodes and neighbours are sorted by node index
+    sources = np.concatenate([endpoints[:, 0], endpoints[:, 1]])
+    targets = np.concatenate([endpoints[:, 1], endpoints[:, 0]])
+    edge_ids = np.tile(np.arange(len(edges), dtype=np.int32), 2)
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=len(nodes)))
+
+    _add_json(blobs, "graph.nodes", [name for name, _ in nodes])
+    _add_json(blobs, "graph.attributes", attributes)
+    _add_records(blobs, "graph.node_data", [data for _, data in nodes])
+    _add_records(blobs, "graph.edge_data", [data for _, _, data in edges])
+    _add_array(blobs, "graph.edge_endpoints", endpoints)
+    _add_array(blobs, "graph.indptr", indptr)
+    _add_array(blobs, "graph.neighbours", targets[order])
+    _add_array(blobs, "graph.neighbour_edges", edge_ids[order])
+
+
+async def export_snapshot(smol_rag, path, generation=0):
+    """
+    Packs every store of a SmolRag instance, plus the BM25 term counts, into a single snapshot file. The file is
+    written next to path and moved into place, so readers never see a partial snapshot.
+
+    Layout: an 8 byte magic, the format version, the manifest length, the JSON manifest and then the blobs, each
+    aligned to 64 bytes. The manifest records the offset, length and SHA-256 of every blob. Vector matrices and graph
+    adjacency are raw arrays, and KV values are stored with an offsets array so they can be read one at a time.
+
+    :param smol_rag: The SmolRag instance to export.
+    :param path: Where to write the snapshot.
+    :param generation: Generation number recorded in the manifest, see publish_snapshot.
+    :return: The manifest.
+    """
+    blobs = {}
+    counts = {}
+    for name in VECTOR_STORES:
+        data, matrix = await getattr(smol_rag, name).get_all()
+        _add_json(blobs, f"{name}.data", data)
+        _add_array(blobs, f"{name}.matrix", np.asarray(matrix, dtype=np.float32).reshape(-1, smol_rag.dimensions))
+        counts[name] = len(data)
+    for name in KV_STORES:
+        store = await getattr(smol_rag, name).get_all()
+        _add_json(blobs, f"{name}.keys", list(store.keys()))
+        _add_records(blobs, name, store.values())
+        counts[name] = len(store)
+    nodes, edges, attributes = await smol_rag.graph.get_all()
+    _add_graph(blobs, nodes, edges, attributes)
+    counts["graph"] = len(nodes)
+    bm25_index = await smol_rag._get_bm25_index()
+    _add_json(blobs, "bm25_index", await bm25_index.get_term_counts())
+
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "generation": generation,
+        "created_at": time.time(),
+        "dimensions": smol_rag.dimensions,
+        "embedding_model": EMBEDDING_MODEL,
+        "counts": counts,
+        "blobs": {},
+    }
+    offset = 0
+    for name, (kind, payload, extra) in blobs.items():
+        manifest["blobs"][name] = {
+            "kind": kind,
+            "offset": offset,
+            "length": len(payload),
+            "sha256": hashlib.sha256(payload).hexdigest(),
+            **extra,
+        }
+        offset += _align(len(payload))
+    # The snapshot id identifies the content, so re-exporting unchanged stores gives the same id
+    manifest["id"] = hashlib.sha256(
+        "".join(blob["sha256"] for blob in manifest["blobs"].values()).encode()
+    ).hexdigest()[:16]
+
+    manifest_bytes = _encode_json(manifest)
+    data_start = _align(HEADER.size + len(manifest_bytes))
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, len(manifest_bytes)))
+        f.write(manifest_bytes)
+        for name, (_, payload, _) in blobs.items():
+            f.seek(data_start + manifest["blobs"][name]["offset"])
+            f.write(payload)
+    os.replace(temp_path, path)
+    logger.info(f"Snapshot {manifest['id']} exported to {path}")
+    return manifest
+
+
+class MappedRecords:
+    """Read-only sequence of JSON values decoded one at a time from a snapshot."""
+
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return json.loads(bytes(self.values[int(self.offsets[i]):int(self.offsets[i + 1])]))
+
+
+class Snapshot:
+    """
+    A snapshot file opened memory-mapped and read-only. Blobs are only read, and their checksums verified, when a
+    store first asks for them. Arrays and KV values are used in place, so worker processes opening the same snapshot
+    share its pages through the page cache instead of each holding a copy.
+    """
+
+    def __init__(self, path, verify=True):
+        self.path = path
+        self.verify = verify
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, manifest_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError(f"{path} is not a SmolRag snapshot")
+        if version != SNAPSHOT_FORMAT_VERSION:
+            raise SnapshotError(f"{path} has snapshot format version {version}, expected {SNAPSHOT_FORMAT_VERSION}")
+        self.manifest = json.loads(self._mmap[HEADER.size:HEADER.size + manifest_length])
+        self._data_start = _align(HEADER.size + manifest_length)
+
+    @property
+    def id(self):
+        return self.manifest["id"]
+
+    @property
+    def generation(self):
+        return self.manifest["generation"]
+
+    def get_bytes(self, name):
+        """
+        :return: A read-only memoryview over the blob, without copying it.
+        """
+        if name not in self.manifest["blobs"]:
+            raise SnapshotError(f"Snapshot {self.path} has no blob named {name}")
+        blob = self.manifest["blobs"][name]
+        start = self._data_start + blob["offset"]
+        view = memoryview(self._mmap)[start:start + blob["length"]]
+        if self.verify and hashlib.sha256(view).hexdigest() != blob["sha256"]:
+            raise SnapshotError(f"Checksum mismatch for {name} in snapshot {self.path}")
+        return view
+
+    def get_json(self, name):
+        return json.loads(bytes(self.get_bytes(name)))
+
+    def get_array(self, name):
+        blob = self.manifest["blobs"][name]
+        return np.frombuffer(self.get_bytes(name), dtype=blob["dtype"]).reshape(blob["shape"])
+
+    def get_records(self, name):
+        return MappedRecords(self.get_array(f"{name}.offsets"), self.get_bytes(f"{name}.values"))
+
+    def get_stores(self, coarse_dimensions=None, coarse_candidates=100):
+        """
+        :param coarse_dimensions: Two-stage search on the vector stores, see NanoVectorStore.
+        :param coarse_candidates: Rows re-scored at full dimension per query.
+        :return: Dict of SmolRag constructor arguments for every store, all read-only and loaded on first use.
+        """
+        stores = {
+            name: SnapshotVectorStore(self, name, coarse_dimensions, coarse_candidates) for name in VECTOR_STORES
+        }
+        stores.update({name: SnapshotKvStore(self, name) for name in KV_STORES})
+        stores["graph_db"] = SnapshotGraphStore(self)
+        return stores
+
+
+async def _read_only(self, *args, **kwargs):
+    raise PermissionError(f"{self.file_path} is read-only, it was opened from a snapshot")
+
+
+class SnapshotKvStore(JsonKvStore):
+    """Read-only KV store over a snapshot. Only the keys are held in memory, values are decoded on access."""
+
+    def __init__(self, snapshot, name):
+        super().__init__(f"{snapshot.path}#{name}")
+        self.snapshot = snapshot
+        self.name = name
+        self._index = None
+        self._records = None
+
+    @property
+    def is_loaded(self):
+        return self._index is not None
+
+    @property
+    def store(self):
+        self.load()
+        return {key: self._records[i] for key, i in self._index.items()}
+
+    def load(self):
+        with self._load_lock:
+            if self._index is None:
+                self._records = self.snapshot.get_records(self.name)
+                self._index = {key: i for i, key in enumerate(self.snapshot.get_json(f"{self.name}.keys"))}
+
+    def _get(self, key):
+        self.load()
+        i = self._index.get(key)
+        return None if i is None else self._records[i]
+
+    async def has(self, key):
+        self.load()
+        return key in self._index
+
+    async def equal(self, key, value):
+        return self._get(key) == value
+
+    async def get_all(self):
+        return self.store
+
+    async def get_by_key(self, key):
+        return self._get(key)
+
+    async def get_many(self, keys):
+        return [self._get(key) for key in keys]
+
+    add = add_many = remove = remove_many = save = _read_only
+
+
+class SnapshotVectorStore(NanoVectorStore):
+    def __init__(self, snapshot, name, coarse_dimensions=None, coarse_candidates=100):
+        super().__init__(
+            f"{snapshot.path}#{name}", snapshot.manifest["dimensions"], coarse_dimensions, coarse_candidates
+        )
+        self.snapshot = snapshot
+        self.name = name
+
+    def load(self):
+        with self._load_lock:
+            if not self.is_loaded:
+                # The matrix is mapped from the snapshot file rather than read into memory
+                self.restore(
+                    self.snapshot.get_json(f"{self.name}.data"), self.snapshot.get_array(f"{self.name}.matrix")
+                )
+
+    upsert = delete = save = _read_only
+
+
+class SnapshotGraphStore(NetworkXGraphStore):
+    """
+    Read-only graph store over the CSR adjacency arrays of a snapshot. Node and edge data are decoded on access, and a
+    NetworkX graph is only built if something needs one, such as community detection.
+    """
+
+    def __init__(self, snapshot):
+        super().__init__(f"{snapshot.path}#graph")
+        self.snapshot = snapshot
+        self._index = None
+
+    @property
+    def is_loaded(self):
+        return self._index is not None
+
+    @property
+    def graph(self):
+        if self._graph is None:
+            import networkx as nx
+            graph = nx.Graph(**self.snapshot.get_json("graph.attributes"))
+            graph.add_nodes_from(self.get_nodes())
+            graph.add_edges_from(self.get_edges())
+            self._graph = graph
+        return self._graph
+
+    def load(self):
+        with self._load_lock:
+            if self._index is not None:
+                return
+            self._names = self.snapshot.get_json("graph.nodes")
+            self._node_data = self.snapshot.get_records("graph.node_data")
+            self._edge_data = self.snapshot.get_records("graph.edge_data")
+            self._edge_endpoints = self.snapshot.get_array("graph.edge_endpoints")
+            self._indptr = self.snapshot.get_array("graph.indptr")
+            self._neighbours = self.snapshot.get_array("graph.neighbours")
+            self._neighbour_edges = self.snapshot.get_array("graph.neighbour_edges")
+            self._index = {name: i for i, name in enumerate(self._names)}
+
+    def _get_index(self, name):
+        self.load()
+        return self._index.get(name)
+
+    def get_node(self, name):
+        i = self._get_index(name)
+        return None if i is None else self._node_data[i]
+
+    def get_edge(self, edge):
+        i, j = self._get_index(edge[0]), self._get_index(edge[1])
+        if i is None or j is None:
+            return None
+        start, end = self._indptr[i], self._indptr[i + 1]
+        position = start + np.searchsorted(self._neighbours[start:end], j)
+        if position == end or self._neighbours[position] != j:
+            return None
+        return self._edge_data[int(self._neighbour_edges[position])]
+
+    def get_nodes(self):
+        self.load()
+        return [(name, self._node_data[i]) for i, name in enumerate(self._names)]
+
+    def get_edges(self):
+        self.load()
+        return [
+            (self._names[source], self._names[target], self._edge_data[i])
+            for i, (source, target) in enumerate(self._edge_endpoints)
+        ]
+
+    def get_node_edges(self, name):
+        i = self._get_index(name)
+        if i is None:
+            return []
+        # A self-loop is listed twice in the adjacency, so it counts twice towards the degree as in NetworkX
+        neighbours = dict.fromkeys(self._neighbours[self._indptr[i]:self._indptr[i + 1]].tolist())
+        return [(name, self._names[j]) for j in neighbours]
+
+    def degree(self, name):
+        i = self._get_index(name)
+        return 0 if i is None else int(self._indptr[i + 1] - self._indptr[i])
+
+    def get_community_edges(self, names):
+        indices = {self._get_index(name) for name in names} - {None}
+        return [
+            (self._names[source], self._names[target], self._edge_data[i])
+            for i, (source, target) in enumerate(self._edge_endpoints)
+            if source in indices and target in indices
+        ]
+
+    merge_batch = update_batch = remove_node = save = _read_only
+
+
+def get_current_snapshot(directory):
+    """
+    :return: The {"generation", "path", "id"} of the snapshot currently published in directory, or None.
+    """
+    current_path = os.path.join(directory, CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path) as f:
+        current = json.load(f)
+    return {**current, "path": os.path.join(directory, current["path"])}
+
+
+async def publish_snapshot(smol_rag, directory, keep=2):
+    """
+    Exports a snapshot into directory under the next generation number and then points the CURRENT file at it, so
+    serving processes watching the directory switch to it. Older generations beyond keep are deleted; processes still
+    mapping one keep their mapping until they switch.
+
+    :return: The manifest of the new snapshot.
+    """
+    os.makedirs(directory, exist_ok=True)
+    current = get_current_snapshot(directory)
+    generation = current["generation"] + 1 if current else 1
+    file_name = f"snapshot-{generation:06d}.smolrag"
+    manifest = await export_snapshot(smol_rag, os.path.join(directory, file_name), generation)
+
+    temp_path = os.path.join(directory, f"{CURRENT_FILE}.tmp")
+    with open(temp_path, "w") as f:
+        json.dump({"generation": generation, "path": file_name, "id": manifest["id"]}, f)
+    os.replace(temp_path, os.path.join(directory, CURRENT_FILE))
+
+    snapshots = sorted(name for name in os.listdir(directory) if name.startswith("snapshot-"))
+    for name in snapshots[:-keep]:
+        os.remove(os.path.join(directory, name))
+    logger.info(f"Published snapshot generation {generation} to {directory}")
+    return manifest
+
+
+async def watch_snapshots(smol_rag, directory, interval=5.0):
+    """
+    Polls directory for a newer snapshot generation and switches smol_rag to it. Runs until cancelled.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            current = get_current_snapshot(directory)
+            if current and (smol_rag.snapshot is None or current["generation"] > smol_rag.snapshot.generation):
+                snapshot = await asyncio.to_thread(Snapshot, current["path"])
+                smol_rag.use_snapshot(snapshot)
+                metrics.set_gauge("snapshot.generation", snapshot.generation)
+        except Exception as e:
+            logger.error(f"Error switching to the latest snapshot in {directory}: {e}")
+
+
+def import_snapshot(path, data_paths=None):
+    """
+    Unpacks a snapshot into the loose store files that SmolRag uses by default, e.g. to ingest more documents on top
+    of it. Existing files are overwritten.
+
+    :param path: The snapshot to import.
+    :param data_paths: Optional dict of store name to file path, defaults to the paths in app.definitions.
+    """
+    from nano_vectordb.dbs import array_to_buffer_string
+    import networkx as nx
+
+    data_paths = {**VECTOR_STORES, **KV_STORES, "graph": KG_DB, **(data_paths or {})}
+    snapshot = Snapshot(path)
+    stores = snapshot.get_stores()
+    for name in VECTOR_STORES:
+        with open(data_paths[name], "w", encoding="utf-8") as f:
+            json.dump({
+                "embedding_dim": snapshot.manifest["dimensions"],
+                "data": snapshot.get_json(f"{name}.data"),
+                "matrix": array_to_buffer_string(snapshot.get_array(f"{name}.matrix")),
+            }, f, ensure_ascii=False)
+    for name in KV_STORES:
+        with open(data_paths[name], "w") as f:
+            json.dump(stores[name].store, f, indent=2)
+    nx.write_graphml(stores["graph_db"].graph, data_paths["graph"])
+    logger.info(f"Snapshot {snapshot.id} imported from {path}")
+
+
+if __name__ == '__main__':
+    usage = "Usage: python -m app.snapshot export|publish|import|info <path>"
+    if len(sys.argv) != 3 or sys.argv[1] not in ("export", "publish", "import", "info"):
+        sys.exit(usage)
+    command, snapshot_path = sys.argv[1:]
+
+    if command in ("export", "publish"):
+        from app.smol_rag import SmolRag
+        if command == "export":
+            result = asyncio.run(export_snapshot(SmolRag(), snapshot_path))
+        else:
+            result = asyncio.run(publish_snapshot(SmolRag(), snapshot_path))
+        print(json.dumps({key: result[key] for key in ("id", "generation", "counts")}, indent=2))
+    elif command == "import":
+        import_snapshot(snapshot_path)
+    else:
+        print(json.dumps({k: v for k, v in Snapshot(snapshot_path).manifest.items() if k != "blobs"}, indent=2))
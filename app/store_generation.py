@@ -0,0 +1,80 @@
+import contextvars
+import os
+
+from app.logger import logger
+from app.metrics import metrics
+
+# Maps id(smol_rag) to the generation the current query or ingestion run is pinned to
+pinned_generations = contextvars.ContextVar("pinned_generations", default={})
+
+STAGING_DIR = "staging"
+# Written once a staging directory holds a complete copy of the stores, so an interrupted reindex can be resumed from it
+STAGING_CHECKPOINT = "checkpoint"
+
+
+def get_store_path(store):
+    """The file a store saves to, or the directory of a sharded vector store."""
+    return getattr(store, "file_path", None) or getattr(store, "storage_file", None) or store.storage_dir
+
+
+def get_staging_path(path):
+    """Where the staging copy of the store saving to path saves, in a staging directory beside it."""
+    return os.path.join(os.path.dirname(path), STAGING_DIR, os.path.basename(path))
+
+
+class StoreGeneration:
+    """
+    A complete set of stores that are read together. Queries pin the generation that is live when they start and
+    keep using it until they finish, even if a newer generation is swapped in meanwhile. A retired generation drops
+    its stores once its last query has finished.
+    """
+
+    def __init__(self, stores, number=0, snapshot=None):
+        """
+        :param stores: Dict of SmolRag store attribute name to store.
+        :param number: Generation number, incremented on every swap.
+        :param snapshot: The snapshot the stores were opened from, if any.
+        """
+        self.stores = stores
+        self.number = number
+        self.snapshot = snapshot
+        self.active_queries = 0
+        self.retired = False
+
+    def acquire(self):
+        self.active_queries += 1
+
+    def release(self):
+        self.active_queries -= 1
+        if self.retired and self.active_queries == 0:
+            self._drop()
+
+    def retire(self):
+        self.retired = True
+        if self.active_queries == 0:
+            self._drop()
+
+    def _drop(self):
+        # Stores backed by other processes, such as sharded vector stores, stop them
+        for store in self.stores.values():
+            if hasattr(store, "close"):
+                store.close()
+        self.stores = {}
+        self.snapshot = None
+        metrics.increment("store_generation.released")
+        logger.info(f"Store generation {self.number} released")
+
+
+class GenerationStore:
+    """Class attribute that resolves to the same named store of the instance's current generation."""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return instance.generation.stores[self.name]
+
+    def __set__(self, instance, store):
+        instance.generation.stores[self.name] = store
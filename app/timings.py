@@ -0,0 +1,38 @@
+import time
+from contextlib import contextmanager
+
+
+class Timings:
+    """Collects the wall-clock duration of each named stage of a request."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] = time.perf_counter() - start
+
+    def record(self, stage, seconds):
+        self.stages[stage] = seconds
+
+    async def run(self, stage, awaitable):
+        with self.measure(stage):
+            return await awaitable
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    def to_dict(self):
+        return {
+            "stages_ms": {stage: round(seconds * 1000, 2) for stage, seconds in self.stages.items()},
+            "total_ms": round(self.elapsed() * 1000, 2),
+        }
+
+    def __str__(self):
+        stages = ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in self.stages.items())
+        return f"{stages} (total {self.elapsed() * 1000:.0f}ms)"
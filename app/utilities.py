@@ -5,16 +5,23 @@ import json
 import os
 import pathlib
 import re
+import unicodedata
 from hashlib import md5
 from typing import List
 
-import tiktoken
-
 from app.definitions import COMPLETION_MODEL
+from app.logger import logger
 
 tiktoken_encoders = {}
 
 
+class ApproximateEncoder:
+    """Stands in for a tiktoken encoding that can't be loaded, counting a token per word or punctuation mark."""
+
+    def encode(self, text):
+        return re.findall(r"\w+|[^\w\s]", text)
+
+
 def create_file_if_not_exists(file_path, default_content=""):
     if not os.path.exists(file_path):
         write_file(file_path, default_content)
@@ -59,10 +66,30 @@ def get_docs(root_dir):
     return text_files
 
 
+def get_relative_path(path, root_dir):
+    """
+    Returns path relative to root_dir. Paths recorded on another machine are matched on a directory with the same name
+    as root_dir, and other paths are returned unchanged.
+    """
+    if path.startswith(root_dir + os.sep):
+        return os.path.relpath(path, root_dir)
+    marker = os.sep + os.path.basename(root_dir) + os.sep
+    return path.rsplit(marker, 1)[1] if marker in path else path
+
+
 def make_hash(text, prefix=""):
     return prefix + md5(text.encode()).hexdigest()
 
 
+def normalize_entity_name(name: str) -> str:
+    """Fold an entity name to a canonical key so case, article and whitespace variants share one node."""
+    key = unicodedata.normalize("NFKC", name).casefold()
+    key = re.sub(r"[\"'`]", "", key)
+    key = re.sub(r"\s+", " ", key).strip()
+    # "a" and "an" only go before several words, so names like "A Record" keep theirs
+    return re.sub(r"^(the (?=\S)|an? (?=\S+ \S))", "", key)
+
+
 def add_to_json(file_path, key, value):
     with open(file_path, "r+") as f:
         data = json.load(f)
@@ -128,7 +155,13 @@ def truncate_list_by_token_size(data_list, get_text_for_row, max_token_size=4000
 def get_encoded_tokens(text, model=COMPLETION_MODEL):
     global tiktoken_encoders
     if not model in tiktoken_encoders:
-        tiktoken_encoders[model] = tiktoken.encoding_for_model(model)
+        import tiktoken
+        try:
+            tiktoken_encoders[model] = tiktoken.encoding_for_model(model)
+        except Exception as e:
+            # tiktoken downloads an encoding on first use, offline the token budgets are approximated instead
+            logger.warning(f"Could not load the tiktoken encoding for {model}, approximating token counts: {e}")
+            tiktoken_encoders[model] = ApproximateEncoder()
 
     return tiktoken_encoders[model].encode(text)
 
@@ -142,3 +175,18 @@ def list_of_list_to_csv(data: List[List[str]]) -> str:
     writer = csv.writer(output)
     writer.writerows(data)
     return output.getvalue()
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuses several rankings of ids with reciprocal rank fusion, each id scores the sum of 1 / (k + rank).
+
+    :param rankings: Lists of ids, best first.
+    :param k: Damping constant, higher values flatten the contribution of the top ranks.
+    :return: List of (id, score) tuples, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
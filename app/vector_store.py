@@ -1,27 +1,247 @@
 import asyncio
+import copy
+import json
+import os
+import threading
+from collections import defaultdict
 
-from nano_vectordb import NanoVectorDB
+import numpy as np
+from nano_vectordb.dbs import array_to_buffer_string, load_storage
+
+from app.logger import logger
+
+
+def normalize(vectors):
+    # A zero vector stays zero instead of turning into NaNs, and scores 0 against everything
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
 
 
 class NanoVectorStore:
-    def __init__(self, storage_file, dimensions):
+    """
+    Cosine similarity vector store held in memory as a row list and a normalised float32 matrix, read from and saved
+    to a file in the NanoVectorDB format.
+    """
+
+    def __init__(self, storage_file, dimensions, coarse_dimensions=None, coarse_candidates=100):
+        """
+        :param storage_file: Path of the NanoVectorDB file.
+        :param dimensions: Vector dimensions.
+        :param coarse_dimensions: Enables two-stage search: queries first scan a copy of the vectors truncated to this
+            many leading dimensions and renormalised, then only the best coarse_candidates rows are scored at full
+            dimension. Only suited to Matryoshka embeddings such as text-embedding-3, whose leading dimensions carry
+            most of the meaning.
+        :param coarse_candidates: Rows re-scored at full dimension per query, at least top_k.
+        """
         self.storage_file = storage_file
         self.dimensions = dimensions
-        self.db = NanoVectorDB(self.dimensions, storage_file=storage_file)
+        self.coarse_dimensions = coarse_dimensions
+        self.coarse_candidates = coarse_candidates
+        self._data = None
+        self._matrix = None
+        self._filter_index = None
+        self._coarse_matrix = None
+        self._load_lock = threading.Lock()
         self._lock = asyncio.Lock()
 
+    @property
+    def is_loaded(self):
+        return self._data is not None
+
+    def load(self):
+        """Reads the vectors from disk. Called on first use, or from a worker thread to warm the store up."""
+        with self._load_lock:
+            if self._data is not None:
+                return
+            storage = load_storage(self.storage_file)
+            if storage is None:
+                self.restore([], np.zeros((0, self.dimensions), dtype=np.float32))
+                return
+            if storage["embedding_dim"] != self.dimensions:
+                raise ValueError(
+                    f"{self.storage_file} has {storage['embedding_dim']} dimensions, expected {self.dimensions}"
+                )
+            self.restore(storage["data"], normalize(storage["matrix"]))
+            logger.info(f"Loaded {len(self._data)} vectors from {self.storage_file}")
+
+    def restore(self, data, matrix):
+        """Replaces the rows in memory, e.g. with the rows and normalised matrix returned by get_all()."""
+        self._data = data
+        self._matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, self.dimensions)
+        self._filter_index = None
+        self._coarse_matrix = None
+
+    def _get_storage(self):
+        if self._data is None:
+            self.load()
+        return self._data, self._matrix
+
+    def copy(self, storage_file=None):
+        """Returns an independent in-memory copy saving to storage_file, by default the same file, e.g. for staging."""
+        store = NanoVectorStore(
+            storage_file or self.storage_file, self.dimensions, self.coarse_dimensions, self.coarse_candidates
+        )
+        data, matrix = self._get_storage()
+        store.restore(copy.deepcopy(data), matrix.copy())
+        return store
+
+    def reopen(self, storage_file):
+        """Returns a new store over another file, read on first use, e.g. to resume a staging generation."""
+        return NanoVectorStore(storage_file, self.dimensions, self.coarse_dimensions, self.coarse_candidates)
+
+    def move(self, storage_file):
+        """Replaces storage_file with the saved file of this store, which saves there from now on."""
+        os.replace(self.storage_file, storage_file)
+        self.storage_file = storage_file
+
     async def upsert(self, rows):
+        """:param rows: Dicts with an "__id__", a "__vector__" and any other fields, replacing rows with the same id."""
+        rows = {row["__id__"]: row for row in rows}
+        if not rows:
+            return
+        vectors = normalize(np.array([row["__vector__"] for row in rows.values()], dtype=np.float32))
         async with self._lock:
-            self.db.upsert(rows)
+            data, matrix = self._get_storage()
+            positions = {row["__id__"]: i for i, row in enumerate(data)}
+            data, new_vectors = list(data), []
+            for row, vector in zip(rows.values(), vectors):
+                row = {key: value for key, value in row.items() if key != "__vector__"}
+                if row["__id__"] in positions:
+                    data[positions[row["__id__"]]] = row
+                    matrix[positions[row["__id__"]]] = vector
+                else:
+                    data.append(row)
+                    new_vectors.append(vector)
+            if new_vectors:
+                matrix = np.vstack([matrix, new_vectors])
+            self.restore(data, matrix)
 
     async def delete(self, ids):
         async with self._lock:
-            self.db.delete(ids)
+            data, matrix = self._get_storage()
+            ids = set(ids)
+            keep = [i for i, row in enumerate(data) if row["__id__"] not in ids]
+            self.restore([data[i] for i in keep], matrix[keep])
+
+    async def query(self, query, top_k=10, better_than_threshold=0.02, filter=None):
+        """
+        :param query: Query vector.
+        :param top_k: Number of results.
+        :param better_than_threshold: Minimum score for a result to be returned.
+        :param filter: Optional dict restricting the rows scored, see get_ids.
+        """
+        return (await self.query_many([query], top_k, better_than_threshold, filter))[0]
+
+    async def query_many(self, queries, top_k=10, better_than_threshold=0.02, filter=None):
+        """
+        Runs several cosine similarity queries as a single matrix multiplication.
+
+        :param queries: Array of shape (n_queries, dimensions).
+        :param top_k: Number of results per query.
+        :param better_than_threshold: Minimum score for a result to be returned.
+        :param filter: Optional dict restricting the rows scored, see get_ids.
+        :return: One list of results per query, in the same format as query().
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimensions)
+        queries = normalize(queries)
+        async with self._lock:
+            data, matrix = self._get_storage()
+            rows = np.arange(len(data)) if filter is None else self._get_filtered_rows(filter)
+            if not len(rows):
+                return [[] for _ in queries]
+            candidates = max(top_k, self.coarse_candidates)
+            if self.coarse_dimensions and len(rows) > candidates:
+                # The coarse pass picks each query's candidates, which are then scored at full dimension
+                coarse_queries = queries[:, :self.coarse_dimensions]
+                coarse_queries = normalize(coarse_queries)
+                coarse_matrix = self._get_coarse_matrix()
+                coarse_scores = coarse_queries @ (coarse_matrix if filter is None else coarse_matrix[rows]).T
+                query_rows = rows[np.argpartition(-coarse_scores, candidates - 1, axis=1)[:, :candidates]]
+                scores = np.einsum("qd,qcd->qc", queries, matrix[query_rows])
+            else:
+                # Filtering happens before scoring, only the candidate rows are multiplied
+                query_rows = np.broadcast_to(rows, (len(queries), len(rows)))
+                scores = queries @ (matrix if filter is None else matrix[rows]).T
+            k = min(top_k, scores.shape[1])
+            top_indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            results = []
+            for query_scores, candidate_rows, indices in zip(scores, query_rows, top_indices):
+                indices = indices[np.argsort(-query_scores[indices])]
+                results.append([
+                    {**data[candidate_rows[i]], "__metrics__": query_scores[i]}
+                    for i in indices
+                    if better_than_threshold is None or query_scores[i] >= better_than_threshold
+                ])
+            return results
+
+    async def get_ids(self, filter):
+        """
+        :param filter: Dict with any of "doc_ids", rows whose __doc_id__ is one of them, and "inserted_after" /
+            "inserted_before", rows whose __inserted_at__ timestamp falls in the range. Fields are combined with AND.
+        :return: The ids of the rows matching the filter.
+        """
+        async with self._lock:
+            data, _ = self._get_storage()
+            return [data[i]["__id__"] for i in self._get_filtered_rows(filter)]
+
+    async def get_first_id(self):
+        """:return: The id of the first row, or None when the store is empty."""
+        async with self._lock:
+            data, _ = self._get_storage()
+            return data[0]["__id__"] if data else None
+
+    def _get_filter_index(self):
+        # Built on first use and dropped on every write: a row list per doc id and a column of insertion times
+        if self._filter_index is None:
+            data, _ = self._get_storage()
+            doc_rows = defaultdict(list)
+            for i, row in enumerate(data):
+                doc_rows[row.get("__doc_id__")].append(i)
+            self._filter_index = {
+                "doc_rows": {doc_id: np.array(rows) for doc_id, rows in doc_rows.items()},
+                "inserted_at": np.array([row.get("__inserted_at__", np.nan) for row in data], dtype=np.float64),
+            }
+        return self._filter_index
+
+    def _get_coarse_matrix(self):
+        # Built on first use and dropped on every write, like the filter index
+        if self._coarse_matrix is None:
+            _, matrix = self._get_storage()
+            self._coarse_matrix = np.ascontiguousarray(normalize(matrix[:, :self.coarse_dimensions]), dtype=np.float32)
+        return self._coarse_matrix
+
+    def _get_filtered_rows(self, filter):
+        index = self._get_filter_index()
+        mask = np.ones(len(index["inserted_at"]), dtype=bool)
+        if filter.get("doc_ids") is not None:
+            doc_mask = np.zeros_like(mask)
+            for doc_id in filter["doc_ids"]:
+                if doc_id in index["doc_rows"]:
+                    doc_mask[index["doc_rows"][doc_id]] = True
+            mask &= doc_mask
+        if filter.get("inserted_after") is not None:
+            mask &= index["inserted_at"] >= filter["inserted_after"]
+        if filter.get("inserted_before") is not None:
+            mask &= index["inserted_at"] < filter["inserted_before"]
+        return np.flatnonzero(mask)
 
-    async def query(self, query, top_k=10, better_than_threshold=0.02):
+    async def get_all(self):
+        """
+        :return: The row metadata, in matrix order, and a copy of the normalised vector matrix.
+        """
         async with self._lock:
-            return self.db.query(query=query, top_k=top_k, better_than_threshold=better_than_threshold)
+            data, matrix = self._get_storage()
+            return list(data), matrix.copy()
 
     async def save(self):
+        # Written to a temporary file first, so a crash mid-write never leaves a truncated store
         async with self._lock:
-            self.db.save()
+            data, matrix = self._get_storage()
+            tmp_file = f"{self.storage_file}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"embedding_dim": self.dimensions, "data": data, "matrix": array_to_buffer_string(matrix)},
+                    f,
+                    ensure_ascii=False
+                )
+            os.replace(tmp_file, self.storage_file)
@@ -0,0 +1,60 @@
+"""
+Measures SmolRag's own overhead, without provider latency: ingests app/input_docs with the in-process LocalLlm into a
+temporary data directory, then times every query type over the evaluation queries. The stub completer extracts no
+entities, so the knowledge graph query types only time their empty paths.
+
+Run from the project root with: python -m benchmarks.local_backend [queries]
+"""
+import asyncio
+import logging
+import statistics
+import sys
+import tempfile
+import time
+
+from app.chunking import naive_overlap_excerpts
+from app.definitions import EVALUATION_DATA_SET, INPUT_DOCS_DIR
+from app.llm_scheduler import LlmScheduler
+from app.local_llm import LocalLlm
+from app.smol_rag import SmolRag
+from app.utilities import get_docs, get_json
+
+QUERY_TYPES = ["query", "hybrid_query", "local_kg_query", "global_kg_query", "hybrid_kg_query", "mix_query"]
+
+
+async def main(query_count):
+    queries = [row["query"] for row in get_json(EVALUATION_DATA_SET)][:query_count]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        smol_rag = SmolRag(
+            llm=LocalLlm(),
+            # Unlimited budgets, so the scheduler never waits
+            llm_scheduler=LlmScheduler(10 ** 9, 10 ** 12),
+            data_dir=tmp_dir,
+            # The default chunker needs the nltk sentence tokenizer data
+            excerpt_fn=naive_overlap_excerpts,
+        )
+        documents = len(get_docs(INPUT_DOCS_DIR))
+        start = time.perf_counter()
+        await smol_rag.import_documents()
+        elapsed = time.perf_counter() - start
+        excerpts = len(await smol_rag.excerpt_kv.get_all())
+        print(f"import_documents: {documents} documents, {excerpts} excerpts in {elapsed:.2f} s "
+              f"({documents / elapsed:.1f} documents/s)")
+
+        print(f"\n{len(queries)} queries per type")
+        for query_type in QUERY_TYPES:
+            query = getattr(smol_rag, query_type)
+            await query(queries[0])
+            timings = []
+            for text in queries:
+                start = time.perf_counter()
+                await query(text)
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print(f"{query_type:<16} p50 {statistics.median(timings) * 1000:7.2f} ms   "
+                  f"p95 {timings[int(len(timings) * 0.95)] * 1000:7.2f} ms")
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
@@ -0,0 +1,86 @@
+"""
+Compares two-stage Matryoshka vector search (a scan of the vectors truncated to their leading dimensions, then
+re-scoring of the best candidates at full dimension) with the exhaustive full-dimension scan, for speed and recall@k.
+
+Queries are midpoints of random pairs of stored excerpt vectors. Recall is measured on app/data/embeddings_db.json as
+is, and speed and recall on a larger store grown to the given number of rows from noisy copies of its vectors.
+
+Run from the project root with: python -m benchmarks.matryoshka_search [rows]
+"""
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from app.definitions import EMBEDDINGS_DB
+from app.vector_store import NanoVectorStore
+
+QUERIES = 100
+TOP_K = 10
+SETTINGS = [(256, 50), (256, 100), (256, 200), (512, 50), (512, 100), (512, 200)]
+
+
+def make_queries(matrix, rng):
+    pairs = rng.integers(len(matrix), size=(QUERIES, 2))
+    queries = matrix[pairs[:, 0]] + matrix[pairs[:, 1]]
+    return queries / np.linalg.norm(queries, axis=-1, keepdims=True)
+
+
+def grow(data, matrix, rows, rng):
+    # Noise follows the spread of each dimension, so the copies keep the Matryoshka structure of the originals
+    sources = rng.integers(len(matrix), size=rows)
+    vectors = matrix[sources] + rng.normal(size=(rows, matrix.shape[1])) * matrix.std(axis=0) * 0.5
+    return [
+        {**data[source], "__id__": f"{data[source]['__id__']}-{i}", "__vector__": vector}
+        for i, (source, vector) in enumerate(zip(sources, vectors.astype(np.float32)))
+    ]
+
+
+async def search(store, queries):
+    results, timings = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(await store.query(query, top_k=TOP_K, better_than_threshold=None))
+        timings.append(time.perf_counter() - start)
+    return [{row["__id__"] for row in rows} for rows in results], statistics.median(timings)
+
+
+async def benchmark(name, rows, dimensions, queries):
+    print(f"\n{name}: {len(rows)} rows, {dimensions} dimensions, recall@{TOP_K} over {len(queries)} queries")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        exhaustive = NanoVectorStore(os.path.join(tmp_dir, "exhaustive.json"), dimensions)
+        await exhaustive.upsert([dict(row) for row in rows])
+        expected, baseline = await search(exhaustive, queries)
+        print(f"{'exhaustive':<24} {baseline * 1000:8.2f} ms/query")
+        for coarse_dimensions, coarse_candidates in SETTINGS:
+            store = NanoVectorStore(
+                os.path.join(tmp_dir, "two_stage.json"), dimensions, coarse_dimensions, coarse_candidates
+            )
+            await store.upsert([dict(row) for row in rows])
+            await store.query(queries[0], top_k=TOP_K)
+            actual, timing = await search(store, queries)
+            recall = statistics.mean(len(e & a) / len(e) for e, a in zip(expected, actual))
+            print(f"{f'{coarse_dimensions} dims, {coarse_candidates} cands':<24} {timing * 1000:8.2f} ms/query  "
+                  f"{baseline / timing:5.1f}x  recall {recall:.3f}")
+
+
+async def main(row_count):
+    rng = np.random.default_rng(0)
+    store = NanoVectorStore(EMBEDDINGS_DB, 1536)
+    data, matrix = await store.get_all()
+    if not data:
+        sys.exit(f"{EMBEDDINGS_DB} is empty, import some documents first")
+    rows = [{**row, "__vector__": vector} for row, vector in zip(data, matrix)]
+    queries = make_queries(matrix, rng)
+    await benchmark("Existing store", rows, matrix.shape[1], queries)
+    await benchmark("Grown store", grow(data, matrix, row_count, rng), matrix.shape[1], queries)
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000))
@@ -0,0 +1,80 @@
+"""
+Measures query throughput and latency of a ShardedVectorStore against shard count, with the in-process
+NanoVectorStore as the baseline. Random vectors stand in for embeddings; scores don't affect the cost of a scan.
+
+Run from the project root with: python -m benchmarks.sharded_vector_search [rows] [dimensions] [shard counts...]
+"""
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from app.sharded_vector_store import ShardedVectorStore
+from app.vector_store import NanoVectorStore
+
+QUERIES = 200
+CONCURRENCY = 8
+TOP_K = 10
+
+
+def make_rows(count, dimensions, rng):
+    return [
+        {"__id__": f"row-{i}", "__vector__": vector, "__doc_id__": f"doc-{i // 10}"}
+        for i, vector in enumerate(rng.normal(size=(count, dimensions)).astype(np.float32))
+    ]
+
+
+async def run_queries(store, queries):
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies = []
+
+    async def run(query):
+        async with semaphore:
+            start = time.perf_counter()
+            await store.query(query, top_k=TOP_K)
+            latencies.append(time.perf_counter() - start)
+
+    await store.query(queries[0], top_k=TOP_K)
+    start = time.perf_counter()
+    await asyncio.gather(*(run(query) for query in queries))
+    return latencies, time.perf_counter() - start
+
+
+async def benchmark(name, store, rows, queries):
+    for i in range(0, len(rows), 10000):
+        await store.upsert(rows[i:i + 10000])
+    latencies, elapsed = await run_queries(store, queries)
+    latencies = sorted(latencies)
+    print(f"{name:<12} {len(queries) / elapsed:8.1f} QPS   p50 {statistics.median(latencies) * 1000:7.2f} ms   "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:7.2f} ms")
+
+
+async def main(row_count, dimensions, shard_counts):
+    rng = np.random.default_rng(0)
+    queries = rng.normal(size=(QUERIES, dimensions)).astype(np.float32)
+    print(f"{row_count} rows, {dimensions} dimensions, {QUERIES} queries, {CONCURRENCY} concurrent, "
+          f"{os.cpu_count()} CPUs")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        await benchmark("in-process", NanoVectorStore(os.path.join(tmp_dir, "vdb.json"), dimensions),
+                        make_rows(row_count, dimensions, rng), queries)
+        for shards in shard_counts:
+            store = ShardedVectorStore(os.path.join(tmp_dir, f"vdb-{shards}"), dimensions, shards)
+            try:
+                await benchmark(f"{shards} shards", store, make_rows(row_count, dimensions, rng), queries)
+            finally:
+                store.close()
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    args = sys.argv[1:]
+    asyncio.run(main(
+        int(args[0]) if args else 100000,
+        int(args[1]) if len(args) > 1 else 1536,
+        [int(arg) for arg in args[2:]] or [1, 2, 4, 8],
+    ))
@@ -0,0 +1,47 @@
+"""
+Measures how long a fresh process takes to import api.main and answer, and how long the optional warm-up takes to
+load every store.
+
+Run from the project root with: python -m benchmarks.startup [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import api.main
+print(time.perf_counter() - start)
+"""
+
+WARM_UP_SCRIPT = """
+import asyncio, time
+import api.main
+start = time.perf_counter()
+asyncio.run(api.main.smol_rag.warm_up())
+print(time.perf_counter() - start)
+"""
+
+
+def time_script(script, runs):
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", script], cwd=root_dir, capture_output=True, text=True, check=True
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+
+def report(name, timings):
+    print(f"{name}: median {statistics.median(timings) * 1000:.0f} ms, "
+          f"min {min(timings) * 1000:.0f} ms, max {max(timings) * 1000:.0f} ms over {len(timings)} runs")
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    report("import api.main", time_script(IMPORT_SCRIPT, runs))
+    report("warm_up()", time_script(WARM_UP_SCRIPT, runs))
@@ -1,7 +1,75 @@
-from api.main import app
+import asyncio
+import sys
+from contextlib import asynccontextmanager
+from typing import List, Optional
 
-if __name__ == '__main__':
-    from fastmcp import FastMCP
+from fastapi import HTTPException
+
+from api.main import app, stream_map, submit_ingestion_job, corpora, smol_rag
+from app.definitions import WARM_UP
+
+
+def create_mcp_server(warm_up=False):
+    """
+    Returns an MCP server exposing every API endpoint as a tool, plus the streaming query and ingestion tools.
+
+    :param warm_up: Whether to load the stores in the background as soon as the server starts, so the first tool
+        calls don't pay for it.
+    """
+    from fastmcp import FastMCP, Context
+    from fastmcp.exceptions import ToolError
+
+    @asynccontextmanager
+    async def lifespan(_):
+        task = asyncio.create_task(smol_rag.warm_up()) if warm_up else None
+        yield
+        if task is not None:
+            task.cancel()
+
+    mcp_server = FastMCP.from_fastapi(app, lifespan=lifespan)
 
-    mcp_server = FastMCP.from_fastapi(app)
-    mcp_server.run(transport='stdio')
+    @mcp_server.tool()
+    async def stream_query(text: str, ctx: Context, query_type: str = "standard", corpus: Optional[str] = None) -> str:
+        """
+        Answer a query using SmolRag, forwarding the answer to the client as log messages while it is generated.
+        Query types: standard, hybrid, hybrid_kg, local_kg, global_kg, mix, community
+        """
+        method_name = stream_map.get(query_type.lower())
+        if method_name is None:
+            raise ValueError(f"Invalid query_type: {query_type}. Valid types are: {', '.join(stream_map.keys())}")
+        stream_func = getattr(corpora.get(corpus) if corpus else smol_rag, method_name)
+
+        chunks = []
+        buffer = ""
+        async for token in await stream_func(text):
+            chunks.append(token)
+            buffer += token
+            if "\n" in token or len(buffer) >= 80:
+                await ctx.info(buffer)
+                buffer = ""
+        if buffer:
+            await ctx.info(buffer)
+        return "".join(chunks)
+
+    @mcp_server.tool()
+    async def ingest_documents(ctx: Context, paths: Optional[List[str]] = None, corpus: Optional[str] = None) -> dict:
+        """
+        Ingest documents in the background and report progress until the job finishes. Paths are relative to the
+        input docs directory; omit them to ingest every new or changed document. Returns the finished job.
+        """
+        try:
+            job = submit_ingestion_job(paths, corpus)
+        except HTTPException as e:
+            raise ToolError(e.detail)
+        async for state in job.watch():
+            await ctx.report_progress(state["documents_done"], state["documents_total"] or None)
+            await ctx.info(f"{state['status']}: {state['documents_done']}/{state['documents_total']} documents, "
+                           f"{state['excerpts_done']} excerpts, ~{state['tokens']} tokens")
+        return job.to_dict()
+
+    return mcp_server
+
+
+if __name__ == '__main__':
+    # Each stdio launch starts a new process, warming up with WARM_UP set or the --warm-up flag
+    create_mcp_server(warm_up=WARM_UP or "--warm-up" in sys.argv[1:]).run(transport='stdio')
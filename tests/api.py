@@ -0,0 +1,80 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api.main
+from app.corpora import CorpusRegistry
+from app.llm_scheduler import LlmScheduler
+
+
+class FakeSmolRag:
+    """Streams a canned answer, or fails part way through it, as the streaming SmolRag query methods do."""
+
+    snapshot = None
+
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    def get_loaded_size(self):
+        return 0
+
+    async def query_stream(self, text, timings=None, **kwargs):
+        timings.record("retrieval", 0.01)
+
+        async def tokens():
+            for token in ["Checkout ", "takes ", "payments."]:
+                yield token
+            if self.fail:
+                raise RuntimeError("The completion failed")
+            timings.record("completion", 0.02)
+
+        return tokens()
+
+
+def make_client(monkeypatch, smol_rag):
+    corpora = CorpusRegistry(llm=object(), llm_scheduler=LlmScheduler())
+    corpora.register("docs", smol_rag)
+    monkeypatch.setattr(api.main, "corpora", corpora)
+    return TestClient(api.main.app)
+
+
+def get_events(response):
+    events = []
+    for message in response.text.strip().split("\n\n"):
+        event, data = message.split("\n")
+        events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+
+def test_query_stream_sends_timings_tokens_and_done_events(monkeypatch):
+    client = make_client(monkeypatch, FakeSmolRag())
+
+    response = client.post("/query/stream", json={"text": "What does Checkout do?", "corpus": "docs"})
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = get_events(response)
+    assert [event for event, _ in events] == ["timings", "token", "token", "token", "done"]
+    assert "".join(data for event, data in events if event == "token") == "Checkout takes payments."
+    assert set(events[0][1]["stages_ms"]) == {"retrieval"}
+    assert set(events[-1][1]["stages_ms"]) == {"retrieval", "completion"}
+
+
+def test_query_stream_reports_failures_as_an_error_event(monkeypatch):
+    client = make_client(monkeypatch, FakeSmolRag(fail=True))
+
+    events = get_events(client.post("/query/stream", json={"text": "What does Checkout do?", "corpus": "docs"}))
+
+    assert [event for event, _ in events] == ["timings", "token", "token", "token", "error"]
+    assert events[-1][1] == {"detail": "The completion failed"}
+
+
+@pytest.mark.parametrize("request_body, status_code", [
+    ({"text": " ", "corpus": "docs"}, 400),
+    ({"text": "What does Checkout do?", "query_type": "unknown", "corpus": "docs"}, 400),
+    ({"text": "What does Checkout do?", "corpus": "missing"}, 404),
+])
+def test_query_stream_rejects_invalid_requests(monkeypatch, request_body, status_code):
+    client = make_client(monkeypatch, FakeSmolRag())
+
+    assert client.post("/query/stream", json=request_body).status_code == status_code
@@ -0,0 +1,61 @@
+import asyncio
+
+from app.bm25_index import Bm25Index, tokenize
+
+
+def test_tokenize_keeps_identifiers_and_their_parts():
+    assert tokenize("Call /api/v2/plans with the plan_uuid") == [
+        "call", "api/v2/plans", "api", "v2", "plans", "plan_uuid", "plan", "uuid"
+    ]
+
+
+def test_query_ranks_exact_identifier_matches_first():
+    index = Bm25Index()
+    asyncio.run(index.build({
+        "a": "Plans can be listed from the dashboard.",
+        "b": "Send a request to /api/v2/plans to list plans.",
+        "c": "Licenses are created when a checkout completes.",
+    }))
+
+    results = asyncio.run(index.query("/api/v2/plans"))
+
+    assert [r["__id__"] for r in results] == ["b", "a"]
+    assert results[0]["__metrics__"] > results[1]["__metrics__"]
+    assert [r["__id__"] for r in asyncio.run(index.query("/api/v2/plans", ids={"a", "c"}))] == ["a"]
+
+
+def test_add_and_remove_update_the_index():
+    index = Bm25Index()
+    asyncio.run(index.build({"a": "checkout link"}))
+    asyncio.run(index.add_many({"b": "pricing table", "a": "license key"}))
+
+    assert [r["__id__"] for r in asyncio.run(index.query("checkout"))] == []
+    assert {r["__id__"] for r in asyncio.run(index.query("pricing license"))} == {"a", "b"}
+
+    asyncio.run(index.remove_many(["b", "missing"]))
+
+    assert len(index) == 1
+    assert "pricing" not in index.postings
+    assert index.total_length == index.doc_lengths["a"]
+
+
+def test_saved_index_loads_with_the_same_scores(tmp_path):
+    path = str(tmp_path / "bm25_index.json")
+    index = Bm25Index(path)
+    asyncio.run(index.build({"a": "checkout link", "b": "pricing table for the checkout"}))
+    asyncio.run(index.save())
+
+    loaded = Bm25Index(path)
+
+    assert asyncio.run(loaded.load())
+    assert asyncio.run(loaded.query("checkout")) == asyncio.run(index.query("checkout"))
+
+
+def test_index_is_only_saved_once_built(tmp_path):
+    path = tmp_path / "bm25_index.json"
+    index = Bm25Index(str(path))
+    asyncio.run(index.add_many({"a": "checkout link"}))
+    asyncio.run(index.save())
+
+    assert not path.exists()
+    assert not asyncio.run(index.load())
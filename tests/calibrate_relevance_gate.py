@@ -0,0 +1,45 @@
+import asyncio
+
+from app.calibrate_relevance_gate import calibrate_relevance_threshold, get_top_scores
+
+
+class FakeSmolRag:
+    def __init__(self, scores):
+        self.scores = scores
+
+    async def get_context(self, text, query_type):
+        return {"top_score": self.scores[text][query_type]}
+
+    async def _get_query_graph_score(self, text, low_level, high_level):
+        return self.scores[text]["graph"]
+
+
+def test_calibrate_relevance_threshold_keeps_target_recall():
+    in_domain = [0.2 + i / 100 for i in range(50)]
+    off_topic = [0.05, 0.1, 0.15, 0.25]
+
+    result = calibrate_relevance_threshold(in_domain, off_topic, target_recall=0.98)
+
+    assert result["threshold"] == 0.21
+    assert result["in_domain_pass_rate"] == 0.98
+    assert result["off_topic_rejection_rate"] == 0.75
+
+
+def test_calibrate_relevance_threshold_treats_missing_scores_as_zero():
+    result = calibrate_relevance_threshold([None, 0.5, 0.6, 0.7], [None], target_recall=0.75)
+
+    assert result["threshold"] == 0.5
+    assert result["off_topic_rejection_rate"] == 1.0
+
+
+def test_get_top_scores_takes_the_lower_of_the_gate_and_context_scores():
+    smol_rag = FakeSmolRag({
+        "plans": {"standard": 0.3, "graph": 0.35, "hybrid_kg": 0.5, "mix": 0.5},
+        "licenses": {"standard": 0.6, "graph": 0.7, "hybrid_kg": 0.4, "mix": 0.6},
+        "jellyfish": {"standard": 0.1, "graph": None, "hybrid_kg": 0.2, "mix": 0.2},
+    })
+    queries = ["plans", "licenses", "jellyfish"]
+
+    assert asyncio.run(get_top_scores(smol_rag, queries, "hybrid_kg")) == [0.35, 0.4, None]
+    assert asyncio.run(get_top_scores(smol_rag, queries, "mix")) == [0.3, 0.6, 0.1]
+    assert asyncio.run(get_top_scores(smol_rag, queries, "standard")) == [0.3, 0.6, 0.1]
@@ -0,0 +1,59 @@
+import pytest
+
+import app.context_assembler
+from app.context_assembler import ContextAssembler
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(app.context_assembler, "get_encoded_tokens", lambda text, model: text.split())
+
+
+def add_excerpts(assembler, rows):
+    assembler.add_source("excerpts", rows, get_key=lambda row: row["id"], get_text=lambda row: row["text"])
+
+
+def test_context_assembler_merges_rows_found_by_several_sources():
+    assembler = ContextAssembler(100)
+    add_excerpts(assembler, [{"id": "a", "text": "one"}, {"id": "b", "text": "two"}])
+    add_excerpts(assembler, [{"id": "b", "text": "two"}, {"id": "c", "text": "three"}])
+
+    selected, used_tokens = assembler.select()
+
+    assert [row["id"] for row in selected["excerpts"]] == ["b", "a", "c"]
+    assert used_tokens == 3
+
+
+def test_context_assembler_respects_token_budget():
+    assembler = ContextAssembler(5)
+    add_excerpts(assembler, [
+        {"id": "a", "text": "one two three"},
+        {"id": "b", "text": "four five six"},
+        {"id": "c", "text": "seven eight"},
+    ])
+    assembler.add_source("entities", [{"name": "X"}], get_key=lambda row: row["name"], get_text=lambda row: "x y z")
+
+    selected, used_tokens = assembler.select()
+
+    assert [row["id"] for row in selected["excerpts"]] == ["a", "c"]
+    assert selected["entities"] == []
+    assert used_tokens == 5
+
+
+def test_context_assembler_compares_scores_normalised_per_source():
+    assembler = ContextAssembler(3)
+    assembler.add_source(
+        "excerpts", [{"id": "a", "score": 0.9}, {"id": "b", "score": 0.3}],
+        get_key=lambda row: row["id"], get_text=lambda row: "text", get_score=lambda row: row["score"],
+    )
+    # Entity similarities sit lower, but the best entity matches as well as the best excerpt
+    assembler.add_source(
+        "entities", [{"id": "X", "score": 0.4}, {"id": "Y", "score": 0.38}],
+        get_key=lambda row: row["id"], get_text=lambda row: "text", get_score=lambda row: row["score"],
+    )
+
+    selected, used_tokens = assembler.select()
+
+    assert [row["id"] for row in selected["excerpts"]] == ["a"]
+    assert [row["id"] for row in selected["entities"]] == ["X", "Y"]
+    assert used_tokens == 3
@@ -0,0 +1,139 @@
+import asyncio
+from types import SimpleNamespace
+
+from app.corpora import CorpusRegistry
+from app.kv_store import JsonKvStore
+from app.llm_scheduler import LlmScheduler
+from app.openai_llm import OpenAiLlm
+
+DIMENSIONS = 8
+
+
+class FakeLlm:
+    async def get_completion(self, query, **kwargs):
+        return "An answer."
+
+    async def get_embedding(self, content, **kwargs):
+        return [1.0] * DIMENSIONS
+
+
+class FakeOpenAiClient:
+    """Answers with the system prompt it was given, so an answer shows which corpus its context came from."""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_completion))
+        self.embeddings = SimpleNamespace(create=self.create_embeddings)
+
+    def create_completion(self, model, messages, **kwargs):
+        content = messages[0]["content"] if messages[0]["role"] == "system" else "An answer."
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    def create_embeddings(self, model, input):
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[1.0] * DIMENSIONS) for i in range(len(input))])
+
+
+def make_registry(tmp_path, names, llm=None, vector_shards=0, **kwargs):
+    corpora = CorpusRegistry(llm=llm or FakeLlm(), llm_scheduler=LlmScheduler(), **kwargs)
+    for name in names:
+        (tmp_path / name / "input_docs").mkdir(parents=True)
+        (tmp_path / name / "input_docs" / f"{name}.md").write_text(f"The {name} corpus explains {name} plans.")
+    corpora.register_dir(
+        str(tmp_path),
+        dimensions=DIMENSIONS,
+        excerpt_fn=lambda content, size, overlap: [content],
+        vector_shards=vector_shards,
+    )
+    return corpora
+
+
+def ingest(corpora, name):
+    asyncio.run(corpora.get(name).import_documents())
+
+
+def test_corpora_are_created_on_first_use_and_share_the_llm(tmp_path):
+    corpora = make_registry(tmp_path, ["alpha", "beta"])
+
+    assert list(corpora.loaded) == []
+
+    ingest(corpora, "alpha")
+    ingest(corpora, "beta")
+    alpha, beta = corpora.get("alpha"), corpora.get("beta")
+
+    assert alpha.llm is beta.llm is corpora.llm
+    assert alpha.llm_scheduler is beta.llm_scheduler is corpora.llm_scheduler
+    assert [source.rsplit("/", 1)[-1] for source in alpha.source_to_doc_kv.store] == ["alpha.md"]
+    assert [source.rsplit("/", 1)[-1] for source in beta.source_to_doc_kv.store] == ["beta.md"]
+    assert (tmp_path / "beta" / "data" / "excerpt_db.json").exists()
+
+
+def test_shared_llm_cache_answers_each_corpus_from_its_own_context(tmp_path):
+    llm = OpenAiLlm(
+        query_cache_kv=JsonKvStore(str(tmp_path / "query_cache.json")),
+        embedding_cache_kv=JsonKvStore(str(tmp_path / "embedding_cache.json")),
+        openai_api_key=FakeOpenAiClient()
+    )
+    corpora = make_registry(tmp_path / "corpora", ["alpha", "beta"], llm=llm)
+
+    async def ask_both():
+        # One event loop throughout, the shared cache stores are bound to it
+        answers = []
+        for name in ("alpha", "beta"):
+            await corpora.get(name).import_documents()
+            answers.append(await corpora.get(name).query("Which plans are there?"))
+        return answers
+
+    alpha_answer, beta_answer = asyncio.run(ask_both())
+
+    assert "alpha plans" in alpha_answer and "beta" not in alpha_answer
+    assert "beta plans" in beta_answer and "alpha" not in beta_answer
+
+
+def test_least_recently_used_corpus_is_evicted_over_the_memory_budget(tmp_path):
+    corpora = make_registry(tmp_path, ["alpha", "beta", "gamma"], memory_budget=0)
+    corpora.register("resident", corpora.get("gamma"))
+    ingest(corpora, "alpha")
+    alpha = corpora.get("alpha")
+
+    ingest(corpora, "beta")
+
+    assert "alpha" not in corpora.loaded
+    assert "resident" in corpora.loaded
+    assert corpora.get_status()["beta"]["size"] > 0
+
+    reloaded = corpora.get("alpha")
+    assert reloaded is not alpha
+    assert len(reloaded.excerpt_kv.store) == 1
+
+
+def test_idle_corpus_is_evicted_unless_busy(tmp_path):
+    corpora = make_registry(tmp_path, ["alpha", "beta"], idle_seconds=60)
+    alpha = corpora.get("alpha")
+    corpora.get("beta")
+    corpora.last_used = {name: last_used - 120 for name, last_used in corpora.last_used.items()}
+
+    with alpha._pin_generation():
+        assert corpora.evict() == ["beta"]
+
+    assert corpora.evict() == ["alpha"]
+    assert corpora.loaded == {}
+
+
+def test_sharded_corpus_is_sized_and_its_workers_stopped_on_eviction(tmp_path):
+    corpora = make_registry(tmp_path, ["alpha", "beta"], vector_shards=2, idle_seconds=60)
+    alpha = corpora.get("alpha")
+    vector_stores = [alpha.embeddings_db, alpha.entities_db, alpha.relationships_db]
+    try:
+        asyncio.run(alpha.import_documents())
+        asyncio.run(alpha.warm_up())
+        size = corpora.get_status()["alpha"]["size"]
+        corpora.last_used["alpha"] -= 120
+        evicted = corpora.evict()
+        loaded = [store.is_loaded for store in vector_stores]
+    finally:
+        for store in vector_stores:
+            store.close()
+
+    # Once warmed up every store is loaded, so every file of the corpus counts
+    assert size == sum(path.stat().st_size for path in (tmp_path / "alpha" / "data").rglob("*") if path.is_file())
+    assert evicted == ["alpha"]
+    assert loaded == [False, False, False]
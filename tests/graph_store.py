@@ -0,0 +1,104 @@
+import asyncio
+
+from app.definitions import KG_SEP
+from app.graph_store import NetworkXGraphStore
+
+
+def test_merge_batch_appends_values(tmp_path):
+    store = NetworkXGraphStore(str(tmp_path / "kg.graphml"))
+    entity = ("Checkout", {"category": "feature", "description": "Takes payments.", "excerpt_id": "excerpt_1"})
+    relationship = (("Checkout", "Stripe"), {
+        "description": "Checkout uses Stripe.",
+        "keywords": "payments",
+        "weight": 1.0,
+        "excerpt_id": "excerpt_1",
+    })
+
+    asyncio.run(store.merge_batch([entity], [relationship]))
+    asyncio.run(store.merge_batch(
+        [("Checkout", {"category": "feature", "description": "A web component.", "excerpt_id": "excerpt_2"})],
+        [relationship],
+    ))
+
+    node = store.get_node("Checkout")
+    assert node["category"] == "feature"
+    assert node["description"] == KG_SEP.join(["Takes payments.", "A web component."])
+    assert node["excerpt_id"] == KG_SEP.join(["excerpt_1", "excerpt_2"])
+    edge = store.get_edge(("Checkout", "Stripe"))
+    assert edge["description"] == "Checkout uses Stripe."
+    assert edge["weight"] == 2.0
+
+
+def test_concurrent_merges_are_not_lost(tmp_path):
+    store = NetworkXGraphStore(str(tmp_path / "kg.graphml"))
+
+    async def merge_all():
+        await asyncio.gather(*[
+            store.merge_batch([("Salable", {"description": "Salable.", "excerpt_id": f"excerpt_{i}"})])
+            for i in range(50)
+        ])
+        await store.save()
+
+    asyncio.run(merge_all())
+
+    assert len(store.get_node("Salable")["excerpt_id"].split(KG_SEP)) == 50
+    assert NetworkXGraphStore(str(tmp_path / "kg.graphml")).get_node("Salable") == store.get_node("Salable")
+
+
+def test_writes_wait_for_a_save_in_progress(tmp_path):
+    store = NetworkXGraphStore(str(tmp_path / "kg.graphml"))
+    # Big enough that the writes below are scheduled while the save is still serialising the graph in its thread
+    entities = [(f"Entity {i}", {"description": "Saved." * 20}) for i in range(5000)]
+
+    async def run():
+        await store.merge_batch(entities)
+        saving = asyncio.create_task(store.save())
+        await asyncio.sleep(0)
+        writes = [
+            *(store.merge_batch([(f"Late {i}", {"description": "Not saved."})]) for i in range(50)),
+            store.update_batch([("Entity 0", {"description": "Not saved."})]),
+            store.set_field("content_keywords", "not saved"),
+        ]
+        await asyncio.gather(saving, *writes)
+
+    asyncio.run(run())
+
+    saved = NetworkXGraphStore(str(tmp_path / "kg.graphml"))
+    assert len(saved.get_nodes()) == 5000
+    assert saved.get_node("Entity 0")["description"] == "Saved." * 20
+    assert "content_keywords" not in saved.graph.graph
+    assert len(store.get_nodes()) == 5050
+    assert store.graph.graph["content_keywords"] == "not saved"
+
+
+def test_update_batch_skips_missing_items(tmp_path):
+    store = NetworkXGraphStore(str(tmp_path / "kg.graphml"))
+    asyncio.run(store.merge_batch([("Checkout", {"description": "Takes payments."})]))
+
+    asyncio.run(store.update_batch(
+        entities=[("Checkout", {"content_hash": "cnt-1"}), ("Missing", {"content_hash": "cnt-2"})],
+        relationships=[(("Checkout", "Missing"), {"content_hash": "cnt-3"})],
+    ))
+
+    assert store.get_node("Checkout")["content_hash"] == "cnt-1"
+    assert store.get_node("Missing") is None
+    assert store.get_edge(("Checkout", "Missing")) is None
+
+
+def test_get_communities_groups_connected_entities(tmp_path):
+    store = NetworkXGraphStore(str(tmp_path / "kg.graphml"))
+    asyncio.run(store.merge_batch(relationships=[
+        (("Checkout", "Stripe"), {"weight": 3.0}),
+        (("Checkout", "Pricing table"), {"weight": 3.0}),
+        (("Pricing table", "Stripe"), {"weight": 3.0}),
+        (("Signature header", "Webhook"), {"weight": 3.0}),
+        (("Webhook", "Event"), {"weight": 3.0}),
+        (("Event", "Checkout"), {"weight": 0.1}),
+    ]))
+
+    communities = store.get_communities()
+
+    assert sorted(communities) == [["Checkout", "Pricing table", "Stripe"], ["Event", "Signature header", "Webhook"]]
+    assert [
+        ({source, target}, data) for source, target, data in store.get_community_edges(["Signature header", "Webhook"])
+    ] == [({"Signature header", "Webhook"}, {"weight": 3.0})]
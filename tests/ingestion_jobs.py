@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from app.bm25_index import Bm25Index
+from app.graph_store import NetworkXGraphStore
+from app.ingestion_jobs import IngestionJobs
+from app.kv_store import JsonKvStore
+from app.smol_rag import SmolRag
+from app.snapshot import KV_STORES, VECTOR_STORES
+from app.vector_store import NanoVectorStore
+
+DIMENSIONS = 8
+
+
+class FakeLlm:
+    def __init__(self, blocked_text=None):
+        self.blocked_text = blocked_text
+        self.unblocked = asyncio.Event()
+
+    async def get_completion(self, query, **kwargs):
+        if self.blocked_text and self.blocked_text in query:
+            await self.unblocked.wait()
+        return "A summary."
+
+    async def get_embedding(self, content, **kwargs):
+        return [1.0] * DIMENSIONS
+
+
+def make_smol_rag(tmp_path, llm):
+    stores = {name: NanoVectorStore(str(tmp_path / f"{name}.json"), DIMENSIONS) for name in VECTOR_STORES}
+    stores.update({name: JsonKvStore(str(tmp_path / f"{name}.json")) for name in KV_STORES})
+    return SmolRag(
+        llm=llm,
+        excerpt_fn=lambda content, size, overlap: [content],
+        graph_db=NetworkXGraphStore(str(tmp_path / "kg.graphml")),
+        bm25_index=Bm25Index(str(tmp_path / "bm25_index.json")),
+        dimensions=DIMENSIONS,
+        **stores,
+    )
+
+
+@pytest.fixture
+def docs(tmp_path):
+    docs_dir = tmp_path / "docs"
+    docs_dir.mkdir()
+    (docs_dir / "alpha.md").write_text("Alpha explains plans.")
+    (docs_dir / "beta.md").write_text("Beta explains licenses.")
+    return str(docs_dir)
+
+
+async def wait_for(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+
+def test_ingestion_job_reports_progress(tmp_path, docs):
+    smol_rag = make_smol_rag(tmp_path, FakeLlm())
+
+    async def run():
+        jobs = IngestionJobs(smol_rag)
+        job = jobs.submit([docs])
+        states = [state async for state in job.watch()]
+        return job, states
+
+    job, states = asyncio.run(run())
+
+    assert job.status == "completed"
+    assert states[-1]["documents_done"] == 2
+    assert states[-1]["excerpts_done"] == 2
+    assert states[-1]["tokens"] > 0
+    assert len(smol_rag.excerpt_kv.store) == 2
+    assert smol_rag.generation.number == 1
+
+
+def test_cancelled_job_keeps_live_index_and_resumes_from_checkpoint(tmp_path, docs):
+    async def run():
+        smol_rag = make_smol_rag(tmp_path, FakeLlm(blocked_text="Beta"))
+        jobs = IngestionJobs(smol_rag)
+        job = jobs.submit([docs])
+        await wait_for(lambda: job.documents_done == 1)
+        await jobs.cancel(job.id)
+        live_excerpts = await smol_rag.excerpt_kv.get_all()
+
+        resumed_smol_rag = make_smol_rag(tmp_path, FakeLlm())
+        resumed_job = IngestionJobs(resumed_smol_rag).submit([docs])
+        await wait_for(lambda: resumed_job.is_finished)
+        return job, live_excerpts, resumed_job, resumed_smol_rag
+
+    job, live_excerpts, resumed_job, resumed_smol_rag = asyncio.run(run())
+
+    assert job.status == "cancelled"
+    assert live_excerpts == {}
+    assert resumed_job.status == "completed"
+    assert resumed_job.documents_skipped == 1
+    assert resumed_job.documents_done == 1
+    assert len(resumed_smol_rag.source_to_doc_kv.store) == 2
+
+
+def test_cancelled_job_resumes_from_checkpoint_in_the_same_process(tmp_path, docs):
+    llm = FakeLlm(blocked_text="Beta")
+    smol_rag = make_smol_rag(tmp_path, llm)
+
+    async def run():
+        jobs = IngestionJobs(smol_rag)
+        job = jobs.submit([docs])
+        await wait_for(lambda: job.documents_done == 1)
+        await jobs.cancel(job.id)
+
+        llm.unblocked.set()
+        resumed_job = jobs.submit([docs])
+        await wait_for(lambda: resumed_job.is_finished)
+        return resumed_job
+
+    resumed_job = asyncio.run(run())
+
+    assert resumed_job.status == "completed"
+    assert resumed_job.documents_skipped == 1
+    assert resumed_job.documents_done == 1
+    assert len(smol_rag.source_to_doc_kv.store) == 2
+    assert not (tmp_path / "staging").exists()
@@ -0,0 +1,28 @@
+from app.keyword_extractor import extract_keywords
+
+
+def test_extract_keywords_splits_phrases_on_stop_words():
+    keywords = extract_keywords("How does the Salable checkout handle pricing plans?")
+
+    assert keywords["high_level_keywords"] == ["Salable checkout handle pricing plans"]
+    assert keywords["low_level_keywords"] == ["Salable", "checkout", "handle", "pricing", "plans"]
+
+
+def test_extract_keywords_ranks_specific_words_first():
+    keywords = extract_keywords("How do I use the plan_uuid in the v2 API?")
+
+    assert keywords["low_level_keywords"] == ["plan_uuid", "v2", "API"]
+    assert keywords["high_level_keywords"] == ["v2 API"]
+
+
+def test_extract_keywords_falls_back_to_single_word_phrases():
+    keywords = extract_keywords("what is SmolRag?")
+
+    assert keywords == {"high_level_keywords": ["SmolRag"], "low_level_keywords": ["SmolRag"]}
+
+
+def test_extract_keywords_limits_results():
+    keywords = extract_keywords(" and ".join(f"word{i} term{i}" for i in range(20)), max_keywords=5)
+
+    assert len(keywords["high_level_keywords"]) == 5
+    assert len(keywords["low_level_keywords"]) == 5
@@ -0,0 +1,31 @@
+import asyncio
+
+from app.kv_store import JsonKvStore
+
+
+def test_many_operations(tmp_path):
+    store = JsonKvStore(str(tmp_path / "kv.json"))
+
+    asyncio.run(store.add_many({"a": 1, "b": 2, "c": 3}))
+    assert asyncio.run(store.get_many(["c", "missing", "a"])) == [3, None, 1]
+
+    asyncio.run(store.remove_many(["a", "missing"]))
+    assert asyncio.run(store.get_all()) == {"b": 2, "c": 3}
+
+
+def test_save_and_reload(tmp_path):
+    store = JsonKvStore(str(tmp_path / "kv.json"))
+    asyncio.run(store.add_many([("a", {"excerpt": "text"})]))
+    asyncio.run(store.save())
+
+    assert asyncio.run(JsonKvStore(str(tmp_path / "kv.json")).get_by_key("a")) == {"excerpt": "text"}
+
+
+def test_store_is_loaded_on_first_use(tmp_path):
+    file_path = tmp_path / "kv.json"
+    file_path.write_text('{"a": 1}')
+    store = JsonKvStore(str(file_path))
+
+    assert not store.is_loaded
+    assert asyncio.run(store.get_by_key("a")) == 1
+    assert store.is_loaded
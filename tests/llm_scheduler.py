@@ -0,0 +1,82 @@
+import asyncio
+
+import httpx
+import openai
+
+from app.llm_scheduler import LlmScheduler, Priority, TokenBucket, get_retry_after
+
+
+def make_rate_limit_error(retry_after):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(429, headers={"retry-after": retry_after}, request=request)
+    return openai.RateLimitError("Rate limited", response=response, body=None)
+
+
+def test_get_retry_after_reads_header():
+    assert get_retry_after(make_rate_limit_error("1.5")) == 1.5
+    assert get_retry_after(ValueError()) is None
+
+
+def test_scheduler_serves_interactive_calls_before_ingestion():
+    async def run():
+        scheduler = LlmScheduler(requests_per_minute=60)
+        order = []
+
+        async def call(name, priority):
+            await scheduler.acquire("model", priority=priority)
+            order.append(name)
+
+        # The first call takes the only request in the bucket, the rest queue until it refills
+        first = asyncio.create_task(call("first", Priority.INGESTION))
+        await asyncio.sleep(0)
+        ingestion = asyncio.create_task(call("ingestion", Priority.INGESTION))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(call("interactive", Priority.INTERACTIVE))
+        await asyncio.gather(first, interactive)
+        ingestion.cancel()
+        return order
+
+    assert asyncio.run(run()) == ["first", "interactive"]
+
+
+def test_scheduler_retries_rate_limited_calls():
+    async def run():
+        scheduler = LlmScheduler(base_delay=0.01)
+        attempts = []
+
+        async def call():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise make_rate_limit_error("0.01")
+            return "ok"
+
+        return await scheduler.run("model", 10, call), len(attempts)
+
+    assert asyncio.run(run()) == ("ok", 3)
+
+
+def test_scheduler_raises_errors_that_are_not_retryable():
+    async def run():
+        scheduler = LlmScheduler()
+        attempts = []
+
+        async def call():
+            attempts.append(1)
+            raise ValueError("bad request")
+
+        try:
+            await scheduler.run("model", 10, call)
+        except ValueError:
+            return len(attempts)
+
+    assert asyncio.run(run()) == 1
+
+
+def test_token_bucket_charges_calls_bigger_than_its_burst_in_full():
+    bucket = TokenBucket(600)
+
+    # A call of a whole minute's tokens doesn't wait for more than a full bucket, but the calls after it pay it off
+    assert bucket.get_delay(600) == 0
+    bucket.take(600)
+
+    assert bucket.get_delay(1) >= 59
@@ -0,0 +1,59 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from app.llm_backend import LlmBackend, create_llm_backend
+from app.local_llm import LocalLlm
+from app.openai_llm import OpenAiLlm
+from app.smol_rag import SmolRag
+
+
+def test_backends_implement_the_protocol():
+    assert isinstance(LocalLlm(), LlmBackend)
+    assert isinstance(OpenAiLlm(), LlmBackend)
+    assert isinstance(create_llm_backend(8, backend="local"), LocalLlm)
+    with pytest.raises(ValueError):
+        create_llm_backend(backend="other")
+
+
+def test_local_embeddings_are_deterministic_and_lexical():
+    llm = LocalLlm(dimensions=256)
+
+    pricing, pricing_again, plural, webhooks, empty = (
+        np.array(embedding) for embedding in asyncio.run(llm.get_embeddings(
+            ["Style the pricing table", "Style the pricing table", "Styling pricing tables", "Verify webhooks", ""]
+        ))
+    )
+
+    assert np.array_equal(pricing, pricing_again)
+    assert np.isclose(np.linalg.norm(pricing), 1)
+    assert pricing @ plural > 0.5 > pricing @ webhooks
+    assert np.isclose(np.linalg.norm(empty), 1)
+
+
+def test_smol_rag_ingests_and_answers_offline(tmp_path):
+    docs_dir = tmp_path / "input_docs"
+    docs_dir.mkdir()
+    (docs_dir / "pricing.md").write_text("The pricing table lists every plan of a product.")
+    (docs_dir / "webhooks.md").write_text("Webhooks are signed, verify the signature header.")
+    smol_rag = SmolRag(
+        llm=LocalLlm(dimensions=64),
+        dimensions=64,
+        data_dir=str(tmp_path / "data"),
+        input_docs_dir=str(docs_dir),
+        excerpt_fn=lambda content, size, overlap: [content],
+    )
+
+    async def run():
+        await smol_rag.import_documents()
+        context = await smol_rag.get_context("How do I verify a webhook signature?")
+        answer = await smol_rag.query("How do I verify a webhook signature?")
+        chunks = [chunk async for chunk in await smol_rag.query_stream("How do I verify a webhook signature?")]
+        return context, answer, chunks
+
+    context, answer, chunks = asyncio.run(run())
+
+    assert context["data"]["excerpts"][0]["excerpt"].startswith("Webhooks are signed")
+    assert answer.startswith("Stub completion for:")
+    assert "".join(chunks) == answer
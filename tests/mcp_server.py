@@ -0,0 +1,90 @@
+import asyncio
+
+import mcp_server
+
+
+class FakeSmolRag:
+    """Streams a canned answer with a line break, as the streaming SmolRag query methods do."""
+
+    def __init__(self):
+        self.queries = []
+
+    async def mix_query_stream(self, text):
+        self.queries.append(text)
+
+        async def tokens():
+            for token in ["Checkout takes payments.\n", "Refunds ", "go through Stripe."]:
+                yield token
+
+        return tokens()
+
+
+def test_stream_query_forwards_the_answer_as_log_messages(monkeypatch):
+    from fastmcp import Client
+    smol_rag = FakeSmolRag()
+    monkeypatch.setattr(mcp_server, "smol_rag", smol_rag)
+    messages = []
+
+    async def log_handler(message):
+        messages.append(message.data)
+
+    async def run():
+        async with Client(mcp_server.create_mcp_server(), log_handler=log_handler) as client:
+            return await client.call_tool("stream_query", {"text": "How do refunds work?", "query_type": "mix"})
+
+    result = asyncio.run(run())
+
+    assert result[0].text == "Checkout takes payments.\nRefunds go through Stripe."
+    assert messages == ["Checkout takes payments.\n", "Refunds go through Stripe."]
+    assert smol_rag.queries == ["How do refunds work?"]
+
+
+class WarmingSmolRag:
+    def __init__(self):
+        self.warmed_up = asyncio.Event()
+
+    async def warm_up(self):
+        self.warmed_up.set()
+
+
+def test_warm_up_loads_the_stores_when_the_server_starts(monkeypatch):
+    from fastmcp import Client
+
+    async def run(warm_up):
+        smol_rag = WarmingSmolRag()
+        monkeypatch.setattr(mcp_server, "smol_rag", smol_rag)
+        async with Client(mcp_server.create_mcp_server(warm_up=warm_up)):
+            try:
+                await asyncio.wait_for(smol_rag.warmed_up.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+        return smol_rag.warmed_up.is_set()
+
+    assert not asyncio.run(run(warm_up=False))
+    assert asyncio.run(run(warm_up=True))
+
+
+def test_ingest_documents_refuses_unknown_corpora_and_read_only_snapshots(monkeypatch, tmp_path):
+    from fastmcp import Client
+    from fastmcp.exceptions import ToolError
+
+    import api.main
+    from app.corpora import CorpusRegistry
+    from app.llm_scheduler import LlmScheduler
+
+    class SnapshotSmolRag:
+        snapshot = object()
+        input_docs_dir = str(tmp_path)
+
+    monkeypatch.setattr(api.main, "corpora", CorpusRegistry(llm=object(), llm_scheduler=LlmScheduler()))
+    monkeypatch.setattr(api.main, "smol_rag", SnapshotSmolRag())
+
+    async def run(arguments):
+        async with Client(mcp_server.create_mcp_server()) as client:
+            try:
+                await client.call_tool("ingest_documents", arguments)
+            except ToolError as e:
+                return str(e)
+
+    assert "Unknown corpus: nope" in asyncio.run(run({"corpus": "nope"}))
+    assert "read-only snapshot" in asyncio.run(run({}))
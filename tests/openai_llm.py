@@ -0,0 +1,60 @@
+import asyncio
+from types import SimpleNamespace
+
+from app.kv_store import JsonKvStore
+from app.openai_llm import OpenAiLlm
+
+
+class FakeStream:
+    """A synchronous completion stream, as returned by the openai client, recording whether it was closed."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.closed = False
+
+    def __iter__(self):
+        for token in self.tokens:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+
+    def close(self):
+        self.closed = True
+
+
+def make_llm(tmp_path, stream):
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **kwargs: stream)))
+    return OpenAiLlm(
+        query_cache_kv=JsonKvStore(str(tmp_path / "query_cache.json")),
+        embedding_cache_kv=JsonKvStore(str(tmp_path / "embedding_cache.json")),
+        openai_api_key=client
+    )
+
+
+def test_completion_stream_is_cached_once_complete(tmp_path):
+    stream = FakeStream(["Checkout ", "takes ", "payments."])
+    llm = make_llm(tmp_path, stream)
+
+    async def run():
+        streamed = [token async for token in llm.get_completion_stream("What does Checkout do?", context="Docs")]
+        cached = [token async for token in llm.get_completion_stream("What does Checkout do?", context="Docs")]
+        return streamed, cached
+
+    streamed, cached = asyncio.run(run())
+
+    assert streamed == ["Checkout ", "takes ", "payments."]
+    assert cached == ["Checkout takes payments."]
+    assert stream.closed
+
+
+def test_completion_stream_is_closed_when_the_consumer_stops_early(tmp_path):
+    stream = FakeStream(["Checkout ", "takes ", "payments."])
+    llm = make_llm(tmp_path, stream)
+
+    async def run():
+        tokens = llm.get_completion_stream("What does Checkout do?")
+        first = await anext(tokens)
+        await tokens.aclose()
+        return first
+
+    assert asyncio.run(run()) == "Checkout "
+    assert stream.closed
+    assert llm.query_cache_kv.store == {}
@@ -0,0 +1,196 @@
+import asyncio
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from app.sharded_vector_store import ShardedVectorStore, _call_shard, get_shard
+from app.vector_store import NanoVectorStore
+
+DIMENSIONS = 8
+
+
+def make_rows(size=60):
+    rng = np.random.default_rng(0)
+    return [
+        {"__id__": f"row-{i}", "__vector__": rng.normal(size=DIMENSIONS), "__doc_id__": f"doc-{i % 7}"}
+        for i in range(size)
+    ], rng.normal(size=(4, DIMENSIONS))
+
+
+def get_ids(results):
+    return [[row["__id__"] for row in query_results] for query_results in results]
+
+
+def test_sharded_queries_match_a_single_store(tmp_path):
+    rows, queries = make_rows()
+    store = NanoVectorStore(str(tmp_path / "vdb.json"), DIMENSIONS)
+    sharded = ShardedVectorStore(str(tmp_path / "vdb"), DIMENSIONS, shards=3)
+    filter = {"doc_ids": ["doc-1", "doc-4"]}
+
+    async def run():
+        await store.upsert([dict(row) for row in rows])
+        await sharded.upsert([dict(row) for row in rows])
+        await sharded.save()
+        return (
+            await store.query_many(queries, top_k=5),
+            await sharded.query_many(queries, top_k=5),
+            await store.query_many(queries, top_k=5, filter=filter),
+            await sharded.query_many(queries, top_k=5, filter=filter),
+        )
+
+    reloaded = None
+    try:
+        expected, actual, expected_filtered, actual_filtered = asyncio.run(run())
+        reloaded = ShardedVectorStore(str(tmp_path / "vdb"), DIMENSIONS, shards=1)
+        reloaded_results = asyncio.run(reloaded.query_many(queries, top_k=5))
+    finally:
+        sharded.close()
+        if reloaded is not None:
+            reloaded.close()
+
+    assert get_ids(actual) == get_ids(expected)
+    assert get_ids(actual_filtered) == get_ids(expected_filtered)
+    assert reloaded.shard_names == ["shard-0", "shard-1", "shard-2"]
+    assert get_ids(reloaded_results) == get_ids(expected)
+
+
+def test_first_id_skips_empty_shards(tmp_path):
+    rows, _ = make_rows()
+    one_doc_rows = [row for row in rows if row["__doc_id__"] == "doc-3"]
+    sharded = ShardedVectorStore(str(tmp_path / "vdb"), DIMENSIONS, shards=3)
+
+    async def run():
+        empty = await sharded.get_first_id()
+        await sharded.upsert(one_doc_rows)
+        return empty, await sharded.get_first_id()
+
+    try:
+        empty, first_id = asyncio.run(run())
+    finally:
+        sharded.close()
+
+    assert empty is None
+    assert first_id == one_doc_rows[0]["__id__"]
+
+
+def test_adding_and_removing_shards_moves_only_their_rows(tmp_path):
+    rows, queries = make_rows()
+    sharded = ShardedVectorStore(str(tmp_path / "vdb"), DIMENSIONS, shards=2)
+
+    async def run():
+        await sharded.upsert(rows)
+        before = await sharded.query_many(queries, top_k=5)
+        await sharded.add_shard()
+        after_add = await sharded.query_many(queries, top_k=5)
+        shard_sizes = {
+            name: len((await sharded._call(name, _call_shard, "get_all"))[0]) for name in sharded.shard_names
+        }
+        await sharded.remove_shard("shard-0")
+        after_remove = await sharded.query_many(queries, top_k=5)
+        data, matrix = await sharded.get_all()
+        return before, after_add, shard_sizes, after_remove, data, matrix
+
+    try:
+        before, after_add, shard_sizes, after_remove, data, matrix = asyncio.run(run())
+    finally:
+        sharded.close()
+
+    assert get_ids(after_add) == get_ids(before)
+    assert get_ids(after_remove) == get_ids(before)
+    assert shard_sizes["shard-2"] > 0
+    assert sum(shard_sizes.values()) == 60
+    assert sorted(row["__id__"] for row in data) == sorted(row["__id__"] for row in rows)
+    assert matrix.shape == (60, DIMENSIONS)
+    assert sharded.shard_names == ["shard-1", "shard-2"]
+
+
+def test_queries_find_every_row_while_a_shard_is_added(tmp_path):
+    rows, queries = make_rows()
+    sharded = ShardedVectorStore(str(tmp_path / "vdb"), DIMENSIONS, shards=2)
+    call = sharded._call
+    during_add = []
+
+    async def call_and_query(name, fn, *args):
+        # Queries run without the store lock, so one can land between any two steps of add_shard
+        if fn is _call_shard and args[0] in ("upsert", "delete"):
+            sharded._call = call
+            during_add.append(await sharded.query_many(queries, top_k=60, better_than_threshold=None))
+            sharded._call = call_and_query
+        return await call(name, fn, *args)
+
+    async def run():
+        await sharded.upsert(rows)
+        sharded._call = call_and_query
+        await sharded.add_shard()
+        sharded._call = call
+
+    try:
+        asyncio.run(run())
+    finally:
+        sharded.close()
+
+    assert len(during_add) == 4
+    for results in during_add:
+        assert [len(ids) for ids in get_ids(results)] == [60] * len(queries)
+
+
+def test_rendezvous_hashing_only_moves_keys_to_the_new_shard():
+    keys = [f"doc-{i}" for i in range(200)]
+    before = {key: get_shard(key, ["a", "b", "c"]) for key in keys}
+    after = {key: get_shard(key, ["a", "b", "c", "d"]) for key in keys}
+
+    assert {after[key] for key in keys if after[key] != before[key]} == {"d"}
+
+
+def test_a_dead_shard_worker_is_restarted_from_its_file(tmp_path):
+    rows, queries = make_rows()
+    sharded = ShardedVectorStore(str(tmp_path / "vdb"), DIMENSIONS, shards=2)
+
+    async def run():
+        await sharded.upsert([dict(row) for row in rows])
+        await sharded.save()
+        expected = await sharded.query_many(queries, top_k=5)
+        worker = sharded._workers["shard-0"]
+        for process in list(worker._processes.values()):
+            process.kill()
+            process.join()
+        try:
+            await sharded.query_many(queries, top_k=5)
+            failed = False
+        except BrokenProcessPool:
+            failed = True
+        return expected, failed, await sharded.query_many(queries, top_k=5)
+
+    try:
+        expected, failed, actual = asyncio.run(run())
+    finally:
+        sharded.close()
+
+    assert failed
+    assert get_ids(actual) == get_ids(expected)
+
+
+def test_starting_the_workers_does_not_block_the_event_loop(tmp_path):
+    rows, queries = make_rows()
+    sharded = ShardedVectorStore(str(tmp_path / "vdb"), DIMENSIONS, shards=2)
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.001)
+
+    async def run():
+        ticker = asyncio.create_task(tick())
+        await asyncio.sleep(0)
+        await sharded.query_many(queries, top_k=5)
+        ticker.cancel()
+
+    try:
+        asyncio.run(run())
+    finally:
+        sharded.close()
+
+    # Blocked, the loop would not tick until the worker processes had started
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < (ticks[-1] - ticks[0]) / 2
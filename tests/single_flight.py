@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from app.metrics import metrics
+from app.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    flights = SingleFlight("test.run")
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(*(flights.run("key", fetch) for _ in range(5)))
+
+    metrics.reset()
+    assert asyncio.run(main()) == ["result"] * 5
+    assert len(calls) == 1
+    assert metrics.get("test.run.calls") == 1
+    assert metrics.get("test.run.dedup_hits") == 4
+    assert len(flights) == 0
+
+
+def test_errors_are_shared_and_not_cached():
+    flights = SingleFlight("test.error")
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def main():
+        results = await asyncio.gather(flights.run("key", fail), flights.run("key", fail), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        with pytest.raises(RuntimeError):
+            await flights.run("key", fail)
+
+    asyncio.run(main())
+    assert len(calls) == 2
+
+
+def test_run_many_only_fetches_keys_not_in_flight():
+    flights = SingleFlight("test.many")
+    fetched = []
+
+    async def fetch(keys):
+        fetched.append(keys)
+        await asyncio.sleep(0.01)
+        return {key: key.upper() for key in keys}
+
+    async def main():
+        return await asyncio.gather(
+            flights.run_many(["a", "b"], fetch),
+            flights.run_many(["b", "c", "a"], fetch),
+        )
+
+    metrics.reset()
+    assert asyncio.run(main()) == [["A", "B"], ["B", "C", "A"]]
+    assert fetched == [["a", "b"], ["c"]]
+    assert metrics.get("test.many.dedup_hits") == 2
+    assert len(flights) == 0
@@ -0,0 +1,451 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from app.definitions import TUPLE_SEP, REC_SEP, COMPLETE_TAG, KG_SEP
+from app.local_llm import LocalLlm
+from app.prompts import get_no_relevant_context_response
+from app.smol_rag import SmolRag
+from app.utilities import make_hash, normalize_entity_name
+from app.timings import Timings
+
+DIMENSIONS = 64
+DOCUMENTS = {
+    "checkout.md": "Checkout takes payments through Stripe.",
+    "webhooks.md": "Webhooks are signed, verify the signature header.",
+}
+REFUNDS = "The checkout page issues refunds."
+
+
+def record(*fields):
+    return "(" + TUPLE_SEP.join(f'"{field}"' for field in fields) + ")"
+
+
+# What the entity extraction prompt returns for the document containing each key
+EXTRACTIONS = {
+    "Checkout takes payments": [
+        record("entity", "Checkout", "feature", "Takes payments."),
+        record("entity", "Stripe", "api", "Processes card payments."),
+        record("relationship", "Checkout", "Stripe", "Checkout charges cards through Stripe.", "payments", 2),
+    ],
+    "Webhooks are signed": [
+        record("entity", "Webhook", "feature", "Notifies your server of events."),
+        record("entity", "Signature header", "configuration", "Signs every webhook."),
+        record("relationship", "Webhook", "Signature header", "Webhooks carry a signature header.", "security", 1),
+    ],
+    REFUNDS: [
+        record("entity", "the CHECKOUT", "feature", "Takes payments and issues refunds."),
+        record("entity", "Refund", "concept", "Money returned to a customer."),
+        record("relationship", "checkout", "Refund", "Checkout issues refunds.", "refunds", 1),
+    ],
+}
+ENTITY_NAMES = ["Checkout", "Stripe", "Webhook", "Signature header", "Refund"]
+
+
+class CountingLlm(LocalLlm):
+    """LocalLlm recording the texts it embeds one at a time, and counting its embedding calls."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.embedded = []
+        self.embedding_calls = 0
+
+    async def get_embedding(self, content, model=None):
+        self.embedded.append(content)
+        self.embedding_calls += 1
+        return await super().get_embedding(content, model)
+
+    async def get_embeddings(self, contents, model=None):
+        self.embedding_calls += 1
+        return await super().get_embeddings(contents, model)
+
+
+class ReversingLlm(LocalLlm):
+    """LocalLlm embedding every text backwards, standing in for another embedding model."""
+
+    async def get_embedding(self, content, model=None):
+        return await super().get_embedding(content[::-1], model)
+
+
+class FakeCompleter:
+    """Completion function for LocalLlm answering each SmolRag prompt with canned data, and queries with their context."""
+
+    def __init__(self):
+        self.prompts = []
+
+    def __call__(self, query, context):
+        self.prompts.append(query)
+        if query.startswith("-Goal-"):
+            text = query.rsplit("Text: ", 1)[1]
+            records = next((records for key, records in EXTRACTIONS.items() if key in text), [])
+            return REC_SEP.join(records) + COMPLETE_TAG
+        if "summarising one community" in query:
+            return "Report on " + ", ".join(name for name in ENTITY_NAMES if f"{name}," in query)
+        if "You are given several descriptions" in query:
+            lines = (line.strip() for line in query.splitlines())
+            return "Consolidated: " + " ".join(line[2:] for line in lines if line.startswith("- "))
+        return context or "A summary."
+
+    def count(self, text):
+        return sum(text in prompt for prompt in self.prompts)
+
+
+def make_smol_rag(tmp_path, completer, documents=DOCUMENTS, relevance_threshold=None, **kwargs):
+    docs_dir = tmp_path / "input_docs"
+    docs_dir.mkdir(exist_ok=True)
+    for name, content in documents.items():
+        (docs_dir / name).write_text(content)
+    return SmolRag(
+        llm=CountingLlm(dimensions=DIMENSIONS, completion_fn=completer),
+        dimensions=DIMENSIONS,
+        data_dir=str(tmp_path / "data"),
+        input_docs_dir=str(docs_dir),
+        excerpt_fn=lambda content, size, overlap: [content],
+        relevance_threshold=relevance_threshold,
+        **kwargs,
+    )
+
+
+def test_reindex_builds_community_reports_for_community_queries(tmp_path):
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter())
+
+    async def run():
+        await smol_rag.reindex()
+        context = await smol_rag.get_context("How does Checkout take payments with Stripe?", query_type="community")
+        answer = await smol_rag.community_query("How does Checkout take payments with Stripe?")
+        return context, answer
+
+    context, answer = asyncio.run(run())
+
+    reports = sorted(community["summary"] for community in smol_rag.community_kv.store.values())
+    assert reports == ["Report on Checkout, Stripe", "Report on Webhook, Signature header"]
+    assert context["data"]["communities"][0]["entities"] == ["Checkout", "Stripe"]
+    assert "## Community report\n\nReport on Checkout, Stripe" in answer
+
+
+def test_build_communities_only_summarises_changed_communities(tmp_path):
+    completer = FakeCompleter()
+    smol_rag = make_smol_rag(tmp_path, completer)
+
+    async def run():
+        await smol_rag.ingest()
+        summaries_after_ingest = completer.count("summarising one community")
+        await smol_rag.build_communities()
+        summaries_after_rebuild = completer.count("summarising one community")
+        await smol_rag.graph.merge_batch(
+            [("Refund", {"category": "feature", "description": "Returns a payment."})],
+            [(("Refund", "Stripe"), {"description": "Refunds go through Stripe.", "keywords": "", "weight": 1.0})],
+        )
+        await smol_rag.build_communities()
+        return summaries_after_ingest, summaries_after_rebuild, completer.count("summarising one community")
+
+    summaries_after_ingest, summaries_after_rebuild, summaries_after_change = asyncio.run(run())
+
+    assert summaries_after_ingest == 2
+    assert summaries_after_rebuild == 2
+    assert summaries_after_change == 3
+    assert sorted(community["entities"] for community in smol_rag.community_kv.store.values()) == [
+        ["Checkout", "Refund", "Stripe"], ["Signature header", "Webhook"]
+    ]
+    assert len(asyncio.run(smol_rag.communities_db.get_all())[0]) == 2
+
+
+def test_consolidate_descriptions_skips_unchanged_descriptions(tmp_path):
+    completer = FakeCompleter()
+    smol_rag = make_smol_rag(tmp_path, completer)
+    consolidation_prompt = "You are given several descriptions"
+
+    async def run():
+        # An entity whose name joins the ends of a relationship must not share its consolidation record
+        await smol_rag.graph.merge_batch(
+            [
+                ("Checkout", {"description": KG_SEP.join(["Takes payments.", "A web component."])}),
+                ("Checkout_Stripe", {"description": KG_SEP.join(["An odd name.", "Still an entity."])}),
+            ],
+            [(("Checkout", "Stripe"), {"description": KG_SEP.join(["Charges cards.", "Refunds cards."]), "weight": 1.0})],
+        )
+        counts = []
+        await smol_rag.consolidate_descriptions(max_token_size=3)
+        counts.append(completer.count(consolidation_prompt))
+        await smol_rag.consolidate_descriptions(max_token_size=3)
+        counts.append(completer.count(consolidation_prompt))
+        await smol_rag.graph.merge_batch([("Checkout", {"description": "Embeds in any page."})])
+        await smol_rag.consolidate_descriptions(max_token_size=3)
+        counts.append(completer.count(consolidation_prompt))
+        return counts
+
+    counts = asyncio.run(run())
+
+    assert counts == [3, 3, 4]
+    assert smol_rag.graph.get_node("Checkout")["description"].startswith("Consolidated: Consolidated: Takes payments.")
+    assert smol_rag.graph.get_edge(("Checkout", "Stripe"))["description"] == "Consolidated: Charges cards. Refunds cards."
+    assert len(smol_rag.consolidation_kv.store) == 3
+
+
+def test_entity_name_variants_resolve_to_the_first_seen_name(tmp_path):
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter(), {**DOCUMENTS, "refunds.md": REFUNDS})
+
+    async def run():
+        await smol_rag.import_documents([str(tmp_path / "input_docs" / "checkout.md")])
+        await smol_rag.import_documents()
+
+    asyncio.run(run())
+
+    assert sorted(name for name, _ in smol_rag.graph.get_nodes()) == [
+        "Checkout", "Refund", "Signature header", "Stripe", "Webhook"
+    ]
+    assert smol_rag.graph.get_node("Checkout")["description"] == KG_SEP.join(
+        ["Takes payments.", "Takes payments and issues refunds."]
+    )
+    assert smol_rag.graph.get_edge(("Checkout", "Refund"))["description"] == "Checkout issues refunds."
+    assert smol_rag.entity_alias_kv.store["checkout"] == "Checkout"
+
+
+def test_entity_merge_threshold_merges_similar_entities_and_reuses_their_vectors(tmp_path):
+    documents = {"checkout.md": DOCUMENTS["checkout.md"], "refunds.md": REFUNDS}
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter(), documents, entity_merge_threshold=0.6)
+
+    async def run():
+        await smol_rag.import_documents([str(tmp_path / "input_docs" / "checkout.md")])
+        # Without its alias, only the threshold can merge "the CHECKOUT" into Checkout
+        await smol_rag.entity_alias_kv.remove("checkout")
+        smol_rag.llm.embedded.clear()
+        await smol_rag.import_documents([str(tmp_path / "input_docs" / "refunds.md")])
+
+    asyncio.run(run())
+
+    assert sorted(name for name, _ in smol_rag.graph.get_nodes()) == ["Checkout", "Refund", "Stripe"]
+    assert smol_rag.entity_alias_kv.store["checkout"] == "Checkout"
+    # A new entity is stored with the vector requested to look for similar entities, not embedded again
+    assert smol_rag.llm.embedded.count("Refund Money returned to a customer.") == 1
+
+
+def test_migrate_entity_aliases_merges_name_variants(tmp_path):
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter())
+
+    async def run():
+        await smol_rag.graph.merge_batch(
+            [
+                ("Checkout", {"category": "feature", "description": "Takes payments."}),
+                ("the checkout", {"category": "feature", "description": "Issues refunds."}),
+                ("Stripe", {"category": "api", "description": "Processes card payments."}),
+                ("Refund", {"category": "concept", "description": "Money returned to a customer."}),
+                ("Webhook", {"category": "feature", "description": "Notifies your server of events."}),
+            ],
+            [
+                (("Checkout", "Stripe"), {"description": "Charges cards.", "keywords": "", "weight": 2.0}),
+                (("Checkout", "Webhook"), {"description": "Sends payment events.", "keywords": "", "weight": 1.0}),
+                (("Refund", "the checkout"), {"description": "Issues refunds.", "keywords": "", "weight": 1.0}),
+            ],
+        )
+        await smol_rag._embed_graph_items(
+            ["Checkout", "the checkout", "Stripe", "Refund", "Webhook"],
+            [("Checkout", "Stripe"), ("Checkout", "Webhook"), ("Refund", "the checkout")]
+        )
+        await smol_rag.migrate_entity_aliases()
+        entities, _ = await smol_rag.entities_db.get_all()
+        relationships, _ = await smol_rag.relationships_db.get_all()
+        return entities, relationships
+
+    entities, relationships = asyncio.run(run())
+
+    assert sorted(name for name, _ in smol_rag.graph.get_nodes()) == ["Checkout", "Refund", "Stripe", "Webhook"]
+    assert smol_rag.graph.get_node("Checkout")["description"] == KG_SEP.join(["Takes payments.", "Issues refunds."])
+    assert smol_rag.graph.get_edge(("Checkout", "Refund"))["description"] == "Issues refunds."
+    assert smol_rag.entity_alias_kv.store == {
+        "checkout": "Checkout", "stripe": "Stripe", "refund": "Refund", "webhook": "Webhook"
+    }
+    assert sorted(row["__entity_name__"] for row in entities) == ["Checkout", "Refund", "Stripe", "Webhook"]
+    assert sorted((row["__source__"], row["__target__"]) for row in relationships) == [
+        ("Checkout", "Refund"), ("Checkout", "Stripe"), ("Checkout", "Webhook")
+    ]
+
+
+STREAM_METHODS = [
+    "query", "hybrid_query", "local_kg_query", "global_kg_query", "hybrid_kg_query", "mix_query", "community_query"
+]
+
+
+def test_stream_methods_stream_the_answers_of_their_queries(tmp_path):
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter())
+    question = "How does Checkout take payments with Stripe?"
+
+    async def run():
+        await smol_rag.reindex()
+        results = {}
+        for method in STREAM_METHODS:
+            timings = Timings()
+            tokens = [token async for token in await getattr(smol_rag, f"{method}_stream")(question, timings=timings)]
+            results[method] = tokens, timings, await getattr(smol_rag, method)(question)
+        return results
+
+    results = asyncio.run(run())
+
+    for method, (tokens, timings, answer) in results.items():
+        assert len(tokens) > 1, method
+        assert "".join(tokens) == answer, method
+        assert {"first_token", "completion"} <= set(timings.stages), method
+
+
+def test_bm25_index_is_saved_on_import_and_loaded_on_restart(tmp_path):
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter())
+    asyncio.run(smol_rag.import_documents())
+    restarted = make_smol_rag(tmp_path, FakeCompleter())
+
+    async def fail():
+        raise AssertionError("The index was rebuilt from the excerpts")
+
+    restarted.excerpt_kv.get_all = fail
+
+    async def run():
+        index = await restarted._get_bm25_index()
+        found = [row["__id__"] for row in await index.query("Stripe")]
+        doc_id = await restarted.source_to_doc_kv.get_by_key(str(tmp_path / "input_docs" / "checkout.md"))
+        await restarted.remove_document_by_id(doc_id)
+        reloaded = make_smol_rag(tmp_path, FakeCompleter()).bm25_index
+        await reloaded.load()
+        return found, len(index), len(reloaded)
+
+    found, size, reloaded_size = asyncio.run(run())
+
+    assert len(found) == 1
+    assert size == reloaded_size == 1
+
+
+def test_mix_context_with_local_keywords_embeds_the_query_with_the_keywords(tmp_path):
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter())
+
+    async def run():
+        await smol_rag.reindex()
+        smol_rag.llm.embedding_calls = 0
+        return await smol_rag.get_context(
+            "How does Checkout take payments with Stripe?", query_type="mix", local_keywords=True
+        )
+
+    context = asyncio.run(run())
+
+    assert smol_rag.llm.embedding_calls == 1
+    assert "Checkout takes payments through Stripe." in [excerpt["excerpt"] for excerpt in context["data"]["excerpts"]]
+    assert "Stripe" in [entity["entity_name"] for entity in context["data"]["kg"]["entities"]]
+
+
+OFF_TOPIC = "What do jellyfish eat?"
+
+
+def test_relevance_gate_refuses_kg_and_mix_queries_before_keyword_extraction(tmp_path):
+    completer = FakeCompleter()
+    smol_rag = make_smol_rag(tmp_path, completer, relevance_threshold=0.2)
+    keyword_prompt = "identifying both high-level and low-level keywords"
+
+    async def run():
+        await smol_rag.reindex()
+        answers = [await smol_rag.hybrid_kg_query(OFF_TOPIC), await smol_rag.mix_query(OFF_TOPIC)]
+        refused_keyword_prompts = completer.count(keyword_prompt)
+        await smol_rag.mix_query("How does Checkout take payments with Stripe?")
+        return answers, refused_keyword_prompts, completer.count(keyword_prompt)
+
+    answers, refused_keyword_prompts, keyword_prompts = asyncio.run(run())
+
+    assert answers == [get_no_relevant_context_response()] * 2
+    assert refused_keyword_prompts == 0
+    assert keyword_prompts == 1
+
+
+def test_relevance_gate_scores_kg_queries_on_the_graph_with_one_embedding(tmp_path):
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter(), relevance_threshold=0.2)
+
+    async def run():
+        await smol_rag.reindex()
+        embedding = np.array(await smol_rag.llm.get_embedding(OFF_TOPIC))
+        graph_results = [
+            await store.query(query=embedding, top_k=1, better_than_threshold=0.02)
+            for store in (smol_rag.entities_db, smol_rag.relationships_db)
+        ]
+        smol_rag.llm.embedding_calls = 0
+        return graph_results, await smol_rag.get_context(OFF_TOPIC, query_type="hybrid_kg")
+
+    graph_results, context = asyncio.run(run())
+
+    assert context["top_score"] == max((float(rows[0]["__metrics__"]) for rows in graph_results if rows), default=None)
+    assert smol_rag.llm.embedding_calls == 1
+    assert "excerpt_search" not in context["timings"]["stages_ms"]
+    assert context["data"]["entities"] == []
+
+
+def test_queries_are_refused_when_the_backend_embeds_unlike_the_stores(tmp_path):
+    asyncio.run(make_smol_rag(tmp_path, FakeCompleter()).import_documents())
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter())
+    smol_rag.llm = ReversingLlm(dimensions=DIMENSIONS)
+    smaller = make_smol_rag(tmp_path, FakeCompleter())
+    smaller.llm = LocalLlm(dimensions=DIMENSIONS // 2)
+
+    with pytest.raises(ValueError, match="another model"):
+        asyncio.run(smol_rag.query("How does Checkout take payments with Stripe?"))
+    with pytest.raises(ValueError, match="dimensions"):
+        asyncio.run(smaller.query("How does Checkout take payments with Stripe?"))
+    assert asyncio.run(make_smol_rag(tmp_path, FakeCompleter()).query("How does Checkout take payments with Stripe?"))
+
+
+def test_migrate_entity_aliases_replaces_baseline_relationship_vectors(tmp_path):
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter())
+    edges = {
+        ("Checkout", "Stripe"): "Charges cards.",
+        ("Checkout", "Webhook"): "Sends payment events.",
+        ("Refund", "the checkout"): "Issues refunds.",
+    }
+
+    async def run():
+        await smol_rag.graph.merge_batch(
+            [(name, {"category": "feature", "description": f"About {name}."})
+             for name in ["Checkout", "the checkout", "Stripe", "Refund", "Webhook"]],
+            [
+                (edge, {"description": description, "keywords": "", "weight": 1.0, "excerpt_id": "excerpt_id_1"})
+                for edge, description in edges.items()
+            ],
+        )
+        # Relationship vectors as stored before this version, plus one whose edge is already gone
+        await smol_rag.relationships_db.upsert([
+            {
+                "__id__": make_hash(f"{source}_{target}", prefix="ent-"),
+                "__source__": source,
+                "__target__": target,
+                "__vector__": smol_rag.llm.embed(f" {source} {target} {description}"),
+            }
+            for (source, target), description in {**edges, ("Gone", "Stripe"): "Charges cards."}.items()
+        ])
+        await smol_rag.migrate_entity_aliases()
+        relationships, _ = await smol_rag.relationships_db.get_all()
+        hl_dataset, _, _ = await smol_rag._get_high_level_dataset(smol_rag.llm.embed("Stripe Charges cards."))
+        return relationships, hl_dataset
+
+    relationships, hl_dataset = asyncio.run(run())
+
+    assert sorted((row["__source__"], row["__target__"]) for row in relationships) == [
+        ("Checkout", "Refund"), ("Checkout", "Stripe"), ("Checkout", "Webhook"), ("Gone", "Stripe")
+    ]
+    # The vector of the missing edge is skipped rather than failing the query
+    assert sorted(relation["src_tgt"] for relation in hl_dataset) == [
+        ("Checkout", "Refund"), ("Checkout", "Stripe"), ("Checkout", "Webhook")
+    ]
+
+
+class SlowEmbeddingLlm(CountingLlm):
+    """CountingLlm whose embeddings take a while, as a network call would."""
+
+    async def get_embedding(self, content, model=None):
+        await asyncio.sleep(0.01)
+        return await super().get_embedding(content, model)
+
+
+def test_concurrently_imported_name_variants_resolve_to_one_name(tmp_path):
+    documents = {"checkout.md": DOCUMENTS["checkout.md"], "refunds.md": REFUNDS}
+    # A threshold no variant reaches, so each resolution awaits an embedding between reading and recording its alias
+    smol_rag = make_smol_rag(tmp_path, FakeCompleter(), documents, entity_merge_threshold=0.999)
+    smol_rag.llm = SlowEmbeddingLlm(dimensions=DIMENSIONS, completion_fn=smol_rag.llm.completion_fn)
+
+    asyncio.run(smol_rag.import_documents())
+
+    names = [name for name, _ in smol_rag.graph.get_nodes()]
+    assert len(names) == 3
+    assert sum(normalize_entity_name(name) == "checkout" for name in names) == 1
@@ -0,0 +1,104 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from app.bm25_index import Bm25Index
+from app.graph_store import NetworkXGraphStore
+from app.kv_store import JsonKvStore
+from app.smol_rag import SmolRag
+from app.snapshot import KV_STORES, VECTOR_STORES, Snapshot, SnapshotError, export_snapshot, get_current_snapshot, \
+    publish_snapshot
+from app.vector_store import NanoVectorStore
+
+DIMENSIONS = 8
+
+
+def make_smol_rag(tmp_path):
+    stores = {name: NanoVectorStore(str(tmp_path / f"{name}.json"), DIMENSIONS) for name in VECTOR_STORES}
+    stores.update({name: JsonKvStore(str(tmp_path / f"{name}.json")) for name in KV_STORES})
+    return SmolRag(
+        llm=object(),
+        graph_db=NetworkXGraphStore(str(tmp_path / "kg.graphml")),
+        bm25_index=Bm25Index(),
+        dimensions=DIMENSIONS,
+        **stores,
+    )
+
+
+def test_snapshot_round_trip(tmp_path):
+    smol_rag = make_smol_rag(tmp_path)
+    vectors = np.random.default_rng(0).random((3, DIMENSIONS))
+
+    async def run():
+        await smol_rag.embeddings_db.upsert([
+            {"__id__": f"excerpt_{i}", "__vector__": vector, "doc_id": "doc_1"} for i, vector in enumerate(vectors)
+        ])
+        await smol_rag.excerpt_kv.add_many({f"excerpt_{i}": {"excerpt": f"plan_uuid {i}"} for i in range(3)})
+        await smol_rag.graph.merge_batch(
+            [("Checkout", {"category": "feature", "description": "Takes payments."})],
+            [(("Checkout", "Stripe"), {"description": "Checkout uses Stripe.", "weight": 1.0})],
+        )
+        manifest = await export_snapshot(smol_rag, str(tmp_path / "snapshot.smolrag"))
+
+        restored = SmolRag.from_snapshot(str(tmp_path / "snapshot.smolrag"), llm=object())
+        assert not any(restored.get_store_status().values())
+        results = await restored.embeddings_db.query(vectors[1], top_k=1)
+        excerpts = await restored.excerpt_kv.get_all()
+        bm25_results = await (await restored._get_bm25_index()).query("plan_uuid 2")
+        with pytest.raises(PermissionError):
+            await restored.excerpt_kv.add("excerpt_3", {})
+        return manifest, results, excerpts, restored.graph, bm25_results
+
+    manifest, results, excerpts, graph, bm25_results = asyncio.run(run())
+
+    assert manifest["counts"]["embeddings_db"] == 3
+    assert results[0]["__id__"] == "excerpt_1"
+    assert results[0]["doc_id"] == "doc_1"
+    assert excerpts["excerpt_2"] == {"excerpt": "plan_uuid 2"}
+    assert graph.get_node("Checkout")["description"] == "Takes payments."
+    assert graph.get_edge(("Stripe", "Checkout"))["description"] == "Checkout uses Stripe."
+    assert graph.get_node_edges("Checkout") == [("Checkout", "Stripe")]
+    assert graph.degree("Stripe") == 1
+    assert bm25_results[0]["__id__"] == "excerpt_2"
+
+
+def test_snapshot_detects_corruption(tmp_path):
+    smol_rag = make_smol_rag(tmp_path)
+    asyncio.run(smol_rag.excerpt_kv.add("excerpt_1", {"excerpt": "text"}))
+    path = tmp_path / "snapshot.smolrag"
+    asyncio.run(export_snapshot(smol_rag, str(path)))
+
+    snapshot = Snapshot(str(path))
+    blob = snapshot.manifest["blobs"]["excerpt_kv.values"]
+    content = bytearray(path.read_bytes())
+    content[snapshot._data_start + blob["offset"]] ^= 0xFF
+    path.write_bytes(bytes(content))
+
+    with pytest.raises(SnapshotError):
+        Snapshot(str(path)).get_json("excerpt_kv")
+
+
+def test_publish_snapshot_increments_generation(tmp_path):
+    smol_rag = make_smol_rag(tmp_path)
+    directory = str(tmp_path / "snapshots")
+
+    asyncio.run(publish_snapshot(smol_rag, directory))
+    asyncio.run(publish_snapshot(smol_rag, directory))
+    current = get_current_snapshot(directory)
+
+    assert current["generation"] == 2
+    assert SmolRag.from_snapshot(directory, llm=object()).snapshot.generation == 2
+
+
+def test_snapshot_vector_stores_use_two_stage_search(tmp_path):
+    smol_rag = make_smol_rag(tmp_path)
+    path = str(tmp_path / "snapshot.smolrag")
+    asyncio.run(export_snapshot(smol_rag, path))
+
+    restored = SmolRag.from_snapshot(path, llm=object(), coarse_dimensions=4, coarse_candidates=20)
+    restored.use_snapshot(Snapshot(path))
+
+    for name in VECTOR_STORES:
+        store = getattr(restored, name)
+        assert (store.coarse_dimensions, store.coarse_candidates) == (4, 20)
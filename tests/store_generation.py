@@ -0,0 +1,111 @@
+import asyncio
+
+from app.bm25_index import Bm25Index
+from app.graph_store import NetworkXGraphStore
+from app.kv_store import JsonKvStore
+from app.smol_rag import SmolRag
+from app.snapshot import KV_STORES, VECTOR_STORES
+from app.vector_store import NanoVectorStore
+
+DIMENSIONS = 8
+
+
+def make_smol_rag(tmp_path):
+    stores = {name: NanoVectorStore(str(tmp_path / f"{name}.json"), DIMENSIONS) for name in VECTOR_STORES}
+    stores.update({name: JsonKvStore(str(tmp_path / f"{name}.json")) for name in KV_STORES})
+    return SmolRag(
+        llm=object(),
+        graph_db=NetworkXGraphStore(str(tmp_path / "kg.graphml")),
+        bm25_index=Bm25Index(),
+        dimensions=DIMENSIONS,
+        **stores,
+    )
+
+
+def test_reindex_swaps_generation_once_ingestion_completes(tmp_path):
+    smol_rag = make_smol_rag(tmp_path)
+
+    async def ingest():
+        await smol_rag.excerpt_kv.add("excerpt_2", {"excerpt": "plan_uuid two"})
+        seen_during_ingest.append(await live_excerpt_kv.get_all())
+        await smol_rag.excerpt_kv.save()
+
+    async def run():
+        await smol_rag.excerpt_kv.add("excerpt_1", {"excerpt": "plan_uuid one"})
+        await smol_rag.reindex(ingest)
+        return await smol_rag.excerpt_kv.get_all(), await (await smol_rag._get_bm25_index()).query("plan_uuid")
+
+    seen_during_ingest = []
+    live_excerpt_kv = smol_rag.excerpt_kv
+    excerpts, bm25_results = asyncio.run(run())
+
+    assert list(seen_during_ingest[0]) == ["excerpt_1"]
+    assert list(excerpts) == ["excerpt_1", "excerpt_2"]
+    assert {result["__id__"] for result in bm25_results} == {"excerpt_1", "excerpt_2"}
+    assert smol_rag.generation.number == 1
+    assert "excerpt_2" in JsonKvStore(str(tmp_path / "excerpt_kv.json")).store
+
+
+def test_running_query_keeps_its_generation_until_it_finishes(tmp_path):
+    smol_rag = make_smol_rag(tmp_path)
+    old_generation = smol_rag.generation
+
+    async def ingest():
+        await smol_rag.excerpt_kv.add("excerpt_1", {"excerpt": "plan_uuid one"})
+
+    async def run():
+        with smol_rag._pin_generation():
+            await smol_rag.reindex(ingest)
+            pinned_excerpts = await smol_rag.excerpt_kv.get_all()
+            assert old_generation.stores
+        return pinned_excerpts, await smol_rag.excerpt_kv.get_all()
+
+    pinned_excerpts, live_excerpts = asyncio.run(run())
+
+    assert pinned_excerpts == {}
+    assert list(live_excerpts) == ["excerpt_1"]
+    assert old_generation.stores == {}
+
+
+def test_failed_reindex_leaves_live_files_untouched(tmp_path):
+    smol_rag = make_smol_rag(tmp_path)
+
+    async def ingest():
+        await smol_rag.excerpt_kv.add("excerpt_1", {"excerpt": "plan_uuid one"})
+        await smol_rag.excerpt_kv.save()
+        raise RuntimeError("Embedding service unavailable")
+
+    async def run():
+        try:
+            await smol_rag.reindex(ingest)
+        except RuntimeError:
+            pass
+        return await smol_rag.excerpt_kv.get_all()
+
+    assert asyncio.run(run()) == {}
+    assert JsonKvStore(str(tmp_path / "excerpt_kv.json")).store == {}
+    assert "excerpt_1" in JsonKvStore(str(tmp_path / "staging" / "excerpt_kv.json")).store
+
+
+def test_direct_writes_wait_for_a_running_reindex(tmp_path):
+    smol_rag = make_smol_rag(tmp_path)
+    events = []
+
+    async def ingest():
+        await smol_rag.excerpt_kv.add("excerpt_1", {"excerpt": "plan_uuid one"})
+        await asyncio.sleep(0.05)
+        events.append("ingested")
+
+    async def build_communities():
+        await smol_rag.build_communities()
+        events.append("built communities")
+
+    async def run():
+        reindex = asyncio.create_task(smol_rag.reindex(ingest))
+        await asyncio.sleep(0)
+        await asyncio.gather(reindex, build_communities())
+
+    asyncio.run(run())
+
+    assert events == ["ingested", "built communities"]
+    assert smol_rag.generation.number == 1
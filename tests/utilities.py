@@ -0,0 +1,37 @@
+import pytest
+
+from app.utilities import normalize_entity_name, reciprocal_rank_fusion, get_relative_path
+
+
+@pytest.mark.parametrize(
+    "name,expected",
+    [
+        ("Salable API", "salable api"),
+        ("SALABLE API", "salable api"),
+        ("the Salable API", "salable api"),
+        ("  Salable \n API ", "salable api"),
+        ('"Salable API"', "salable api"),
+        ("An Example", "an example"),
+        ("A Record", "a record"),
+        ("a payment method", "payment method"),
+        ("The Record", "record"),
+        ("Theme", "theme"),
+        ("checkoutCreateIntent", "checkoutcreateintent"),
+    ],
+)
+def test_normalize_entity_name(name, expected):
+    assert normalize_entity_name(name) == expected
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "d"]], k=60)
+
+    assert [item_id for item_id, _ in fused] == ["c", "a", "b", "d"]
+    assert fused[0][1] == pytest.approx(1 / 63 + 1 / 61)
+
+
+def test_get_relative_path():
+    assert get_relative_path("/srv/app/input_docs/events/created.md", "/srv/app/input_docs") == "events/created.md"
+    assert get_relative_path("/Users/me/app/input_docs/Components/checkout.md", "/srv/app/input_docs") == \
+        "Components/checkout.md"
+    assert get_relative_path("/elsewhere/doc.md", "/srv/app/input_docs") == "/elsewhere/doc.md"
@@ -0,0 +1,125 @@
+import asyncio
+
+import numpy as np
+
+from app.vector_store import NanoVectorStore
+
+
+def make_store(tmp_path, dimensions=8, size=50):
+    store = NanoVectorStore(str(tmp_path / "vdb.json"), dimensions)
+    rng = np.random.default_rng(0)
+    rows = [{"__id__": f"row-{i}", "__vector__": rng.normal(size=dimensions)} for i in range(size)]
+    asyncio.run(store.upsert(rows))
+    return store, rng
+
+
+def test_query_many_matches_query(tmp_path):
+    store, rng = make_store(tmp_path)
+    queries = rng.normal(size=(4, 8))
+
+    batched = asyncio.run(store.query_many(queries, top_k=5, better_than_threshold=0.1))
+
+    for query, results in zip(queries, batched):
+        expected = asyncio.run(store.query(query, top_k=5, better_than_threshold=0.1))
+        assert [r["__id__"] for r in results] == [r["__id__"] for r in expected]
+        assert np.allclose([r["__metrics__"] for r in results], [r["__metrics__"] for r in expected])
+
+
+def test_query_many_on_empty_store(tmp_path):
+    store = NanoVectorStore(str(tmp_path / "vdb.json"), 8)
+
+    assert asyncio.run(store.query_many(np.ones((2, 8)))) == [[], []]
+
+
+def test_query_filter_only_scores_matching_rows(tmp_path):
+    store = NanoVectorStore(str(tmp_path / "vdb.json"), 8)
+    rng = np.random.default_rng(0)
+    rows = [
+        {"__id__": f"row-{i}", "__vector__": rng.normal(size=8), "__doc_id__": f"doc-{i % 3}", "__inserted_at__": i}
+        for i in range(30)
+    ]
+    asyncio.run(store.upsert(rows))
+    query = rng.normal(size=8)
+
+    results = asyncio.run(store.query(
+        query, top_k=30, better_than_threshold=None,
+        filter={"doc_ids": ["doc-1", "doc-2"], "inserted_after": 10, "inserted_before": 20}
+    ))
+    unfiltered = asyncio.run(store.query(query, top_k=30, better_than_threshold=None))
+
+    ids = {f"row-{i}" for i in range(10, 20) if i % 3}
+    assert {r["__id__"] for r in results} == ids
+    assert [r["__id__"] for r in results] == [r["__id__"] for r in unfiltered if r["__id__"] in ids]
+    assert asyncio.run(store.query(query, filter={"doc_ids": ["doc-9"]})) == []
+
+
+def test_two_stage_search_rescores_coarse_candidates_at_full_dimension(tmp_path):
+    rng = np.random.default_rng(0)
+    # Leading dimensions dominate, as in Matryoshka embeddings
+    scales = np.linspace(4, 0.5, 32)
+    rows = [{"__id__": f"row-{i}", "__vector__": rng.normal(size=32) * scales} for i in range(500)]
+    exhaustive = NanoVectorStore(str(tmp_path / "exhaustive.json"), 32)
+    two_stage = NanoVectorStore(str(tmp_path / "two_stage.json"), 32, coarse_dimensions=8, coarse_candidates=100)
+    queries = rng.normal(size=(20, 32)) * scales
+
+    async def run():
+        await exhaustive.upsert([dict(row) for row in rows])
+        await two_stage.upsert([dict(row) for row in rows])
+        return (
+            await exhaustive.query_many(queries, top_k=5, better_than_threshold=None),
+            await two_stage.query_many(queries, top_k=5, better_than_threshold=None),
+            await two_stage.query(queries[0], top_k=5, better_than_threshold=None),
+        )
+
+    expected, actual, single = asyncio.run(run())
+
+    hits = sum(len({r["__id__"] for r in e} & {r["__id__"] for r in a}) for e, a in zip(expected, actual))
+    assert hits / (5 * len(queries)) >= 0.9
+    assert [r["__id__"] for r in single] == [r["__id__"] for r in actual[0]]
+    for expected_results, results in zip(expected, actual):
+        expected_scores = {r["__id__"]: r["__metrics__"] for r in expected_results}
+        for result in results:
+            if result["__id__"] in expected_scores:
+                assert np.isclose(result["__metrics__"], expected_scores[result["__id__"]])
+
+
+def test_zero_queries_and_vectors_score_zero(tmp_path):
+    store, rng = make_store(tmp_path)
+    asyncio.run(store.upsert([{"__id__": "zero", "__vector__": np.zeros(8)}]))
+
+    queries = np.vstack([np.zeros(8), rng.normal(size=8)])
+
+    results = asyncio.run(store.query_many(queries, top_k=60, better_than_threshold=None))
+
+    assert [r["__metrics__"] for r in results[0]] == [0] * 51
+    assert not np.isnan([r["__metrics__"] for r in results[1]]).any()
+    assert next(r["__metrics__"] for r in results[1] if r["__id__"] == "zero") == 0
+
+
+def test_saved_store_is_read_by_nano_vectordb(tmp_path):
+    from nano_vectordb import NanoVectorDB
+    store, rng = make_store(tmp_path)
+    query = rng.normal(size=8)
+    asyncio.run(store.upsert([{"__id__": "row-3", "__vector__": query, "__doc_id__": "doc-1"}]))
+    asyncio.run(store.delete(["row-4"]))
+    asyncio.run(store.save())
+
+    reloaded = NanoVectorStore(store.storage_file, 8)
+    expected = NanoVectorDB(8, storage_file=store.storage_file).query(query, top_k=5)
+    actual = asyncio.run(reloaded.query(query, top_k=5, better_than_threshold=None))
+
+    assert len(asyncio.run(reloaded.get_all())[0]) == 49
+    assert [r["__id__"] for r in actual] == [r["__id__"] for r in expected]
+    assert actual[0] == {"__id__": "row-3", "__doc_id__": "doc-1", "__metrics__": actual[0]["__metrics__"]}
+    assert np.isclose(actual[0]["__metrics__"], 1)
+
+
+def test_two_stage_search_of_a_query_with_zero_leading_dimensions(tmp_path):
+    store, rng = make_store(tmp_path, size=300)
+    store.coarse_dimensions, store.coarse_candidates = 4, 20
+    query = np.concatenate([np.zeros(4), rng.normal(size=4)])
+
+    with np.errstate(invalid="raise"):
+        results = asyncio.run(store.query(query, top_k=5, better_than_threshold=None))
+
+    assert len(results) == 5